@@ -1,6 +1,7 @@
+import gc
 import os
 
-from celery import Celery
+from celery import Celery, signals
 
 # Set the default Django settings module for the 'celery' program.
 # Change between 'CLAMS_web.settings.dev' or 'CLAMS_web.settings.prod' depending on environment
@@ -18,6 +19,43 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
 
+@signals.celeryd_init.connect
+def configure_queue_worker(conf=None, options=None, **kwargs):
+    """Give a worker of a single job queue the concurrency and memory limit of that queue.
+
+    Start one worker per queue, e.g. celery -A CLAMS_web worker -Q small. Options given on the command line are kept.
+    """
+    from django.conf import settings
+
+    queues = options.get('queues') or []
+    if isinstance(queues, str):
+        queues = queues.split(',')
+    if len(queues) != 1 or queues[0] not in settings.CLAMS_JOB_QUEUES:
+        return
+    queue_settings = settings.CLAMS_JOB_QUEUES[queues[0]]
+    conf.worker_concurrency = queue_settings['concurrency']
+    conf.worker_max_memory_per_child = queue_settings['max_memory_per_child']
+
+
+@signals.worker_init.connect
+def preload_processing(**kwargs):
+    """Import and warm up the processing stack in the worker's main process before it starts its pool.
+
+    Web processes only import clams_processing when a job runs, so without this every pool process would import pandas
+    on its first job. Processes forked from the warmed-up main process, including those replacing a child that reached
+    its memory limit, share its pages copy-on-write. Freezing the garbage collector keeps the children from writing to
+    the pages of the preloaded objects when they collect.
+    """
+    from django.conf import settings
+
+    if not settings.CLAMS_WORKER_PRELOAD:
+        return
+    import clams_processing
+
+    clams_processing.warm_up()
+    gc.freeze()
+
+
 @app.task(bind=True, ignore_result=True)
 def debug_task(self):
     print(f'Request: {self.request!r}')
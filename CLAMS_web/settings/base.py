@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/dev/ref/settings/
 from pathlib import Path
 
 from environs import Env
+from kombu import Queue
 
 env = Env()
 env.read_env()
@@ -40,6 +41,8 @@ INSTALLED_APPS = [
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
+    # Serve static files with WhiteNoise in runserver too
+    'whitenoise.runserver_nostatic',
     'django.contrib.staticfiles',
     'django.contrib.sites',
 
@@ -49,6 +52,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # Answers static file requests before the rest of the middleware and the views
+    'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -85,6 +90,13 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # The workers write the results table while the web processes read it, see wrangler/results.py. With the
+        # write-ahead log readers are not blocked by a writer, and a writer waits for another instead of failing.
+        # init_command requires Django 5.1.
+        'OPTIONS': {
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+            'timeout': 30,
+        },
     }
 }
 
@@ -125,12 +137,41 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 STATICFILES_DIRS = [str(BASE_DIR.joinpath('static'))]
-# STATIC_ROOT = str(BASE_DIR.joinpath('staticfiles'))
+STATIC_ROOT = str(BASE_DIR.joinpath('staticfiles'))
+
+# collectstatic copies the static files to STATIC_ROOT with the hash of their content in their names, plus gzip and
+# brotli compressed variants. WhiteNoise serves the hashed files with far-future immutable cache headers, a changed file
+# gets a new name, and the compressed variant the browser accepts.
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage'},
+}
+# Cache lifetime in seconds of static files without a hash in their name, e.g. favicon.ico
+WHITENOISE_MAX_AGE = env.int('WHITENOISE_MAX_AGE', default=3600)
 
 # Media files (user uploaded)
 MEDIA_ROOT = str(BASE_DIR.joinpath('media'))
 MEDIA_URL = 'media/'
 
+# Storage of uploads and results shared by the web and worker nodes, see clams_storage.py: a directory (MEDIA_ROOT by
+# default) or s3://bucket/prefix, with CLAMS_S3_ENDPOINT_URL for S3-compatible stores such as MinIO
+CLAMS_STORAGE_URL = env.str('CLAMS_STORAGE_URL', default=MEDIA_ROOT)
+CLAMS_S3_ENDPOINT_URL = env.str('CLAMS_S3_ENDPOINT_URL', default=None)
+# Local directories of the workers for uploads fetched from a remote storage and a cache of fetched files
+CLAMS_WORKSPACE_DIR = env.str('CLAMS_WORKSPACE_DIR', default=str(BASE_DIR.joinpath('workspace')))
+CLAMS_WORKER_CACHE_DIR = env.str('CLAMS_WORKER_CACHE_DIR', default=str(BASE_DIR.joinpath('worker_cache')))
+CLAMS_WORKER_CACHE_BYTES = env.int('CLAMS_WORKER_CACHE_BYTES', default=10 * 1024 ** 3)
+# Subjects processed at the same time when jobs run subject by subject, see clams_processing.stream_pipeline. 0 runs
+# every job stage by stage.
+CLAMS_MAX_SUBJECTS_IN_FLIGHT = env.int('CLAMS_MAX_SUBJECTS_IN_FLIGHT', default=0)
+# Uploaded files are stored once per content, hashed by these handlers while they are received. Contents no upload
+# references are deleted once they have not been stored or reused for CLAMS_BLOB_MIN_AGE seconds.
+FILE_UPLOAD_HANDLERS = [
+    'wrangler.storage.HashingMemoryFileUploadHandler',
+    'wrangler.storage.HashingTemporaryFileUploadHandler',
+]
+CLAMS_BLOB_MIN_AGE = env.int('CLAMS_BLOB_MIN_AGE', default=3600)
+
 # Celery settings
 CELERY_BROKER_URL = 'redis://localhost:6379/0'  # Use Redis as the message broker
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'  # Use Redis as the result backend
@@ -139,6 +180,70 @@ CELERY_TASK_SERIALIZER = 'json'   # Serialize tasks as JSON
 CELERY_RESULT_SERIALIZER = 'json'  # Serialize results as JSON
 CELERY_TIMEZONE = 'UTC'           # Set the timezone
 CELERY_TASK_ALWAYS_EAGER = False
+# Processing jobs are routed to the small or large queue by their estimated cost, see wrangler/routing.py
+CELERY_TASK_QUEUES = (Queue('small'), Queue('large'))
+CELERY_TASK_DEFAULT_QUEUE = 'small'
+# Workers take one job at a time, so a long job never holds back jobs prefetched behind it
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_TASK_ACKS_LATE = True
+# Import the processing stack in the worker's main process before it forks its pool, see CLAMS_web/celery.py
+CLAMS_WORKER_PRELOAD = env.bool('CLAMS_WORKER_PRELOAD', default=True)
+
+# Job admission, see wrangler/admission.py
+# Submissions are refused while this many jobs are waiting in the queues
+CLAMS_MAX_PENDING_JOBS = env.int('CLAMS_MAX_PENDING_JOBS', default=50)
+# Seconds after which the active job of an upload is forgotten even if it never finished
+CLAMS_ACTIVE_JOB_TIMEOUT = env.int('CLAMS_ACTIVE_JOB_TIMEOUT', default=24 * 3600)
+
+# Cache shared by all web processes, holds the active job of every upload
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': env.str('CLAMS_CACHE_URL', default='redis://localhost:6379/1'),
+    }
+}
+
+# Seconds the downsampled previews of the subjects are kept in the cache, see wrangler/preview.py
+CLAMS_PREVIEW_CACHE_SECONDS = env.int('CLAMS_PREVIEW_CACHE_SECONDS', default=24 * 3600)
+
+# Job routing
+# Estimated job wall time in seconds: MB * (COST_PER_MB + COST_PER_MB_PER_BIN * bin sizes) + COST_PER_FILE * files
+CLAMS_JOB_COST_PER_MB = env.float('CLAMS_JOB_COST_PER_MB', default=0.25)
+CLAMS_JOB_COST_PER_MB_PER_BIN = env.float('CLAMS_JOB_COST_PER_MB_PER_BIN', default=0.15)
+CLAMS_JOB_COST_PER_FILE = env.float('CLAMS_JOB_COST_PER_FILE', default=0.05)
+# Jobs estimated to take longer go to the large queue
+CLAMS_LARGE_JOB_SECONDS = env.float('CLAMS_LARGE_JOB_SECONDS', default=60)
+# Settings of the workers of each queue (max_memory_per_child in KB) and time limits of its jobs in seconds. Worker
+# settings given on the celery command line take precedence.
+CLAMS_JOB_QUEUES = {
+    'small': {
+        'concurrency': env.int('CLAMS_SMALL_CONCURRENCY', default=4),
+        'max_memory_per_child': env.int('CLAMS_SMALL_MAX_MEMORY_PER_CHILD', default=1_000_000),
+        'soft_time_limit': env.int('CLAMS_SMALL_SOFT_TIME_LIMIT', default=600),
+        'time_limit': env.int('CLAMS_SMALL_TIME_LIMIT', default=660),
+    },
+    'large': {
+        'concurrency': env.int('CLAMS_LARGE_CONCURRENCY', default=1),
+        'max_memory_per_child': env.int('CLAMS_LARGE_MAX_MEMORY_PER_CHILD', default=8_000_000),
+        'soft_time_limit': env.int('CLAMS_LARGE_SOFT_TIME_LIMIT', default=4 * 3600),
+        'time_limit': env.int('CLAMS_LARGE_TIME_LIMIT', default=4 * 3600 + 300),
+    },
+}
+
+# Processing instrumentation
+# Upload IDs of jobs to profile with cProfile, or '*' for every job, e.g. CLAMS_PROFILE_JOBS=<upload_id>,<upload_id>
+CLAMS_PROFILE_JOBS = env.list('CLAMS_PROFILE_JOBS', default=[])
+CLAMS_PROFILE_DIR = env.str('CLAMS_PROFILE_DIR', default=str(BASE_DIR.joinpath('profiles')))
+
+# Metrics
+# Directory shared by the web and worker processes to publish their metric values
+CLAMS_METRICS_DIR = env.str('CLAMS_METRICS_DIR', default=str(BASE_DIR.joinpath('metrics')))
+# Clients allowed to scrape the /metrics/ endpoint
+CLAMS_METRICS_ALLOWED_IPS = env.list('CLAMS_METRICS_ALLOWED_IPS', default=['127.0.0.1', '::1'])
+# Seconds the size of MEDIA_ROOT is cached between scrapes, walking it gets slower as uploads accumulate
+CLAMS_MEDIA_USAGE_CACHE_SECONDS = env.int('CLAMS_MEDIA_USAGE_CACHE_SECONDS', default=300)
+# Port for Celery workers to serve their own metrics on, e.g. when they do not share CLAMS_METRICS_DIR with the web tier
+CLAMS_WORKER_METRICS_PORT = env.int('CLAMS_WORKER_METRICS_PORT', default=None)
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/dev/ref/settings/#default-auto-field
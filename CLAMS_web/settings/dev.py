@@ -34,6 +34,11 @@ LOGGING = {
             'handlers': ['console'],
             # 'level': 'DEBUG',
         },
+        'instrumentation': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
     'root': {'level': 'INFO'},
 }
\ No newline at end of file
@@ -32,6 +32,11 @@ LOGGING = {
             'class': 'logging.FileHandler',
             'filename': '/var/log/clamswrangler/django.log',
         },
+        'jobs': {
+            'level': 'INFO',
+            'class': 'logging.FileHandler',
+            'filename': '/var/log/clamswrangler/jobs.log',
+        },
     },
     'loggers': {
         'django': {
@@ -39,5 +44,10 @@ LOGGING = {
             'level': 'WARNING',
             'propagate': True,
         },
+        'instrumentation': {
+            'handlers': ['jobs'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
 }
@@ -0,0 +1,140 @@
+"""Benchmarks and equivalence checks for the processing engines of clams_processing.
+
+The full pipeline is timed with every installed engine on synthetic data, and the files written by each engine are
+compared with those of the default pandas engine. All engines must write identical files, the exit code is 1 if any
+file differs.
+
+Usage:
+    python -m benchmarks.bench_engine --scenario medium --repeat 3
+"""
+import argparse
+import contextlib
+import io
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import clams_processing
+from benchmarks.bench_io import compare_outputs
+from benchmarks.bench_pipeline import BIN_HOURS, KEEP_HOURS, SCENARIOS, START_DARK, TRIM_HOURS, _git_revision, \
+    save_results
+from benchmarks.synthetic import generate_experiment
+
+
+def available_engines():
+    """Return the engines whose dependencies are installed."""
+    engines = []
+    for engine in clams_processing.ENGINES:
+        try:
+            clams_processing.get_engine(engine)
+        except ImportError:
+            continue
+        engines.append(engine)
+    return engines
+
+
+def run_pipeline(directory_path, bin_hours, engine):
+    with contextlib.redirect_stdout(io.StringIO()):
+        clams_processing.run_pipeline(directory_path, TRIM_HOURS, KEEP_HOURS, bin_hours, START_DARK, engine=engine)
+
+
+def run_scenario(name, engines, repeat, bin_hours, work_directory):
+    """Time the full pipeline with every engine for one scenario and check their outputs.
+
+    Returns:
+    dict: scenario parameters and, per engine, the median pipeline wall time and the files that differ
+    """
+    subjects, days, interval = SCENARIOS[name]
+    source = os.path.join(work_directory, f'{name}_source')
+    summary = generate_experiment(source, subjects=subjects, days=days, interval_minutes=interval)
+
+    reference_directory = os.path.join(work_directory, f'{name}_reference')
+    shutil.copytree(source, reference_directory)
+    run_pipeline(reference_directory, bin_hours, 'pandas')
+
+    results = {}
+    for engine in engines:
+        walls = []
+        run_directory = os.path.join(work_directory, f'{name}_{engine}')
+        for _ in range(repeat):
+            shutil.rmtree(run_directory, ignore_errors=True)
+            shutil.copytree(source, run_directory)
+            started = time.perf_counter()
+            run_pipeline(run_directory, bin_hours, engine)
+            walls.append(time.perf_counter() - started)
+
+        results[engine] = {
+            'pipeline_median': statistics.median(walls),
+            'mismatches': compare_outputs(reference_directory, run_directory, identical=True),
+        }
+        shutil.rmtree(run_directory)
+
+    return {
+        'subjects': subjects,
+        'days': days,
+        'interval_minutes': interval,
+        'input_bytes': summary['bytes'],
+        'engines': results,
+    }
+
+
+def print_results(results):
+    for name, scenario in results['scenarios'].items():
+        print(f"\n{name}: {scenario['subjects']} subjects, {scenario['days']} days, "
+              f"{scenario['interval_minutes']} min interval ({scenario['input_bytes'] / 1e6:.1f} MB)")
+        print(f"{'engine':<10}{'pipeline (s)':>14}{'speedup':>10}  check")
+        baseline = scenario['engines'].get('pandas', {}).get('pipeline_median')
+        for engine, stats in scenario['engines'].items():
+            speedup = f"{baseline / stats['pipeline_median']:>9.2f}x" if baseline else f"{'-':>10}"
+            check = 'identical' if not stats['mismatches'] else f"FAILED ({len(stats['mismatches'])} files differ)"
+            print(f"{engine:<10}{stats['pipeline_median']:>14.3f}{speedup}  {check}")
+            for relative_path in stats['mismatches'][:10]:
+                print(f"{'':<12}{relative_path}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark and check the processing engines of clams_processing.")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="scenario to run, may be repeated (default: small)")
+    parser.add_argument('--engine', action='append', choices=clams_processing.ENGINES,
+                        help="engine to run, may be repeated (default: every installed engine)")
+    parser.add_argument('--repeat', type=int, default=3, help="repetitions per measurement (default: 3)")
+    parser.add_argument('--bin-hours', type=int, nargs='+', default=BIN_HOURS,
+                        help=f"bin sizes to process (default: {' '.join(map(str, BIN_HOURS))})")
+    parser.add_argument('--output', help="path of the JSON results file (default: benchmarks/results/)")
+    args = parser.parse_args(argv)
+
+    engines = args.engine or available_engines()
+    for engine in engines:
+        clams_processing.get_engine(engine)
+
+    results = {
+        'benchmark': 'engine',
+        'revision': _git_revision(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'repeat': args.repeat,
+        'bin_hours': args.bin_hours,
+        'scenarios': {},
+    }
+    with tempfile.TemporaryDirectory() as work_directory:
+        for name in args.scenario or ['small']:
+            results['scenarios'][name] = run_scenario(name, engines, args.repeat, args.bin_hours, work_directory)
+
+    print_results(results)
+    print(f"\nResults saved to {save_results(results, args.output)}")
+
+    failed = any(stats['mismatches'] for scenario in results['scenarios'].values()
+                 for stats in scenario['engines'].values())
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
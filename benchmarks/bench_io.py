@@ -0,0 +1,230 @@
+"""Benchmarks and equivalence checks for the CSV backends of clams_io.
+
+For every backend the reading and writing of each kind of pipeline file (raw exports, cleaned, trimmed, binned and
+combined files) is timed on synthetic data, followed by the full pipeline. The outputs of the full pipeline are then
+compared with those of the default pandas backend: pandas and pyarrow must produce identical files, arrow files must
+hold the same values. The exit code is 1 if any backend fails its check.
+
+Usage:
+    python -m benchmarks.bench_io --scenario medium --repeat 3
+    python -m benchmarks.bench_io --backend pandas --backend arrow
+"""
+import argparse
+import contextlib
+import filecmp
+import glob
+import io
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import pandas as pd
+
+import clams_io
+import clams_processing
+from benchmarks.bench_pipeline import BIN_HOURS, KEEP_HOURS, SCENARIOS, START_DARK, TRIM_HOURS, _git_revision, \
+    save_results
+from benchmarks.synthetic import generate_experiment
+
+# Backends that must write byte-identical files to the pandas backend, the others must write the same values
+IDENTICAL_BACKENDS = ('pandas', 'pyarrow')
+
+# kind: (glob pattern relative to the processed experiment directory, lines to skip before the header)
+FILE_KINDS = {
+    'raw': ('*.CSV', 22),
+    'cleaned': ('Cleaned_CLAMS_data/*.csv', 0),
+    'trimmed': ('Trimmed_CLAMS_data/*.csv', 0),
+    'binned': ('*hour_bins_Binned_CLAMS_data/*.csv', 0),
+    'combined': ('*hour_bins_Combined_CLAMS_data/*.csv', 0),
+}
+
+
+def available_backends():
+    """Return the backends whose dependencies are installed."""
+    backends = []
+    for backend in clams_io.BACKENDS:
+        try:
+            clams_io._check_backend(backend)
+        except ImportError:
+            continue
+        backends.append(backend)
+    return backends
+
+
+def run_pipeline(directory_path, bin_hours):
+    with contextlib.redirect_stdout(io.StringIO()):
+        clams_processing.run_pipeline(directory_path, TRIM_HOURS, KEEP_HOURS, bin_hours, START_DARK)
+
+
+def time_io(directory_path, work_directory):
+    """Time reading and writing every kind of file in a processed experiment directory with the current backend.
+
+    Returns:
+    dict: per file kind, the number of files and the read and write wall seconds
+    """
+    output_directory = os.path.join(work_directory, 'io_output')
+    os.makedirs(output_directory, exist_ok=True)
+
+    timings = {}
+    for kind, (pattern, skiprows) in FILE_KINDS.items():
+        file_paths = sorted(glob.glob(os.path.join(directory_path, pattern)))
+        started = time.perf_counter()
+        frames = [clams_io.read_csv(file_path, skiprows=skiprows) for file_path in file_paths]
+        read_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for i, df in enumerate(frames):
+            clams_io.write_csv(df, os.path.join(output_directory, f'{kind}_{i}.csv'))
+        write_seconds = time.perf_counter() - started
+        timings[kind] = {'files': len(file_paths), 'read': read_seconds, 'write': write_seconds}
+
+    shutil.rmtree(output_directory)
+    return timings
+
+
+def compare_outputs(reference_directory, directory_path, identical):
+    """Compare the outputs of two pipeline runs.
+
+    Parameters:
+    reference_directory (string): experiment directory processed with the pandas backend
+    directory_path (string): the same experiment processed with another backend
+    identical (bool): require identical files instead of files holding the same values
+
+    Returns:
+    list of str: relative paths of the files that differ or are missing
+    """
+    mismatches = []
+    for reference_path in sorted(glob.glob(os.path.join(reference_directory, '**', '*.csv'), recursive=True)):
+        relative_path = os.path.relpath(reference_path, reference_directory)
+        path = os.path.join(directory_path, relative_path)
+        if not os.path.exists(path):
+            mismatches.append(relative_path)
+        elif identical:
+            if not filecmp.cmp(reference_path, path, shallow=False):
+                mismatches.append(relative_path)
+        else:
+            try:
+                pd.testing.assert_frame_equal(pd.read_csv(reference_path), pd.read_csv(path), check_dtype=False,
+                                              check_exact=True)
+            except AssertionError:
+                mismatches.append(relative_path)
+    return mismatches
+
+
+def run_scenario(name, backends, repeat, bin_hours, work_directory):
+    """Benchmark the I/O and the full pipeline of every backend for one scenario and check their outputs.
+
+    Returns:
+    dict: scenario parameters and, per backend, I/O and pipeline timings and the result of the check
+    """
+    subjects, days, interval = SCENARIOS[name]
+    source = os.path.join(work_directory, f'{name}_source')
+    summary = generate_experiment(source, subjects=subjects, days=days, interval_minutes=interval)
+
+    # The outputs of the default backend are the reference, and the files whose I/O is timed
+    reference_directory = os.path.join(work_directory, f'{name}_reference')
+    shutil.copytree(source, reference_directory)
+    with clams_io.use_backend('pandas'):
+        run_pipeline(reference_directory, bin_hours)
+
+    results = {}
+    for backend in backends:
+        with clams_io.use_backend(backend):
+            io_samples = [time_io(reference_directory, work_directory) for _ in range(repeat)]
+
+            pipeline_walls = []
+            run_directory = os.path.join(work_directory, f'{name}_{backend}')
+            for _ in range(repeat):
+                shutil.rmtree(run_directory, ignore_errors=True)
+                shutil.copytree(source, run_directory)
+                started = time.perf_counter()
+                run_pipeline(run_directory, bin_hours)
+                pipeline_walls.append(time.perf_counter() - started)
+
+        mismatches = compare_outputs(reference_directory, run_directory, backend in IDENTICAL_BACKENDS)
+        shutil.rmtree(run_directory)
+
+        results[backend] = {
+            'io': {kind: {'files': io_samples[0][kind]['files'],
+                          'read_median': statistics.median(sample[kind]['read'] for sample in io_samples),
+                          'write_median': statistics.median(sample[kind]['write'] for sample in io_samples)}
+                   for kind in FILE_KINDS},
+            'pipeline_median': statistics.median(pipeline_walls),
+            'check': 'identical' if backend in IDENTICAL_BACKENDS else 'same values',
+            'mismatches': mismatches,
+        }
+
+    return {
+        'subjects': subjects,
+        'days': days,
+        'interval_minutes': interval,
+        'input_bytes': summary['bytes'],
+        'backends': results,
+    }
+
+
+def print_results(results):
+    for name, scenario in results['scenarios'].items():
+        print(f"\n{name}: {scenario['subjects']} subjects, {scenario['days']} days, "
+              f"{scenario['interval_minutes']} min interval ({scenario['input_bytes'] / 1e6:.1f} MB)")
+        print(f"{'backend':<10}{'kind':<10}{'files':>7}{'read (s)':>11}{'write (s)':>11}")
+        for backend, stats in scenario['backends'].items():
+            for kind, io_stats in stats['io'].items():
+                print(f"{backend:<10}{kind:<10}{io_stats['files']:>7}{io_stats['read_median']:>11.3f}"
+                      f"{io_stats['write_median']:>11.3f}")
+
+        print(f"\n{'backend':<10}{'pipeline (s)':>14}{'speedup':>10}  check")
+        baseline = scenario['backends'].get('pandas', {}).get('pipeline_median')
+        for backend, stats in scenario['backends'].items():
+            speedup = f"{baseline / stats['pipeline_median']:>9.2f}x" if baseline else f"{'-':>10}"
+            check = stats['check'] if not stats['mismatches'] else f"FAILED ({len(stats['mismatches'])} files differ)"
+            print(f"{backend:<10}{stats['pipeline_median']:>14.3f}{speedup}  {check}")
+            for relative_path in stats['mismatches'][:10]:
+                print(f"{'':<12}{relative_path}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark and check the CSV backends of clams_io.")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="scenario to run, may be repeated (default: small)")
+    parser.add_argument('--backend', action='append', choices=clams_io.BACKENDS,
+                        help="backend to run, may be repeated (default: every installed backend)")
+    parser.add_argument('--repeat', type=int, default=3, help="repetitions per measurement (default: 3)")
+    parser.add_argument('--bin-hours', type=int, nargs='+', default=BIN_HOURS,
+                        help=f"bin sizes to process (default: {' '.join(map(str, BIN_HOURS))})")
+    parser.add_argument('--output', help="path of the JSON results file (default: benchmarks/results/)")
+    args = parser.parse_args(argv)
+
+    backends = args.backend or available_backends()
+    for backend in backends:
+        clams_io._check_backend(backend)
+
+    results = {
+        'benchmark': 'io',
+        'revision': _git_revision(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'bin_hours': args.bin_hours,
+        'scenarios': {},
+    }
+    with tempfile.TemporaryDirectory() as work_directory:
+        for name in args.scenario or ['small']:
+            results['scenarios'][name] = run_scenario(name, backends, args.repeat, args.bin_hours, work_directory)
+
+    print_results(results)
+    print(f"\nResults saved to {save_results(results, args.output)}")
+
+    failed = any(stats['mismatches'] for scenario in results['scenarios'].values()
+                 for stats in scenario['backends'].values())
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,249 @@
+"""Stage-level benchmarks for the clams_processing pipeline.
+
+Every stage is timed on synthetic data generated by benchmarks.synthetic, followed by the full pipeline as run by the
+web worker. With --memory the stages are run once more under tracemalloc for their peak memory; tracing slows them down
+several times, so the timed runs are never traced. Results are written as JSON to benchmarks/results/ so runs can be
+compared.
+
+Usage:
+    python -m benchmarks.bench_pipeline --scenario small --repeat 3
+    python -m benchmarks.bench_pipeline --scenario small --repeat 3 --memory
+    python -m benchmarks.bench_pipeline --compare benchmarks/results/old.json benchmarks/results/new.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import clams_processing
+from benchmarks.synthetic import generate_experiment
+from helpers import zip_directory
+
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# name: (subjects, days, interval_minutes)
+SCENARIOS = {
+    'small': (4, 3, 15),
+    'medium': (16, 5, 5),
+    'large': (64, 7, 2),
+}
+
+TRIM_HOURS = 2
+KEEP_HOURS = 48
+START_DARK = False
+BIN_HOURS = [1, 4, 12]
+
+
+def _stages(directory_path, bin_hours):
+    """Return the pipeline stages in execution order as (name, callable) pairs."""
+    config_file = os.path.join(directory_path, 'config', 'experiment_config.csv')
+    stages = [
+        ('clean', lambda: clams_processing.clean_all_clams_data(directory_path)),
+        ('trim', lambda: clams_processing.trim_all_clams_data(directory_path, TRIM_HOURS, KEEP_HOURS, START_DARK)),
+    ]
+    for bin_hour in bin_hours:
+        combined_directory = os.path.join(directory_path, f'{bin_hour}hour_bins_Combined_CLAMS_data')
+        stages += [
+            (f'bin_{bin_hour}h', lambda b=bin_hour: clams_processing.process_directory(directory_path, b)),
+            (f'recombine_{bin_hour}h',
+             lambda b=bin_hour: clams_processing.recombine_columns(directory_path, config_file, b)),
+            (f'reformat_{bin_hour}h',
+             lambda d=combined_directory: clams_processing.reformat_csvs_in_directory(d)),
+        ]
+    stages.append(('zip', lambda: zip_directory(directory_path, directory_path + '.zip')))
+    return stages
+
+
+def _measure(func):
+    """Run func once with stdout silenced and return (wall seconds, cpu seconds)."""
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    return wall, cpu
+
+
+def _measure_memory(func):
+    """Run func once under tracemalloc with stdout silenced and return its peak traced bytes."""
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def _run(source, run_directory, bin_hours, measure):
+    """Run every stage and then the full pipeline on fresh copies of source.
+
+    Returns:
+    dict: stage name -> result of measure for the stage
+    """
+    measurements = {}
+    # Stages write into the experiment directory, so every run starts from a fresh copy
+    shutil.rmtree(run_directory, ignore_errors=True)
+    shutil.copytree(source, run_directory)
+    for stage_name, func in _stages(run_directory, bin_hours):
+        measurements[stage_name] = measure(func)
+
+    shutil.rmtree(run_directory, ignore_errors=True)
+    shutil.copytree(source, run_directory)
+    stages = _stages(run_directory, bin_hours)
+    measurements['pipeline'] = measure(lambda: [func() for _, func in stages])
+    shutil.rmtree(run_directory, ignore_errors=True)
+    if os.path.exists(run_directory + '.zip'):
+        os.remove(run_directory + '.zip')
+    return measurements
+
+
+def run_scenario(name, repeat, bin_hours, work_directory, memory=False):
+    """Benchmark every stage and the full pipeline for one scenario.
+
+    Parameters:
+    name (string): key into SCENARIOS
+    repeat (int): number of repetitions per measurement
+    bin_hours (list of int): bin sizes to process
+    work_directory (string): scratch directory for generated and processed data
+    memory (bool): also measure the peak memory of every stage, in a separate run under tracemalloc
+
+    Returns:
+    dict: scenario parameters, input size and per-stage statistics
+    """
+    subjects, days, interval = SCENARIOS[name]
+    source = os.path.join(work_directory, f'{name}_source')
+    summary = generate_experiment(source, subjects=subjects, days=days, interval_minutes=interval)
+
+    run_directory = os.path.join(work_directory, f'{name}_run')
+    samples = {}
+    for _ in range(repeat):
+        for stage_name, measurement in _run(source, run_directory, bin_hours, _measure).items():
+            samples.setdefault(stage_name, []).append(measurement)
+    peaks = _run(source, run_directory, bin_hours, _measure_memory) if memory else {}
+
+    results = {}
+    for stage_name, measurements in samples.items():
+        walls = [m[0] for m in measurements]
+        results[stage_name] = {
+            'wall_min': min(walls),
+            'wall_median': statistics.median(walls),
+            'cpu_median': statistics.median(m[1] for m in measurements),
+            # None unless measured with --memory
+            'peak_mem_bytes': peaks.get(stage_name),
+        }
+
+    return {
+        'subjects': subjects,
+        'days': days,
+        'interval_minutes': interval,
+        'input_rows': summary['rows'],
+        'input_bytes': summary['bytes'],
+        'stages': results,
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save_results(results, output_path=None):
+    """Write benchmark results to JSON and return the path."""
+    if output_path is None:
+        os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        output_path = os.path.join(RESULTS_DIRECTORY, f"{timestamp}_{results['revision']}.json")
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    return output_path
+
+
+def print_results(results):
+    for name, scenario in results['scenarios'].items():
+        print(f"\n{name}: {scenario['subjects']} subjects, {scenario['days']} days, "
+              f"{scenario['interval_minutes']} min interval ({scenario['input_bytes'] / 1e6:.1f} MB)")
+        print(f"{'stage':<16}{'wall min (s)':>14}{'wall med (s)':>14}{'cpu med (s)':>14}{'peak mem (MB)':>15}")
+        for stage_name, stats in scenario['stages'].items():
+            peak = '-' if stats['peak_mem_bytes'] is None else f"{stats['peak_mem_bytes'] / 1e6:.1f}"
+            print(f"{stage_name:<16}{stats['wall_min']:>14.3f}{stats['wall_median']:>14.3f}"
+                  f"{stats['cpu_median']:>14.3f}{peak:>15}")
+
+
+def compare_results(old_path, new_path):
+    """Print the per-stage change in median wall time and peak memory between two result files."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    print(f"Comparing {old['revision']} -> {new['revision']}")
+    for name, scenario in new['scenarios'].items():
+        if name not in old['scenarios']:
+            continue
+        print(f"\n{name}")
+        print(f"{'stage':<16}{'old (s)':>10}{'new (s)':>10}{'speedup':>10}{'mem ratio':>11}")
+        old_stages = old['scenarios'][name]['stages']
+        for stage_name, stats in scenario['stages'].items():
+            if stage_name not in old_stages:
+                continue
+            old_wall = old_stages[stage_name]['wall_median']
+            new_wall = stats['wall_median']
+            old_mem = old_stages[stage_name]['peak_mem_bytes']
+            new_mem = stats['peak_mem_bytes']
+            # The memory ratio needs both runs measured with --memory
+            mem_ratio = f"{new_mem / (old_mem or 1):.2f}x" if old_mem is not None and new_mem is not None else '-'
+            print(f"{stage_name:<16}{old_wall:>10.3f}{new_wall:>10.3f}{old_wall / new_wall:>9.2f}x{mem_ratio:>11}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the CLAMS processing pipeline stage by stage.")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="scenario to run, may be repeated (default: small)")
+    parser.add_argument('--repeat', type=int, default=3, help="repetitions per measurement (default: 3)")
+    parser.add_argument('--bin-hours', type=int, nargs='+', default=BIN_HOURS,
+                        help=f"bin sizes to process (default: {' '.join(map(str, BIN_HOURS))})")
+    parser.add_argument('--memory', action='store_true',
+                        help="also measure the peak memory of every stage, in a separate run under tracemalloc")
+    parser.add_argument('--output', help="path of the JSON results file (default: benchmarks/results/)")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two result files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare_results(*args.compare)
+        return
+
+    results = {
+        'revision': _git_revision(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'memory': args.memory,
+        'bin_hours': args.bin_hours,
+        'scenarios': {},
+    }
+    with tempfile.TemporaryDirectory() as work_directory:
+        for name in args.scenario or ['small']:
+            results['scenarios'][name] = run_scenario(name, args.repeat, args.bin_hours, work_directory, args.memory)
+
+    print_results(results)
+    print(f"\nResults saved to {save_results(results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
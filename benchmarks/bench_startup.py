@@ -0,0 +1,217 @@
+"""Startup time and memory of the web, worker and desktop processes.
+
+Every measurement runs in a fresh interpreter:
+
+- web: a Django process setting up the app and importing its URLs and views, as a web server does before serving its
+  first request, and the modules it has loaded.
+- worker: a worker parent process that sends Celery's worker_init signal, as a prefork worker does before starting its
+  pool, then forks children that each process a small synthetic experiment, like the first job of a pool process. The
+  time of that first job and the private (USS) and proportional (PSS) memory of every child are reported, the memory
+  read from /proc/self/smaps_rollup (Linux only).
+- gui: the imports main.py runs before it creates its window, except those of modules that are not installed.
+
+Usage:
+    python -m benchmarks.bench_startup --repeat 5 --children 4
+"""
+import argparse
+import ast
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from datetime import datetime
+
+from benchmarks.bench_pipeline import _git_revision, save_results
+
+PROJECT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules whose import is reported, the ones the web tier should not need
+HEAVY_MODULES = ['numpy', 'pandas', 'pyarrow', 'polars', 'requests', 'boto3', 'clams_processing']
+
+_PRELUDE = '''
+import json, os, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {project!r})
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'CLAMS_web.settings.dev')
+os.environ.setdefault('DEV_SECRET_KEY', 'bench')
+
+def memory():
+    """Return the RSS, PSS and USS of this process in bytes, None where /proc is not available."""
+    values = dict.fromkeys(['rss', 'pss', 'uss'])
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            fields = {{line.split(':')[0]: int(line.split()[1]) * 1024 for line in f if line.split()[-1] == 'kB'}}
+        values.update(rss=fields['Rss'], pss=fields['Pss'],
+                      uss=fields['Private_Clean'] + fields['Private_Dirty'])
+    except (OSError, KeyError):
+        pass
+    return values
+'''
+
+_WEB = _PRELUDE + '''
+import django
+django.setup()
+import CLAMS_web.urls
+seconds = time.perf_counter() - started
+print(json.dumps({{'seconds': seconds, **memory(), 'modules': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+_WORKER = _PRELUDE + '''
+import shutil, tempfile, contextlib, io
+import django
+django.setup()
+from celery import signals
+from CLAMS_web.celery import app
+app.loader.import_default_modules()
+signals.worker_init.send(sender=None)
+parent_seconds = time.perf_counter() - started
+from benchmarks.synthetic import generate_experiment
+
+source = tempfile.mkdtemp()
+generate_experiment(source, subjects=2, days=2, interval_minutes=15)
+children = []
+for i in range({children}):
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        job_started = time.perf_counter()
+        directory = source + f'_{{i}}'
+        shutil.copytree(source, directory)
+        with contextlib.redirect_stdout(io.StringIO()):
+            from clams_processing import run_pipeline
+            run_pipeline(directory, 2, 24, [1], False)
+        result = {{'first_job_seconds': time.perf_counter() - job_started, **memory()}}
+        os.write(write_end, json.dumps(result).encode())
+        os._exit(0)
+    os.close(write_end)
+    children.append((pid, read_end))
+results = []
+for pid, read_end in children:
+    with os.fdopen(read_end) as f:
+        results.append(json.loads(f.read()))
+    os.waitpid(pid, 0)
+print(json.dumps({{'parent_seconds': parent_seconds, 'parent': memory(), 'children': results}}))
+'''
+
+
+def _run(code):
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=PROJECT_DIRECTORY).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def _gui_imports():
+    """Return the top-level import statements of main.py, the ones run before its window is created.
+
+    Returns:
+    tuple: the statements of installed modules and the names of the modules that are not installed
+    """
+    with open(os.path.join(PROJECT_DIRECTORY, 'main.py')) as f:
+        tree = ast.parse(f.read())
+    statements, missing = [], []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            names = [node.module]
+        else:
+            continue
+        top_level = [name.split('.')[0] for name in names]
+        if all(name in sys.builtin_module_names or importlib.util.find_spec(name) or
+               os.path.exists(os.path.join(PROJECT_DIRECTORY, f'{name}.py')) for name in top_level):
+            statements.append(ast.unparse(node))
+        else:
+            missing += [name for name in top_level if name not in missing]
+    return statements, missing
+
+
+def measure_web(repeat):
+    samples = [_run(_WEB.format(project=PROJECT_DIRECTORY, heavy=HEAVY_MODULES)) for _ in range(repeat)]
+    return {
+        'seconds_median': statistics.median(s['seconds'] for s in samples),
+        'rss_bytes': statistics.median(s['rss'] or 0 for s in samples),
+        'uss_bytes': statistics.median(s['uss'] or 0 for s in samples),
+        'modules': samples[-1]['modules'],
+    }
+
+
+def measure_worker(repeat, children):
+    samples = [_run(_WORKER.format(project=PROJECT_DIRECTORY, children=children)) for _ in range(repeat)]
+    child_results = [child for s in samples for child in s['children']]
+    return {
+        'parent_seconds_median': statistics.median(s['parent_seconds'] for s in samples),
+        'parent_rss_bytes': statistics.median(s['parent']['rss'] or 0 for s in samples),
+        'first_job_seconds_median': statistics.median(c['first_job_seconds'] for c in child_results),
+        'child_uss_bytes': statistics.median(c['uss'] or 0 for c in child_results),
+        'child_pss_bytes': statistics.median(c['pss'] or 0 for c in child_results),
+        'child_rss_bytes': statistics.median(c['rss'] or 0 for c in child_results),
+    }
+
+
+def measure_gui(repeat):
+    statements, missing = _gui_imports()
+    code = _PRELUDE.format(project=PROJECT_DIRECTORY) + '\n'.join(statements) + f'''
+print(json.dumps({{'seconds': time.perf_counter() - started, **memory(),
+                  'modules': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+'''
+    samples = [_run(code) for _ in range(repeat)]
+    return {
+        'seconds_median': statistics.median(s['seconds'] for s in samples),
+        'rss_bytes': statistics.median(s['rss'] or 0 for s in samples),
+        'modules': samples[-1]['modules'],
+        'not_installed': missing,
+    }
+
+
+def print_results(results):
+    web, worker, gui = results['web'], results['worker'], results.get('gui')
+    print(f"web process:   {web['seconds_median']:.3f} s to load, RSS {web['rss_bytes'] / 1e6:.1f} MB, "
+          f"USS {web['uss_bytes'] / 1e6:.1f} MB, loads {', '.join(web['modules']) or 'none'}")
+    print(f"worker parent: {worker['parent_seconds_median']:.3f} s to start, "
+          f"RSS {worker['parent_rss_bytes'] / 1e6:.1f} MB")
+    print(f"worker child:  first job {worker['first_job_seconds_median']:.3f} s, USS "
+          f"{worker['child_uss_bytes'] / 1e6:.1f} MB, PSS {worker['child_pss_bytes'] / 1e6:.1f} MB, RSS "
+          f"{worker['child_rss_bytes'] / 1e6:.1f} MB")
+    if gui is not None:
+        print(f"desktop app:   {gui['seconds_median']:.3f} s of imports before the window, RSS "
+              f"{gui['rss_bytes'] / 1e6:.1f} MB, loads {', '.join(gui['modules']) or 'none'}")
+        if gui['not_installed']:
+            print(f"               not installed, so not measured: {', '.join(gui['not_installed'])}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the startup time and memory of the CLAMS processes.")
+    parser.add_argument('--repeat', type=int, default=5, help="fresh interpreters per measurement (default: 5)")
+    parser.add_argument('--children', type=int, default=4, help="worker children forked per repetition (default: 4)")
+    parser.add_argument('--output', help="path of the JSON results file (default: benchmarks/results/)")
+    args = parser.parse_args(argv)
+
+    if not hasattr(os, 'fork'):
+        parser.error("the worker measurement forks like a prefork Celery worker, which requires a POSIX system")
+
+    results = {
+        'revision': _git_revision(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'children': args.children,
+        'web': measure_web(args.repeat),
+        'worker': measure_worker(args.repeat, args.children),
+    }
+    try:
+        results['gui'] = measure_gui(args.repeat)
+    except subprocess.CalledProcessError as e:
+        # e.g. Tk is installed without its shared libraries
+        print(f"Skipping the desktop app: {e.stderr.strip().splitlines()[-1]}")
+
+    print_results(results)
+    print(f"\nResults saved to {save_results(results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
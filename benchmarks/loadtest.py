@@ -0,0 +1,523 @@
+"""End-to-end load test of the web app with synthetic CLAMS uploads.
+
+Every simulated user runs the flow of the browser against the real endpoints: it uploads the raw exports and the
+experiment configuration of a synthetic experiment (upload_csv_files), submits a job (process_view), polls task_status
+until the job has finished, checks for the results (check_zip_exists), downloads the archive (download_zip_file) and
+clears its session. Latency percentiles and errors are reported per endpoint, together with the job throughput, the
+end-to-end job time and the time jobs waited in the queue.
+
+By default the Django app runs in this process, driven by the Django test client, with a local storage, cache and
+metrics directory in a scratch directory and one of these stand-ins for Redis and the workers:
+
+- ``memory`` (default): an embedded Celery worker consuming both job queues of an in-memory broker. ``--broker
+  redis://localhost:6379/0`` uses a local Redis instead.
+- ``eager``: jobs run inside process_view, so there is no queue and the submission takes as long as the job.
+
+With ``--url`` a running deployment (web servers, Redis and workers) is driven over HTTP instead. The queue wait is then
+estimated as the time to completion minus the processing time reported by the job, so it includes up to one poll
+interval.
+
+Results are written as JSON to benchmarks/results/ so runs before and after a scaling change can be compared.
+
+Usage:
+    python -m benchmarks.loadtest --users 50 --iterations 2
+    python -m benchmarks.loadtest --users 20 --celery eager --scenario medium
+    python -m benchmarks.loadtest --users 50 --url http://localhost:8000
+    python -m benchmarks.loadtest --compare benchmarks/results/old.json benchmarks/results/new.json
+"""
+import argparse
+import contextlib
+import glob
+import json
+import logging
+import os
+import platform
+import random
+import re
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from benchmarks.bench_pipeline import _git_revision, save_results
+from benchmarks.synthetic import generate_experiment
+
+# name: (subjects, days, interval_minutes) of the synthetic experiment every user uploads
+SCENARIOS = {
+    'small': (4, 3, 15),
+    'medium': (8, 5, 5),
+    'large': (16, 7, 2),
+}
+
+TRIM_HOURS = 2
+KEEP_HOURS = 48
+BIN_HOURS = ['1', '4']
+START_CYCLE = 'Start Light'
+
+# Endpoints in the order of the flow of a user
+ENDPOINTS = ['process_page', 'upload_csv_files', 'process_view', 'task_status', 'check_zip_exists',
+             'download_zip_file', 'clear_session']
+
+PERCENTILES = [50, 90, 95, 99]
+
+
+class Recorder:
+    """Thread-safe collection of the requests, flows and tasks measured for all users."""
+
+    def __init__(self):
+        self.requests = []
+        self.flows = []
+        self.tasks = {}
+        self._lock = threading.Lock()
+
+    def request(self, endpoint, seconds, status, ok):
+        with self._lock:
+            self.requests.append({'endpoint': endpoint, 'seconds': seconds, 'status': status, 'ok': ok})
+
+    def flow(self, record):
+        with self._lock:
+            self.flows.append(record)
+
+    def task(self, task_id, **fields):
+        """Record the queue wait and processing time of a task run in this process."""
+        with self._lock:
+            self.tasks.setdefault(task_id, {}).update(fields)
+
+
+class DjangoClient:
+    """A user of the app running in this process, see setup_in_process."""
+
+    def __init__(self):
+        from django.test import Client
+
+        self.client = Client()
+
+    def request(self, method, path, data=None):
+        """Send a request and return its status, headers and body as bytes."""
+        if method == 'POST':
+            response = self.client.post(path, data or {})
+        else:
+            response = self.client.get(path)
+        if response.streaming:
+            body = b''.join(response.streaming_content)
+        else:
+            body = response.content
+        response.close()
+        return response.status_code, response.headers, body
+
+
+class HttpClient:
+    """A user of a running deployment with its own session and CSRF cookies."""
+
+    def __init__(self, base_url):
+        import requests
+
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+
+    def request(self, method, path, data=None):
+        """Send a request and return its status, headers and body as bytes."""
+        # The CSRF token is set as a cookie by the process page, Django also checks the Referer of HTTPS requests
+        headers = {'Referer': self.base_url + '/'}
+        token = self.session.cookies.get('csrftoken')
+        if token:
+            headers['X-CSRFToken'] = token
+        fields, files = {}, []
+        for name, value in (data or {}).items():
+            if hasattr(value, 'read') or (isinstance(value, list) and value and hasattr(value[0], 'read')):
+                uploads = value if isinstance(value, list) else [value]
+                files += [(name, (os.path.basename(f.name), f)) for f in uploads]
+            else:
+                fields[name] = value
+        response = self.session.request(method, self.base_url + path, data=fields, files=files or None,
+                                        headers=headers, allow_redirects=False)
+        return response.status_code, response.headers, response.content
+
+
+def _timed(recorder, endpoint, client, method, path, data=None, expected=(200,)):
+    """Send a request, record its latency and return its status, headers and body."""
+    started = time.perf_counter()
+    try:
+        status, headers, body = client.request(method, path, data)
+    except Exception:
+        recorder.request(endpoint, time.perf_counter() - started, None, False)
+        raise
+    recorder.request(endpoint, time.perf_counter() - started, status, status in expected)
+    return status, headers, body
+
+
+def run_user_flow(client, dataset, recorder, poll_interval, job_timeout):
+    """Upload, process, poll, download and clear one synthetic experiment as one user.
+
+    Parameters:
+    client (DjangoClient or HttpClient): the user, whose session holds the upload
+    dataset (string): directory of a synthetic experiment, see benchmarks.synthetic
+    recorder (Recorder): collects the measurements
+    poll_interval (float): seconds between task_status requests
+    job_timeout (float): seconds to wait for the job before giving up on it
+
+    Returns:
+    Nothing. The requests and the flow are recorded, failed flows with an "error".
+    """
+    job = {'submitted': None, 'status': None, 'error': None}
+    try:
+        _timed(recorder, 'process_page', client, 'GET', '/process/')
+
+        exports = sorted(glob.glob(os.path.join(dataset, '*.CSV')))
+        with contextlib.ExitStack() as stack:
+            files = [stack.enter_context(open(path, 'rb')) for path in exports]
+            config_file = stack.enter_context(open(os.path.join(dataset, 'config', 'experiment_config.csv'), 'rb'))
+            status, _, body = _timed(recorder, 'upload_csv_files', client, 'POST', '/upload/',
+                                     {'file': files, 'config_file': config_file})
+        if status != 200:
+            raise RuntimeError(f"Upload failed with status {status}")
+        upload_id = json.loads(body)['upload_id']
+
+        parameters = {'trim_hours': TRIM_HOURS, 'keep_hours': KEEP_HOURS, 'bin_hours': BIN_HOURS,
+                      'start_cycle': START_CYCLE}
+        job['submitted'] = time.perf_counter()
+        status, headers, body = _timed(recorder, 'process_view', client, 'POST', '/process/', parameters,
+                                       expected=(302,))
+        if status == 503:
+            job['status'] = 'rejected'
+            return
+        match = re.search(r'/processing/([^/]+)/', headers.get('Location', '')) if status == 302 else None
+        if match is None:
+            raise RuntimeError(f"Submission failed with status {status}: {body[:200]!r}")
+        job['task_id'] = task_id = match.group(1)
+
+        while True:
+            status, _, body = _timed(recorder, 'task_status', client, 'GET', f'/task-status/{task_id}/')
+            result = json.loads(body) if status == 200 else {}
+            if result.get('status') in ('SUCCESS', 'FAILURE'):
+                break
+            if time.perf_counter() - job['submitted'] > job_timeout:
+                raise TimeoutError(f"Job {task_id} did not finish within {job_timeout:g} seconds")
+            time.sleep(poll_interval)
+        job['finished'] = time.perf_counter()
+        job['processing_seconds'] = (result.get('metrics') or {}).get('total_wall_seconds')
+        if result['status'] == 'FAILURE' or 'error' in result:
+            raise RuntimeError(f"Job {task_id} failed: {result.get('error')}")
+
+        status, _, body = _timed(recorder, 'check_zip_exists', client, 'GET', f'/check-zip/{upload_id}/')
+        if status != 200 or not json.loads(body)['exists']:
+            raise RuntimeError(f"No results archive for upload {upload_id}")
+        status, _, body = _timed(recorder, 'download_zip_file', client, 'GET', f'/download-file/{upload_id}/')
+        if status != 200:
+            raise RuntimeError(f"Download failed with status {status}")
+        job['download_bytes'] = len(body)
+        job['status'] = 'success'
+
+        _timed(recorder, 'clear_session', client, 'POST', '/clear-session/')
+    except Exception as e:
+        job['status'] = job['status'] or 'failure'
+        job['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        recorder.flow(job)
+
+
+@contextlib.contextmanager
+def setup_in_process(work_directory, celery_mode, broker=None, concurrency=1, recorder=None):
+    """Configure the Django app and the Celery stand-in to run in this process.
+
+    Parameters:
+    work_directory (string): scratch directory for the storage and the metrics
+    celery_mode (string): "memory" for an embedded worker, "eager" to run jobs inside the requests
+    broker (string): broker and result backend URL of the embedded worker, the in-memory broker by default
+    concurrency (int): jobs the embedded worker runs at the same time, on threads when more than 1
+    recorder (Recorder): records the queue wait and processing time of every job run in this process
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'CLAMS_web.settings.dev')
+    os.environ.setdefault('DEV_SECRET_KEY', 'loadtest')
+    import django
+
+    django.setup()
+    from celery.signals import task_postrun, task_prerun
+    from django.conf import settings
+    from django.test.utils import override_settings
+
+    from django.db import connection
+
+    from CLAMS_web.celery import app
+    from wrangler.storage import get_storage
+
+    overrides = override_settings(
+        DEBUG=False,
+        ALLOWED_HOSTS=['*'],
+        CLAMS_STORAGE_URL=os.path.join(work_directory, 'storage'),
+        CLAMS_METRICS_DIR=os.path.join(work_directory, 'metrics'),
+        # Sessions and the active jobs of the admission control without a database or Redis
+        SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies',
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        # Pages link the static files without the manifest written by collectstatic
+        STORAGES={**settings.STORAGES,
+                  'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}},
+    )
+    overrides.enable()
+    get_storage.cache_clear()
+    # The jobs load their results into a scratch database instead of db.sqlite3
+    database_name = connection.settings_dict['NAME']
+    connection.settings_dict['TEST']['NAME'] = os.path.join(work_directory, 'db.sqlite3')
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    # The stage and file records of every job are returned in its result instead of being logged, also once the
+    # worker has set up its logging
+    instrumentation_logger = logging.getLogger('instrumentation')
+    log_level = instrumentation_logger.level
+
+    # Tasks are timed by their signals, their own stage records are mixed up when several run on threads
+    def record_start(task=None, **kwargs):
+        enqueued_at = getattr(task.request, 'clams_enqueued_at', None)
+        if task.request.is_eager:
+            recorder.task(task.request.id, queue_wait=0, started=time.perf_counter())
+        elif enqueued_at is not None:
+            recorder.task(task.request.id, queue_wait=max(time.time() - enqueued_at, 0), started=time.perf_counter())
+
+    def record_end(task=None, **kwargs):
+        started = recorder.tasks.get(task.request.id, {}).get('started')
+        if started is not None:
+            recorder.task(task.request.id, processing=time.perf_counter() - started)
+
+    def configure(**options):
+        # The app reads its configuration from the CELERY_ settings, see CLAMS_web/celery.py
+        app.conf.update({f'CELERY_{key.upper()}': value for key, value in options.items()})
+
+    previous = {key: app.conf[key] for key in ('broker_url', 'result_backend', 'task_always_eager',
+                                               'task_store_eager_result', 'worker_redirect_stdouts')}
+    if recorder is not None:
+        task_prerun.connect(record_start, weak=False)
+        task_postrun.connect(record_end, weak=False)
+    try:
+        if celery_mode == 'eager':
+            configure(broker_url='memory://', result_backend='cache+memory://', task_always_eager=True,
+                      task_store_eager_result=True)
+            instrumentation_logger.setLevel(logging.WARNING)
+            yield
+        else:
+            from celery.contrib.testing.worker import start_worker
+            from wrangler.metrics import queue_names
+
+            configure(broker_url=broker or 'memory://', result_backend=broker or 'cache+memory://',
+                      task_always_eager=False, worker_redirect_stdouts=False)
+            with start_worker(app, concurrency=concurrency, pool='solo' if concurrency <= 1 else 'threads',
+                              perform_ping_check=False, queues=queue_names(), shutdown_timeout=60):
+                instrumentation_logger.setLevel(logging.WARNING)
+                yield
+    finally:
+        task_prerun.disconnect(record_start)
+        task_postrun.disconnect(record_end)
+        configure(**previous)
+        instrumentation_logger.setLevel(log_level)
+        connection.creation.destroy_test_db(database_name, verbosity=0)
+        overrides.disable()
+        get_storage.cache_clear()
+
+
+def _latency_stats(seconds):
+    """Return the count and the percentiles and maximum of a list of durations in milliseconds."""
+    if not seconds:
+        return {'count': 0}
+    milliseconds = np.array(seconds) * 1000
+    stats = {'count': len(seconds)}
+    stats.update({f'p{p}_ms': round(float(np.percentile(milliseconds, p)), 1) for p in PERCENTILES})
+    stats['max_ms'] = round(float(milliseconds.max()), 1)
+    return stats
+
+
+def summarize(recorder, wall_seconds):
+    """Summarize the recorded requests and jobs of a load test.
+
+    Parameters:
+    recorder (Recorder): the measurements of all users
+    wall_seconds (float): duration of the load test
+
+    Returns:
+    dict: per-endpoint latencies and error rates, and the throughput, durations and outcomes of the jobs
+    """
+    endpoints = {}
+    for endpoint in ENDPOINTS:
+        requests = [r for r in recorder.requests if r['endpoint'] == endpoint]
+        if not requests:
+            continue
+        stats = _latency_stats([r['seconds'] for r in requests])
+        errors = sum(not r['ok'] for r in requests)
+        stats.update(errors=errors, error_rate=round(errors / len(requests), 4),
+                     requests_per_second=round(len(requests) / wall_seconds, 2))
+        endpoints[endpoint] = stats
+
+    flows = recorder.flows
+    jobs = [job for job in flows if job['submitted'] is not None]
+    finished = [job for job in jobs if 'finished' in job]
+    succeeded = [job for job in jobs if job['status'] == 'success']
+    # Tasks timed in this process are measured exactly, the queue wait of others is estimated from their result
+    queue_waits, processing = [], []
+    for job in finished:
+        task = recorder.tasks.get(job.get('task_id'), {})
+        if 'processing' in task:
+            queue_waits.append(task['queue_wait'])
+            processing.append(task['processing'])
+        elif job.get('processing_seconds') is not None:
+            queue_waits.append(max(job['finished'] - job['submitted'] - job['processing_seconds'], 0))
+            processing.append(job['processing_seconds'])
+
+    errors = {}
+    for job in flows:
+        if job['error']:
+            errors[job['error']] = errors.get(job['error'], 0) + 1
+    return {
+        'wall_seconds': round(wall_seconds, 3),
+        'requests': len(recorder.requests),
+        'requests_per_second': round(len(recorder.requests) / wall_seconds, 2),
+        'request_error_rate': round(sum(not r['ok'] for r in recorder.requests) / max(len(recorder.requests), 1), 4),
+        'endpoints': endpoints,
+        'jobs': {
+            'submitted': len(jobs),
+            'succeeded': len(succeeded),
+            'rejected': sum(job['status'] == 'rejected' for job in jobs),
+            'failed': sum(job['status'] == 'failure' for job in jobs),
+            'flows_failed_before_submission': len(flows) - len(jobs),
+            'jobs_per_minute': round(len(succeeded) / wall_seconds * 60, 2),
+            'end_to_end': _latency_stats([job['finished'] - job['submitted'] for job in finished]),
+            'processing': _latency_stats(processing),
+            'queue_wait': _latency_stats(queue_waits),
+            'queue_wait_exact': bool(recorder.tasks),
+            'download_bytes': sum(job.get('download_bytes', 0) for job in jobs),
+            'errors': errors,
+        },
+    }
+
+
+def run_load_test(client_factory, datasets, users, iterations, ramp_up, poll_interval, job_timeout, recorder):
+    """Run the flow of every user `iterations` times on its own thread and return the wall time in seconds.
+
+    User i uploads datasets[i % len(datasets)] and starts after i * ramp_up / users seconds.
+    """
+    def user(index):
+        time.sleep(index * ramp_up / users)
+        for _ in range(iterations):
+            # Every iteration is a new browser session, so it gets its own upload
+            run_user_flow(client_factory(), datasets[index % len(datasets)], recorder, poll_interval, job_timeout)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=user, args=(i,), name=f'loadtest-user-{i}') for i in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def print_summary(summary):
+    print(f"\n{summary['requests']} requests in {summary['wall_seconds']:.1f} s "
+          f"({summary['requests_per_second']:.1f}/s, {summary['request_error_rate']:.1%} errors)")
+    print(f"{'endpoint':<20}{'count':>7}{'errors':>8}{'p50 (ms)':>10}{'p90 (ms)':>10}{'p95 (ms)':>10}"
+          f"{'p99 (ms)':>10}{'max (ms)':>10}")
+    for endpoint, stats in summary['endpoints'].items():
+        print(f"{endpoint:<20}{stats['count']:>7}{stats['errors']:>8}{stats['p50_ms']:>10.1f}{stats['p90_ms']:>10.1f}"
+              f"{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+
+    jobs = summary['jobs']
+    print(f"\njobs: {jobs['submitted']} submitted, {jobs['succeeded']} succeeded, {jobs['rejected']} rejected as busy, "
+          f"{jobs['failed']} failed ({jobs['jobs_per_minute']:.1f} jobs/min)")
+    wait = 'queue wait' if jobs['queue_wait_exact'] else 'queue wait (est.)'
+    for name, stats in ((('end to end', jobs['end_to_end']), ('processing', jobs['processing']),
+                         (wait, jobs['queue_wait']))):
+        if stats['count']:
+            print(f"{name:<20}{stats['count']:>7}{'':>8}{stats['p50_ms'] / 1000:>9.2f}s{stats['p90_ms'] / 1000:>9.2f}s"
+                  f"{stats['p95_ms'] / 1000:>9.2f}s{stats['p99_ms'] / 1000:>9.2f}s{stats['max_ms'] / 1000:>9.2f}s")
+    for error, count in jobs['errors'].items():
+        print(f"  {count} x {error}")
+
+
+def compare_results(old_path, new_path):
+    """Print the change in p95 latency, error rate and job throughput between two result files."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    print(f"Comparing {old['revision']} -> {new['revision']}")
+    print(f"{'endpoint':<20}{'old p95 (ms)':>14}{'new p95 (ms)':>14}{'old errors':>12}{'new errors':>12}")
+    for endpoint, stats in new['summary']['endpoints'].items():
+        old_stats = old['summary']['endpoints'].get(endpoint)
+        if old_stats is None:
+            continue
+        print(f"{endpoint:<20}{old_stats['p95_ms']:>14.1f}{stats['p95_ms']:>14.1f}{old_stats['error_rate']:>12.2%}"
+              f"{stats['error_rate']:>12.2%}")
+    old_jobs, new_jobs = old['summary']['jobs'], new['summary']['jobs']
+    print(f"jobs/min: {old_jobs['jobs_per_minute']:.1f} -> {new_jobs['jobs_per_minute']:.1f}")
+    for name in ('end_to_end', 'queue_wait'):
+        if old_jobs[name]['count'] and new_jobs[name]['count']:
+            print(f"{name} p95: {old_jobs[name]['p95_ms'] / 1000:.2f}s -> {new_jobs[name]['p95_ms'] / 1000:.2f}s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the CLAMS web app with concurrent synthetic uploads.")
+    parser.add_argument('--users', type=int, default=10, help="concurrent users (default: 10)")
+    parser.add_argument('--iterations', type=int, default=1, help="uploads processed by every user (default: 1)")
+    parser.add_argument('--ramp-up', type=float, default=5, help="seconds over which the users start (default: 5)")
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='small',
+                        help="size of the synthetic experiment of every upload (default: small)")
+    parser.add_argument('--datasets', type=int, default=4,
+                        help="distinct synthetic experiments, shared round-robin by the users (default: 4)")
+    parser.add_argument('--poll-interval', type=float, default=1, help="seconds between status polls (default: 1)")
+    parser.add_argument('--job-timeout', type=float, default=600, help="seconds to wait for a job (default: 600)")
+    parser.add_argument('--url', help="base URL of a running deployment, instead of running the app in this process")
+    parser.add_argument('--celery', choices=['memory', 'eager'], default='memory',
+                        help="Celery stand-in of the in-process app (default: memory)")
+    parser.add_argument('--broker', help="broker URL of the embedded worker, e.g. a local Redis (default: in memory)")
+    parser.add_argument('--worker-concurrency', type=int, default=1,
+                        help="jobs the embedded worker runs at the same time (default: 1)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed of the synthetic data (default: 0)")
+    parser.add_argument('--output', help="path of the JSON results file (default: benchmarks/results/)")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two result files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare_results(*args.compare)
+        return
+
+    results = {
+        'revision': _git_revision(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'target': args.url or f'in-process ({args.celery})',
+        'users': args.users,
+        'iterations': args.iterations,
+        'ramp_up': args.ramp_up,
+        'scenario': args.scenario,
+        'datasets': args.datasets,
+        'poll_interval': args.poll_interval,
+        'worker_concurrency': None if args.url or args.celery == 'eager' else args.worker_concurrency,
+    }
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as work_directory:
+        subjects, days, interval = SCENARIOS[args.scenario]
+        datasets = []
+        for i in range(max(args.datasets, 1)):
+            dataset = os.path.join(work_directory, 'datasets', str(i))
+            generate_experiment(dataset, subjects=subjects, days=days, interval_minutes=interval,
+                                seed=rng.randrange(2 ** 32))
+            datasets.append(dataset)
+
+        if args.url:
+            context = contextlib.nullcontext()
+            client_factory = lambda: HttpClient(args.url)  # noqa: E731
+        else:
+            context = setup_in_process(work_directory, args.celery, args.broker, args.worker_concurrency, recorder)
+            client_factory = DjangoClient
+        # The progress printed by the pipeline of in-process jobs is discarded
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), context:
+            wall_seconds = run_load_test(client_factory, datasets, args.users, args.iterations, args.ramp_up,
+                                         args.poll_interval, args.job_timeout, recorder)
+
+    results['summary'] = summarize(recorder, wall_seconds)
+    print_summary(results['summary'])
+    print(f"\nResults saved to {save_results(results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
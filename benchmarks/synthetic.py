@@ -0,0 +1,231 @@
+"""Synthetic Oxymax-CLAMS data generator.
+
+Produces raw "Export subject CSVs" files with the same layout as the real exports (22-line metadata header, a column
+header row and two formatting rows) so the processing pipeline can be exercised at any scale without real data. With
+--channels-per-file several subjects are written to one multi-channel export, their rows interleaved by CHAN.
+
+Usage:
+    python -m benchmarks.synthetic <output_directory> --subjects 16 --days 4 --interval 15
+    python -m benchmarks.synthetic <output_directory> --subjects 16 --channels-per-file 8
+"""
+import argparse
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Number of metadata lines preceding the column header row in a raw export
+HEADER_LINES = 22
+
+COLUMNS = ["INTERVAL", "CHAN", "DATE/TIME", "VO2", "O2IN", "O2OUT", "DO2", "ACCO2", "VCO2", "CO2IN", "CO2OUT", "DCO2",
+           "ACCCO2", "RER", "HEAT", "FLOW", "STATUS1", "PRESSURE", "FEED1", "FEED1 ACC", "XTOT", "XAMB", "YTOT",
+           "YAMB", "WHEEL", "WHEEL ACC", "ENCLOSURE TEMP", "ENCLOSURE SETPOINT", "LED LIGHTNESS", "LED HUE",
+           "LED SATURATION"]
+
+UNITS = ["", "", "", "ml/kg/hr", "%", "%", "%", "liters", "ml/kg/hr", "%", "%", "%", "liters", "", "kcal/hr", "lpm",
+         "", "mm Hg", "g", "g", "counts", "counts", "counts", "counts", "counts", "counts", "deg C", "deg C", "%", "",
+         ""]
+
+DATE_FORMAT = "%m/%d/%Y %I:%M:%S %p"
+
+
+def _metadata_values(values):
+    return ",".join(str(value) for value in values) if isinstance(values, list) else str(values)
+
+
+def build_header(subject_id, chan, start_time, interval_minutes):
+    """Build the 22 metadata lines that precede the data in a raw export.
+
+    Parameters:
+    subject_id (int or list of int): subject ID written to the "Subject ID" line, one per channel of a multi-channel
+        export
+    chan (int or list of int): channel (cage) number of the subject, or of every subject of a multi-channel export
+    start_time (datetime): time of the first sample
+    interval_minutes (float): sampling interval in minutes
+
+    Returns:
+    list of str: header lines without trailing newlines
+    """
+    masses = ["25.00"] * len(chan) if isinstance(chan, list) else "25.00"
+    header = [
+        "Oxymax CSV File",
+        "Experiment File,C:\\Oxymax\\Experiments\\synthetic.cdta",
+        "Experiment Name,Synthetic benchmark",
+        f"Subject ID,{_metadata_values(subject_id)}",
+        f"Subject Mass,{_metadata_values(masses)}",
+        f"Cage,{_metadata_values(chan)}",
+        f"Channel,{_metadata_values(chan)}",
+        f"Start Time,{start_time.strftime(DATE_FORMAT)}",
+        f"Sample Interval,{interval_minutes:g} min",
+        "Reference Interval,4",
+        "Settle Time,90",
+        "Measure Time,60",
+        "Flow Rate,0.50 lpm",
+        "O2 Calibration,20.90",
+        "CO2 Calibration,0.50",
+        "Light On,06:00",
+        "Light Off,18:00",
+        "Feeder,Balance",
+        "Wheel,Installed",
+        "Software Version,CLAX 2.2.15",
+        f"Export Type,{'Experiment' if isinstance(chan, list) else 'Subject'}",
+        ":DATA",
+    ]
+    assert len(header) == HEADER_LINES
+    return header
+
+
+def generate_subject_data(chan, start_time, days, interval_minutes, rng):
+    """Generate the data rows for one subject.
+
+    Parameters:
+    chan (int): channel (cage) number of the subject
+    start_time (datetime): time of the first sample
+    days (float): number of days of recording
+    interval_minutes (float): sampling interval in minutes
+    rng (numpy.random.Generator): random number generator
+
+    Returns:
+    list of list: rows of formatted values in the order of COLUMNS
+    """
+    n = int(days * 24 * 60 / interval_minutes)
+    offsets = np.arange(n) * interval_minutes
+    # Cages are sampled in sequence, so each channel lags the previous one by a few seconds
+    times = [start_time + timedelta(minutes=float(m), seconds=chan * 7) for m in offsets]
+    hours = np.array([t.hour + t.minute / 60 for t in times])
+    light = (hours >= 6) & (hours < 18)
+    dark = ~light
+
+    # Mice are more active and have a higher metabolic rate during the dark phase
+    vo2 = rng.normal(3000, 150, n) + dark * 600
+    rer = np.clip(rng.normal(0.85, 0.04, n) + dark * 0.08, 0.7, 1.1)
+    vco2 = vo2 * rer
+    interval_hours = interval_minutes / 60
+    acco2 = np.cumsum(vo2 * 0.025 * interval_hours / 1000)
+    accco2 = np.cumsum(vco2 * 0.025 * interval_hours / 1000)
+    heat = (3.815 + 1.232 * rer) * vo2 * 0.025 / 1000
+    flow = rng.normal(0.5, 0.005, n)
+    pressure = rng.normal(760, 1, n)
+    o2in = rng.normal(20.92, 0.01, n)
+    o2out = o2in - rng.normal(0.25, 0.02, n)
+    co2in = rng.normal(0.05, 0.005, n)
+    co2out = co2in + rng.normal(0.2, 0.02, n)
+    feed = np.where(rng.random(n) < 0.15 + dark * 0.3, rng.exponential(0.05, n), 0.0)
+    feed_acc = np.cumsum(feed)
+    xamb = rng.poisson(20 + dark * 60, n)
+    yamb = rng.poisson(15 + dark * 45, n)
+    xtot = xamb + rng.poisson(5, n)
+    ytot = yamb + rng.poisson(5, n)
+    wheel = rng.poisson(dark * 400 + light * 10, n)
+    wheel_acc = np.cumsum(wheel)
+    temp = rng.normal(22.5, 0.2, n)
+    led = np.where(light, 100, 0)
+
+    rows = []
+    for i in range(n):
+        rows.append([
+            i + 1, chan, times[i].strftime(DATE_FORMAT), f"{vo2[i]:.1f}", f"{o2in[i]:.3f}", f"{o2out[i]:.3f}",
+            f"{o2in[i] - o2out[i]:.3f}", f"{acco2[i]:.3f}", f"{vco2[i]:.1f}", f"{co2in[i]:.3f}", f"{co2out[i]:.3f}",
+            f"{co2out[i] - co2in[i]:.3f}", f"{accco2[i]:.3f}", f"{rer[i]:.3f}", f"{heat[i]:.4f}", f"{flow[i]:.3f}",
+            0, f"{pressure[i]:.1f}", f"{feed[i]:.3f}", f"{feed_acc[i]:.3f}", xtot[i], xamb[i], ytot[i], yamb[i],
+            wheel[i], wheel_acc[i], f"{temp[i]:.2f}", "22.50", led[i], 0, 0,
+        ])
+    return rows
+
+
+def write_subject_file(file_path, subject_id, chan, start_time, days, interval_minutes, rng):
+    """Write one raw subject export to file_path.
+
+    Parameters:
+    subject_id (int or list of int): subject ID, or the subject IDs of a multi-channel export
+    chan (int or list of int): channel number of the subject, or of every subject of a multi-channel export
+
+    Returns:
+    int: number of data rows written
+    """
+    if isinstance(chan, list):
+        # Cages are sampled in turn, so the rows of the channels are interleaved
+        channel_rows = [generate_subject_data(c, start_time, days, interval_minutes, rng) for c in chan]
+        rows = [row for sample in zip(*channel_rows) for row in sample]
+    else:
+        rows = generate_subject_data(chan, start_time, days, interval_minutes, rng)
+    with open(file_path, 'w', newline='') as f:
+        for line in build_header(subject_id, chan, start_time, interval_minutes):
+            f.write(line + "\n")
+        f.write(",".join(COLUMNS) + "\n")
+        f.write(",".join(UNITS) + "\n")
+        f.write(",".join("=" * len(col) if col else "=" for col in COLUMNS) + "\n")
+        for row in rows:
+            f.write(",".join(str(value) for value in row) + "\n")
+    return len(rows)
+
+
+def generate_experiment(directory_path, subjects=8, days=3, interval_minutes=15, groups=2, seed=0,
+                        start_time=None, channels_per_file=1):
+    """Generate a synthetic experiment directory with raw exports and an experiment configuration file.
+
+    Parameters:
+    directory_path (string): directory to write the raw .csv files into (created if missing)
+    subjects (int): number of subjects (one raw file per subject)
+    days (float): number of recording days per subject
+    interval_minutes (float): sampling interval in minutes
+    groups (int): number of group labels assigned round-robin to the subjects
+    seed (int): seed for the random number generator
+    start_time (datetime): time of the first sample, defaults to 10:00 on 2024-01-01
+    channels_per_file (int): number of subjects written to each export, more than 1 writes multi-channel exports
+
+    Returns:
+    dict: summary with the number of files, rows and bytes written
+    """
+    os.makedirs(directory_path, exist_ok=True)
+    config_directory = os.path.join(directory_path, 'config')
+    os.makedirs(config_directory, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    start_time = start_time or datetime(2024, 1, 1, 10, 0, 0)
+
+    if not 1 <= channels_per_file <= 16:
+        raise ValueError("channels_per_file must be between 1 and 16")
+
+    total_rows = 0
+    total_bytes = 0
+    config_lines = ["ID,GROUP_LABEL"]
+    files = 0
+    for first in range(0, subjects, channels_per_file):
+        indices = range(first, min(first + channels_per_file, subjects))
+        subject_ids = [1001 + i for i in indices]
+        chans = [i % 16 + 1 for i in indices]
+        if channels_per_file == 1:
+            subject_ids, chans = subject_ids[0], chans[0]
+        files += 1
+        file_path = os.path.join(directory_path, f"synthetic_{files:04d}.CSV")
+        total_rows += write_subject_file(file_path, subject_ids, chans, start_time, days, interval_minutes, rng)
+        total_bytes += os.path.getsize(file_path)
+        config_lines += [f"{1001 + i},Group{i % groups + 1}" for i in indices]
+
+    with open(os.path.join(config_directory, 'experiment_config.csv'), 'w') as f:
+        f.write("\n".join(config_lines) + "\n")
+
+    return {'files': files, 'rows': total_rows, 'bytes': total_bytes}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic Oxymax-CLAMS raw exports.")
+    parser.add_argument('directory', help="output directory for the raw .csv files")
+    parser.add_argument('--subjects', type=int, default=8, help="number of subjects (default: 8)")
+    parser.add_argument('--days', type=float, default=3, help="recording days per subject (default: 3)")
+    parser.add_argument('--interval', type=float, default=15, help="sampling interval in minutes (default: 15)")
+    parser.add_argument('--groups', type=int, default=2, help="number of group labels (default: 2)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument('--channels-per-file', type=int, default=1,
+                        help="subjects per export, more than 1 writes multi-channel exports (default: 1)")
+    args = parser.parse_args(argv)
+
+    summary = generate_experiment(args.directory, args.subjects, args.days, args.interval, args.groups, args.seed,
+                                  channels_per_file=args.channels_per_file)
+    print(f"Wrote {summary['files']} files ({summary['rows']} rows, {summary['bytes'] / 1e6:.1f} MB) "
+          f"to {args.directory}")
+
+
+if __name__ == '__main__':
+    main()
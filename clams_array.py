@@ -0,0 +1,317 @@
+"""Dense subject x bin x variable array of the binned data of a cohort.
+
+recombine_columns stacks the binned data of every subject once into a CombinedArray. The per-variable combined files,
+their reformatted (wide) versions and the long table are all written from it by indexing the array, without stacking or
+pivoting a table per variable. Downstream statistics can run vectorized over the array of a whole cohort, in memory or
+from a .npz file (the .npy arrays of the values and their labels) or an Arrow file of the long table.
+"""
+import io
+
+import numpy as np
+import pandas as pd
+
+
+def _as_read_back(df):
+    """Return a small frame with the dtypes pandas infers when reading it back from a .csv file.
+
+    The reformatted files were pivoted from the combined .csv files, so their IDs and group labels are sorted and
+    written as read back, e.g. an ID "007" as the number 7.
+    """
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False)
+    buffer.seek(0)
+    return pd.read_csv(buffer)
+
+
+class CombinedArray:
+    """Binned data of several subjects as one array of shape (subjects, bins, variables).
+
+    Attributes:
+    values (ndarray): float array of shape (subjects, bins, variables), NaN where a subject has no value
+    present (ndarray): bool array of shape (subjects, bins), True where the subject has a row for the bin
+    ids (ndarray): ID of every subject, as text
+    group_labels (ndarray): GROUP_LABEL of every subject, "" for subjects without one
+    day (ndarray): DAY of every bin
+    hour (ndarray): HOUR of every bin, the end of the bin in hours since the start of the kept data
+    hour_24 (ndarray): 24 HOUR of every bin
+    variables (list of str): names of the variables
+    dtypes (list of dtype): dtype of every variable in the binned data, integer variables are stored as floats
+    """
+
+    def __init__(self, values, present, ids, group_labels, day, hour, hour_24, variables, dtypes=None):
+        self.values = values
+        self.present = present
+        self.ids = ids
+        self.group_labels = group_labels
+        self.day = day
+        self.hour = hour
+        self.hour_24 = hour_24
+        self.variables = list(variables)
+        self.dtypes = list(dtypes) if dtypes is not None else [values.dtype] * len(self.variables)
+
+    def __repr__(self):
+        subjects, bins, variables = self.values.shape
+        return f"CombinedArray({subjects} subjects x {bins} bins x {variables} variables)"
+
+    @classmethod
+    def from_subjects(cls, subject_frames, variables):
+        """Build the array from the binned data of each subject.
+
+        Parameters:
+        subject_frames (iterable of DataFrame): the data of one subject each, as returned by label_binned_subject, with
+            "ID", "GROUP_LABEL", "DAY", "HOUR" and "24 HOUR" columns and a row per bin
+        variables (list of str): columns of the frames to store
+
+        Returns:
+        CombinedArray: subjects in the order of the frames and bins ordered by HOUR
+        """
+        subject_frames = list(subject_frames)
+        lengths = [len(df) for df in subject_frames]
+
+        # A bin is identified by its DAY, HOUR and 24 HOUR, subjects may miss some of the bins of others
+        if subject_frames:
+            keys = pd.MultiIndex.from_frame(pd.concat([df[['HOUR', 'DAY', '24 HOUR']] for df in subject_frames]))
+        else:
+            keys = pd.MultiIndex.from_arrays([[], [], []], names=['HOUR', 'DAY', '24 HOUR'])
+        bins = keys.unique().sort_values()
+        bin_codes = bins.get_indexer(keys)
+        subject_codes = np.repeat(np.arange(len(subject_frames)), lengths)
+        if len(subject_frames) and pd.Series(subject_codes * len(bins) + bin_codes).duplicated().any():
+            raise ValueError("A subject has more than one row for the same DAY, HOUR and 24 HOUR")
+
+        values = np.full((len(subject_frames), len(bins), len(variables)), np.nan)
+        present = np.zeros((len(subject_frames), len(bins)), dtype=bool)
+        present[subject_codes, bin_codes] = True
+        dtypes = []
+        for k, variable in enumerate(variables):
+            if subject_frames:
+                column = np.concatenate([df[variable].to_numpy() for df in subject_frames])
+                values[subject_codes, bin_codes, k] = column.astype(float)
+                dtypes.append(np.result_type(*[df[variable].dtype for df in subject_frames]))
+            else:
+                dtypes.append(values.dtype)
+
+        # Bins take the dtype of the columns they come from, e.g. whole HOURs stay integers
+        coordinates = {}
+        for level, column in enumerate(['HOUR', 'DAY', '24 HOUR']):
+            dtype = np.result_type(*[df[column].dtype for df in subject_frames]) if subject_frames else float
+            coordinates[column] = bins.get_level_values(level).to_numpy().astype(dtype)
+
+        ids = np.array([df['ID'].iloc[0] if len(df) else '' for df in subject_frames], dtype=object)
+        group_labels = np.array([df['GROUP_LABEL'].iloc[0] if len(df) else '' for df in subject_frames], dtype=object)
+        return cls(values, present, ids, group_labels, coordinates['DAY'], coordinates['HOUR'], coordinates['24 HOUR'],
+                   variables, dtypes)
+
+    @classmethod
+    def concatenate(cls, arrays):
+        """Stack the arrays of several groups of subjects, e.g. built one subject at a time, along the subject axis.
+
+        The result is the array from_subjects builds from the frames of all the subjects at once.
+
+        Parameters:
+        arrays (iterable of CombinedArray): arrays with the same variables
+
+        Returns:
+        CombinedArray: subjects in the order of the arrays and bins ordered by HOUR
+        """
+        arrays = list(arrays)
+        if not arrays:
+            raise ValueError("No arrays to concatenate")
+        variables = arrays[0].variables
+        if any(array.variables != variables for array in arrays):
+            raise ValueError("The arrays have different variables")
+
+        # Bins take the dtype of the coordinates they come from, as in from_subjects
+        coordinates = []
+        for name in ['hour', 'day', 'hour_24']:
+            dtype = np.result_type(*[getattr(array, name).dtype for array in arrays])
+            coordinates.append([getattr(array, name).astype(dtype) for array in arrays])
+        bins = pd.MultiIndex.from_arrays([np.concatenate(parts) for parts in coordinates]).unique().sort_values()
+
+        subjects = sum(len(array.ids) for array in arrays)
+        values = np.full((subjects, len(bins), len(variables)), np.nan)
+        present = np.zeros((subjects, len(bins)), dtype=bool)
+        start = 0
+        for i, array in enumerate(arrays):
+            bin_codes = bins.get_indexer(pd.MultiIndex.from_arrays([parts[i] for parts in coordinates]))
+            end = start + len(array.ids)
+            values[start:end, bin_codes] = array.values
+            present[start:end, bin_codes] = array.present
+            start = end
+
+        dtypes = [np.result_type(*[array.dtypes[k] for array in arrays]) for k in range(len(variables))]
+        return cls(values, present, np.concatenate([array.ids for array in arrays]),
+                   np.concatenate([array.group_labels for array in arrays]), bins.get_level_values(1).to_numpy(),
+                   bins.get_level_values(0).to_numpy(), bins.get_level_values(2).to_numpy(), variables, dtypes)
+
+    def _variable_index(self, name):
+        if name not in self.variables:
+            raise KeyError(f"Unknown variable {name!r}, expected one of: {', '.join(self.variables)}")
+        return self.variables.index(name)
+
+    def _column(self, values, k):
+        """Return the values of variable k with the dtype of the binned data when none is missing."""
+        if np.issubdtype(self.dtypes[k], np.integer) and not np.isnan(values).any():
+            return values.astype(self.dtypes[k])
+        return values
+
+    def long(self, variables=None):
+        """Return the long table: one row per subject and bin, subjects in order and bins ordered by HOUR.
+
+        Parameters:
+        variables (list of str): variables to include, defaults to all of them
+
+        Returns:
+        DataFrame: "ID", "GROUP_LABEL", "DAY", "HOUR", "24 HOUR" and one column per variable
+        """
+        variables = self.variables if variables is None else variables
+        subjects, bins = np.nonzero(self.present)
+        data = {
+            'ID': self.ids[subjects],
+            # Inferred as for a column of the labels, e.g. integers when every label is a number
+            'GROUP_LABEL': pd.Series(list(self.group_labels[subjects]), dtype=None if len(subjects) else object),
+            'DAY': self.day[bins],
+            'HOUR': self.hour[bins],
+            '24 HOUR': self.hour_24[bins],
+        }
+        for name in variables:
+            k = self._variable_index(name)
+            data[name] = self._column(self.values[subjects, bins, k], k)
+        return pd.DataFrame(data)
+
+    def variable(self, name):
+        """Return the long table of one variable, as written to its combined .csv file."""
+        return self.long([name])
+
+    def wide(self, name):
+        """Return one variable with a row per subject and day and a column per 24 HOUR, as reformat_csv writes it.
+
+        Rows are sorted by ID, GROUP_LABEL and DAY and columns by 24 HOUR. Subjects without a GROUP_LABEL are labelled
+        "NO_LABEL" and rows and columns without any value are left out.
+
+        Returns:
+        DataFrame: "ID", "GROUP_LABEL", "DAY" and a "{name}_{24 HOUR}" column per 24 HOUR
+        """
+        k = self._variable_index(name)
+        subjects, bins = np.nonzero(self.present)
+        values = self.values[subjects, bins, k]
+        has_value = ~np.isnan(values)
+        subjects, bins, values = subjects[has_value], bins[has_value], values[has_value]
+
+        # Subjects with the same ID and GROUP_LABEL share their rows, the first value of a cell is kept
+        labels = _as_read_back(pd.DataFrame({'ID': self.ids, 'GROUP_LABEL': self.group_labels}))
+        labels['GROUP_LABEL'] = labels['GROUP_LABEL'].astype(object).fillna("NO_LABEL")
+        label_groups = labels.groupby(['ID', 'GROUP_LABEL'], sort=True)
+        label_codes = label_groups.ngroup().to_numpy()
+        label_keys = label_groups.size().index
+
+        days, day_codes = np.unique(self.day, return_inverse=True)
+        hours, hour_codes = np.unique(self.hour_24[bins], return_inverse=True)
+        row_keys, rows = np.unique(label_codes[subjects] * len(days) + day_codes[bins], return_inverse=True)
+        cells, first = np.unique(rows * len(hours) + hour_codes, return_index=True)
+        table = np.full((len(row_keys), len(hours)), np.nan)
+        table.flat[cells] = values[first]
+
+        wide = pd.DataFrame({
+            'ID': label_keys.get_level_values('ID')[row_keys // len(days)],
+            'GROUP_LABEL': label_keys.get_level_values('GROUP_LABEL')[row_keys // len(days)],
+            'DAY': days[row_keys % len(days)],
+        })
+        # As in a pivot, a missing cell makes every column of the table a float column
+        table = self._column(table, k)
+        for column, hour in enumerate(hours):
+            wide[f"{name}_{hour}"] = table[:, column]
+        return wide
+
+    def groups(self):
+        """Return the indices of the subjects of every GROUP_LABEL, in order of first appearance.
+
+        Returns:
+        dict: GROUP_LABEL -> ndarray of subject indices into the first axis of values
+        """
+        codes, labels = pd.factorize(pd.Series(self.group_labels, dtype=object), use_na_sentinel=False)
+        return {label: np.flatnonzero(codes == code) for code, label in enumerate(labels)}
+
+    def group_summary(self, decimals=4):
+        """Return the mean, SD, SEM and number of subjects of every group in every bin, for every variable.
+
+        All variables and bins of a group are summarized at once over the subject axis. The SD is the sample standard
+        deviation, as in Excel's STDEV, and is missing for bins with a single subject. Subjects without a GROUP_LABEL
+        are summarized as "NO_LABEL" and bins without any value in a group are left out.
+
+        Parameters:
+        decimals (int): number of decimals to round the statistics to
+
+        Returns:
+        dict: variable -> DataFrame with "GROUP_LABEL", "DAY", "HOUR", "24 HOUR", "N", "MEAN", "SD" and "SEM" columns,
+            one row per group and bin, groups sorted by label and bins by HOUR
+        """
+        labels = ["NO_LABEL" if pd.isna(label) or label == "" else label for label in self.group_labels]
+        groups = {}
+        for subject, label in enumerate(labels):
+            groups.setdefault(label, []).append(subject)
+
+        frames = {variable: [] for variable in self.variables}
+        for label in sorted(groups, key=str):
+            values = self.values[groups[label]]
+            n = (~np.isnan(values)).sum(axis=0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.nansum(values, axis=0) / n
+                sd = np.sqrt(np.nansum((values - mean) ** 2, axis=0) / (n - 1))
+                sem = sd / np.sqrt(n)
+            sd[n < 2] = np.nan
+            sem[n < 2] = np.nan
+
+            for k, variable in enumerate(self.variables):
+                bins = np.flatnonzero(n[:, k])
+                frames[variable].append(pd.DataFrame({
+                    'GROUP_LABEL': label,
+                    'DAY': self.day[bins],
+                    'HOUR': self.hour[bins],
+                    '24 HOUR': self.hour_24[bins],
+                    'N': n[bins, k],
+                    'MEAN': mean[bins, k].round(decimals),
+                    'SD': sd[bins, k].round(decimals),
+                    'SEM': sem[bins, k].round(decimals),
+                }))
+
+        columns = ['GROUP_LABEL', 'DAY', 'HOUR', '24 HOUR', 'N', 'MEAN', 'SD', 'SEM']
+        return {variable: pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=columns)
+                for variable, parts in frames.items()}
+
+    def select(self, subjects):
+        """Return the array of some of the subjects, e.g. those of a group as returned by groups."""
+        return CombinedArray(self.values[subjects], self.present[subjects], self.ids[subjects],
+                             self.group_labels[subjects], self.day, self.hour, self.hour_24, self.variables,
+                             self.dtypes)
+
+    def save(self, path):
+        """Save the array and its labels to a .npz file of .npy arrays that load reads back.
+
+        IDs and group labels are saved as text, so the file is read without unpickling.
+        """
+        np.savez(path, values=self.values, present=self.present, ids=self.ids.astype(str),
+                 group_labels=self.group_labels.astype(str), day=self.day, hour=self.hour, hour_24=self.hour_24,
+                 variables=np.array(self.variables, dtype=str), dtypes=np.array([str(d) for d in self.dtypes]))
+
+    @classmethod
+    def load(cls, path):
+        """Read an array saved with save."""
+        with np.load(path) as data:
+            return cls(data['values'], data['present'], data['ids'].astype(object),
+                       data['group_labels'].astype(object), data['day'], data['hour'], data['hour_24'],
+                       data['variables'].tolist(), [np.dtype(d) for d in data['dtypes']])
+
+    def to_arrow(self):
+        """Return the long table as a pyarrow Table."""
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("Arrow export requires pyarrow, install it with: pip install pyarrow")
+        return pa.Table.from_pandas(self.long(), preserve_index=False)
+
+    def write_arrow(self, path):
+        """Write the long table to an Arrow IPC (Feather) file."""
+        import pyarrow.feather as feather
+
+        feather.write_feather(self.to_arrow(), path)
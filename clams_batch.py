@@ -0,0 +1,241 @@
+"""Headless batch processing of many CLAMS experiments.
+
+Runs the clams_processing pipeline over any number of experiment directories in parallel, without the desktop or web
+interface. Each experiment directory holds the raw .csv exports and, unless another file is given, a
+config/experiment_config.csv with ID and GROUP_LABEL columns.
+
+Usage:
+    python clams_batch.py exp1/ exp2/ --trim 2 --keep 48 --bin 1 4 --start-cycle light --workers 4
+    python clams_batch.py --manifest experiments.csv --workers 8 --overwrite
+
+The manifest is a .csv or .json list of experiments with a "directory" field and optional "trim_hours", "keep_hours",
+"bin_hours" (e.g. "1;4;12"), "rolling" (e.g. "3:0.5;6:1"), "start_cycle" ("light" or "dark") and "config_file" fields;
+missing fields fall back to the command line options. A JSON status report is written to stdout when all experiments
+have finished. The exit code is 0 if every experiment succeeded and 1 otherwise.
+"""
+import argparse
+import contextlib
+import csv
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Directories created by the pipeline inside an experiment directory
+OUTPUT_DIRECTORY_PATTERN = re.compile(
+    r"^(Cleaned_CLAMS_data|Trimmed_CLAMS_data|QC_Filtered|"
+    r"(\d+hour_bins|[\d.]+hour_rolling_[\d.]+hour_step)_(Binned|Combined)_CLAMS_data)$")
+
+
+def parse_bin_hours(value):
+    """Parse bin hours given as a list or a string separated by commas, semicolons or spaces."""
+    if isinstance(value, str):
+        value = [v for v in re.split(r"[;,\s]+", value) if v]
+    bin_hours = [int(v) for v in value]
+    for bin_hour in bin_hours:
+        if bin_hour <= 0 or 24 % bin_hour != 0:
+            raise ValueError(f"Bin hours must be a factor of 24, got {bin_hour}")
+    return bin_hours
+
+
+def parse_rolling_windows(value):
+    """Parse WINDOW:STEP rolling windows in hours given as a list or a string separated by commas, semicolons or
+    spaces."""
+    if isinstance(value, str):
+        value = [v for v in re.split(r"[;,\s]+", value) if v]
+    rolling_windows = []
+    for window in value or []:
+        window_hours, _, step_hours = str(window).partition(':')
+        if not step_hours:
+            raise ValueError(f"Rolling windows must be given as WINDOW:STEP hours, got {window!r}")
+        window_hours, step_hours = float(window_hours), float(step_hours)
+        if window_hours <= 0 or step_hours <= 0:
+            raise ValueError(f"Rolling window and step hours must be positive, got {window!r}")
+        rolling_windows.append((window_hours, step_hours))
+    return rolling_windows
+
+
+def parse_start_cycle(value):
+    """Return True for a dark start cycle and False for a light one."""
+    value = str(value).strip().lower()
+    if value in ('dark', 'start dark'):
+        return True
+    if value in ('light', 'start light'):
+        return False
+    raise ValueError(f"Start cycle must be 'light' or 'dark', got {value!r}")
+
+
+def read_manifest(manifest_path):
+    """Read the experiments listed in a .csv or .json manifest as a list of dicts."""
+    with open(manifest_path, newline='') as f:
+        if manifest_path.lower().endswith('.json'):
+            entries = json.load(f)
+        else:
+            entries = [{k: v for k, v in row.items() if v not in (None, '')} for row in csv.DictReader(f)]
+
+    # Relative directories are resolved against the location of the manifest
+    manifest_directory = os.path.dirname(os.path.abspath(manifest_path))
+    for entry in entries:
+        if 'directory' not in entry:
+            raise ValueError(f"Manifest entry without a directory: {entry}")
+        entry['directory'] = os.path.join(manifest_directory, entry['directory'])
+    return entries
+
+
+def build_jobs(args):
+    """Combine the manifest entries and directories given on the command line with the default parameters."""
+    entries = read_manifest(args.manifest) if args.manifest else []
+    entries += [{'directory': directory} for directory in args.directories]
+
+    jobs = []
+    for entry in entries:
+        keep_hours = entry.get('keep_hours', args.keep)
+        jobs.append({
+            'directory': os.path.abspath(entry['directory']),
+            'trim_hours': int(entry.get('trim_hours', args.trim)),
+            'keep_hours': int(keep_hours) if keep_hours is not None else None,
+            'bin_hours': parse_bin_hours(entry.get('bin_hours', args.bin)),
+            'rolling_windows': parse_rolling_windows(entry.get('rolling', args.rolling)),
+            'start_dark': parse_start_cycle(entry.get('start_cycle', args.start_cycle)),
+            'config_file': entry.get('config_file'),
+        })
+    return jobs
+
+
+def remove_outputs(directory_path):
+    """Delete the directories generated by a previous run of the pipeline."""
+    for name in os.listdir(directory_path):
+        path = os.path.join(directory_path, name)
+        if os.path.isdir(path) and OUTPUT_DIRECTORY_PATTERN.match(name):
+            shutil.rmtree(path)
+
+
+def process_experiment(job, overwrite=False, max_subjects=None):
+    """Run the pipeline for one experiment and return its status.
+
+    The progress printed by the pipeline is written to a log file in the experiment's config directory instead of
+    stdout, so parallel experiments do not interleave their output.
+
+    Parameters:
+    job (dict): experiment parameters as built by build_jobs
+    overwrite (bool): remove the outputs of a previous run first
+    max_subjects (int): run clams_processing.stream_pipeline with at most this many subjects in flight instead of
+        run_pipeline, None to process the experiment stage by stage
+
+    Returns:
+    dict: the job parameters with "status", "seconds", "log_file" and either stage "metrics" or "error"
+    """
+    # Imported here so the main process only parses arguments and workers load pandas once
+    from clams_processing import run_pipeline, stream_pipeline
+    from instrumentation import collect
+
+    directory_path = job['directory']
+    status = dict(job)
+    started = time.perf_counter()
+    try:
+        if not os.path.isdir(directory_path):
+            raise FileNotFoundError(f"Not a directory: {directory_path}")
+        if overwrite:
+            remove_outputs(directory_path)
+
+        config_directory = os.path.join(directory_path, 'config')
+        os.makedirs(config_directory, exist_ok=True)
+        timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+        status['log_file'] = os.path.join(config_directory, f'log_{timestamp}.txt')
+
+        with open(status['log_file'], 'w') as log, contextlib.redirect_stdout(log), \
+                collect(job_id=directory_path) as metrics:
+            if max_subjects:
+                stream_pipeline(directory_path, job['trim_hours'], job['keep_hours'], job['bin_hours'],
+                                job['start_dark'], job['config_file'], rolling_windows=job['rolling_windows'],
+                                max_subjects=max_subjects)
+            else:
+                run_pipeline(directory_path, job['trim_hours'], job['keep_hours'], job['bin_hours'], job['start_dark'],
+                             job['config_file'], rolling_windows=job['rolling_windows'])
+        status.update(status='success', metrics=metrics.as_dict())
+    except Exception as e:
+        status.update(status='failure', error=f"{type(e).__name__}: {e}")
+    status['seconds'] = round(time.perf_counter() - started, 3)
+    return status
+
+
+def run_batch(jobs, workers, overwrite=False, max_subjects=None):
+    """Process the jobs with at most `workers` experiments running at the same time.
+
+    Returns:
+    list of dict: status of every job, in the order they were given
+    """
+    results = [None] * len(jobs)
+    if workers <= 1:
+        for i, job in enumerate(jobs):
+            results[i] = process_experiment(job, overwrite, max_subjects)
+            print(f"[{results[i]['status']}] {job['directory']}", file=sys.stderr)
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_experiment, job, overwrite, max_subjects): i for i, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                # The worker process itself died, e.g. killed for using too much memory
+                results[i] = dict(jobs[i], status='failure', error=f"{type(e).__name__}: {e}")
+            print(f"[{results[i]['status']}] {jobs[i]['directory']}", file=sys.stderr)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process many CLAMS experiment directories in parallel.")
+    parser.add_argument('directories', nargs='*', help="experiment directories containing raw .csv exports")
+    parser.add_argument('--manifest', help="a .csv or .json file listing experiments and their parameters")
+    parser.add_argument('--trim', type=int, default=0, help="hours to trim from the beginning (default: 0)")
+    parser.add_argument('--keep', type=int, default=None, help="hours to keep after trimming")
+    parser.add_argument('--bin', nargs='+', default=['1'], help="bin sizes in hours (default: 1)")
+    parser.add_argument('--rolling', nargs='+', default=[], metavar='WINDOW:STEP',
+                        help="rolling windows in hours, e.g. 3:0.5 for 3 hour windows every 30 minutes")
+    parser.add_argument('--start-cycle', default='light', help="'light' or 'dark' (default: light)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="maximum number of experiments processed at the same time (default: CPU count)")
+    parser.add_argument('--overwrite', action='store_true',
+                        help="remove outputs of a previous run before processing")
+    parser.add_argument('--max-subjects', type=int, default=None, metavar='N',
+                        help="process each experiment subject by subject with at most N subjects in flight, instead "
+                             "of stage by stage")
+    parser.add_argument('--output', help="also write the JSON status report to this file")
+    args = parser.parse_args(argv)
+
+    if not args.directories and not args.manifest:
+        parser.error("provide experiment directories or --manifest")
+
+    try:
+        jobs = build_jobs(args)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    missing_keep = [job['directory'] for job in jobs if job['keep_hours'] is None]
+    if missing_keep:
+        parser.error(f"no keep hours given for: {', '.join(missing_keep)}")
+
+    started = time.perf_counter()
+    results = run_batch(jobs, max(args.workers, 1), args.overwrite, args.max_subjects)
+    failed = sum(result['status'] != 'success' for result in results)
+    report = {
+        'experiments': results,
+        'succeeded': len(results) - failed,
+        'failed': failed,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+    report_json = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report_json)
+    print(report_json)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,287 @@
+"""CSV input and output for the processing pipeline.
+
+Every stage of clams_processing reads and writes its files through read_csv and write_csv, so the CSV implementation
+is chosen in one place. Three backends are available:
+
+    pandas   pandas' C parser and writer (default)
+    pyarrow  pandas with its multithreaded pyarrow parser, files are still written by pandas
+    arrow    pyarrow's multithreaded CSV reader and its CSV writer
+
+All backends read the same values. The Arrow parsers return ISO timestamps as datetime columns instead of text, which
+makes no difference to the pipeline because every stage converts them with clams_profiles.parse_datetimes. pandas and
+pyarrow write identical files. arrow writes the same values but formats them differently (e.g. 1 instead of 1.0 and
+quoted text).
+
+The backend is chosen with the CLAMS_CSV_BACKEND environment variable or set_backend(). pyarrow is an optional
+dependency that is only needed for the pyarrow and arrow backends.
+
+The per-file stages overlap their I/O with their computation: read_ahead parses the next files on a thread pool while
+the current one is processed, and WriteBehind writes the outputs on another while the next ones are computed. Both
+are bounded, so at most CLAMS_READ_AHEAD parsed files and CLAMS_WRITE_BEHIND unwritten outputs are held in memory.
+Set CLAMS_IO_THREADS to 0 to read and write in the calling thread.
+"""
+import contextlib
+import io
+import itertools
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import pandas as pd
+
+BACKENDS = ('pandas', 'pyarrow', 'arrow')
+
+_backend = os.environ.get('CLAMS_CSV_BACKEND', 'pandas')
+
+# Threads of read_ahead and of every WriteBehind, 0 to read and write in the calling thread
+IO_THREADS = int(os.environ.get('CLAMS_IO_THREADS', 2))
+
+# Files read ahead of the one being processed
+READ_AHEAD = int(os.environ.get('CLAMS_READ_AHEAD', 2))
+
+# Outputs waiting to be written before WriteBehind.write blocks
+WRITE_BEHIND = int(os.environ.get('CLAMS_WRITE_BEHIND', 4))
+
+
+def _check_backend(name):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown CSV backend {name!r}, expected one of: {', '.join(BACKENDS)}")
+    if name != 'pandas':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError(f"The {name} CSV backend requires pyarrow, install it with: pip install pyarrow")
+    return name
+
+
+def get_backend():
+    """Return the name of the CSV backend in use."""
+    return _check_backend(_backend)
+
+
+def set_backend(name):
+    """Select the CSV backend used by read_csv and write_csv for the whole process.
+
+    Returns:
+    string: name of the previous backend
+    """
+    global _backend
+    previous = _backend
+    _backend = _check_backend(name)
+    return previous
+
+
+@contextlib.contextmanager
+def use_backend(name):
+    """Temporarily select a CSV backend."""
+    previous = set_backend(name)
+    try:
+        yield
+    finally:
+        set_backend(previous)
+
+
+def _skip_lines(source, skiprows):
+    """Return the contents of source after its first skiprows lines as a binary buffer.
+
+    The Arrow parser can only skip rows with the same number of fields as the data, so preamble lines of varying width
+    (e.g. the metadata of raw Oxymax exports) are removed before parsing.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            data = f.read()
+    else:
+        data = source.read()
+        if isinstance(data, str):
+            data = data.encode()
+    start = 0
+    for _ in range(skiprows):
+        start = data.index(b'\n', start) + 1
+    return io.BytesIO(data[start:])
+
+
+def _arrow_to_pandas(table):
+    """Convert an Arrow table to a DataFrame with the dtypes pandas' own parser would give, except for timestamps."""
+    import pyarrow as pa
+
+    df = table.to_pandas()
+    # Arrow reads columns without any value as null type, pandas as float
+    for name, column_type in zip(table.column_names, table.schema.types):
+        if pa.types.is_null(column_type):
+            df[name] = df[name].astype('float64')
+    return df
+
+
+def read_csv(source, skiprows=0):
+    """Read a CSV file into a DataFrame with the selected backend.
+
+    Parameters:
+    source (string or file-like): path of the file, or a buffer holding its contents
+    skiprows (int): number of lines to skip before the header row
+
+    Returns:
+    DataFrame: the parsed data
+    """
+    backend = get_backend()
+    if backend == 'pandas':
+        return pd.read_csv(source, skiprows=skiprows or None)
+
+    if skiprows:
+        source = _skip_lines(source, skiprows)
+    if backend == 'pyarrow':
+        return pd.read_csv(source, engine='pyarrow')
+
+    import pyarrow.csv as pa_csv
+
+    # Empty fields in text columns are missing values for pandas, not empty strings
+    convert_options = pa_csv.ConvertOptions(strings_can_be_null=True)
+    return _arrow_to_pandas(pa_csv.read_csv(source, convert_options=convert_options))
+
+
+def write_csv(df, path):
+    """Write a DataFrame without its index to a CSV file with the selected backend."""
+    if get_backend() != 'arrow':
+        df.to_csv(path, index=False)
+        return
+
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+
+    # Format timestamps as pandas does, Arrow would add microseconds to every value
+    timestamp_columns = [name for name, dtype in df.dtypes.items() if pd.api.types.is_datetime64_any_dtype(dtype)]
+    if timestamp_columns:
+        df = df.assign(**{name: df[name].astype(str).where(df[name].notna()) for name in timestamp_columns})
+    pa_csv.write_csv(pa.Table.from_pandas(df, preserve_index=False), path)
+
+
+def read_ahead(paths, read=read_csv, depth=None):
+    """Read files ahead of their processing on a thread pool.
+
+    Parameters:
+    paths (iterable): paths of the files, in processing order
+    read (callable): reads one file, read(path)
+    depth (int): files read ahead of the one being processed, defaults to READ_AHEAD
+
+    Yields:
+    tuple: every path with what read returned for it, in the order of paths. An error reading a file is raised when
+        the file is reached.
+    """
+    depth = READ_AHEAD if depth is None else depth
+    if depth <= 0 or IO_THREADS <= 0:
+        for path in paths:
+            yield path, read(path)
+        return
+
+    paths = iter(paths)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=min(IO_THREADS, depth), thread_name_prefix='clams-read') as executor:
+        try:
+            for path in itertools.islice(paths, depth):
+                pending.append((path, executor.submit(read, path)))
+            while pending:
+                path, future = pending.popleft()
+                # Keep depth files in flight while this one is processed
+                for next_path in itertools.islice(paths, 1):
+                    pending.append((next_path, executor.submit(read, next_path)))
+                yield path, future.result()
+        finally:
+            # The caller stopped early or a read failed
+            for _, future in pending:
+                future.cancel()
+
+
+class PendingOutput:
+    """An output queued by WriteBehind.write.
+
+    Attributes:
+    path (string): path the output is written to
+    written (bool): True once the write has finished, successfully or not
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.written = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def when_written(self, callback):
+        """Call callback() once the output is written, immediately if it is already."""
+        with self._lock:
+            if not self.written:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def _finish(self):
+        with self._lock:
+            self.written = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class WriteBehind:
+    """Write outputs on background threads while the caller computes the next ones.
+
+    write blocks while max_pending outputs are waiting to be written. flush is the barrier after which every queued
+    output is on disk, e.g. before the files are read by the next stage or zipped; leaving the with block flushes.
+
+    Parameters:
+    write (callable): writes one output, write(data, path), defaults to write_csv
+    threads (int): writer threads, defaults to IO_THREADS. With 0 outputs are written by write itself.
+    max_pending (int): outputs waiting to be written at most, defaults to WRITE_BEHIND
+    """
+
+    def __init__(self, write=write_csv, threads=None, max_pending=None):
+        threads = IO_THREADS if threads is None else threads
+        self._write = write
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix='clams-write') if threads > 0 else None
+        self._slots = threading.BoundedSemaphore(max(WRITE_BEHIND if max_pending is None else max_pending, 1))
+        self._futures = []
+
+    def _run(self, data, output):
+        try:
+            self._write(data, output.path)
+        finally:
+            output._finish()
+            self._slots.release()
+
+    def write(self, data, path):
+        """Queue data to be written to path. The data must not be modified afterwards.
+
+        Returns:
+        PendingOutput: the queued output
+        """
+        output = PendingOutput(path)
+        self._slots.acquire()
+        if self._executor is None:
+            self._run(data, output)
+        else:
+            self._futures.append(self._executor.submit(self._run, data, output))
+        return output
+
+    def flush(self):
+        """Wait until every queued output is written, and raise the first error of their writes."""
+        futures, self._futures = self._futures, []
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """Flush and stop the writer threads."""
+        try:
+            self.flush()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._executor is not None:
+            # Let the queued writes finish without hiding the error of the caller
+            self._executor.shutdown()
@@ -0,0 +1,310 @@
+"""Polars implementation of the clams_processing pipeline.
+
+Selected with run_pipeline(..., engine='polars') or CLAMS_ENGINE=polars. Every step builds one lazy query per subject
+and the queries of all subjects are collected together, so Polars runs them on all cores and only parses and computes
+the columns a step needs. The queries are per subject rather than one query over the cohort because the bin labels and
+compensated sums are computed in numpy over the rows of one subject. Like the pandas engine, each step reads the files
+the previous step wrote, so no frames are held between steps.
+
+The files written are identical to those of the pandas engine:
+    - values are parsed as pandas parses them and written with clams_io.write_csv
+    - sums and means use the compensated summation of pandas' groupby, so rounding to 4 decimals gives the same digits
+    - bin labels are assigned with the same scan over the timestamps as bin_clams_frame
+
+Recombining and reformatting work on the array of the combined data and are left to the pandas implementation.
+"""
+import glob
+import os
+import re
+
+import numpy as np
+import polars as pl
+
+import clams_processing
+from clams_io import WriteBehind, get_backend, write_csv
+from clams_processing import BINNED_COLUMNS, DROPPED_COLUMNS, LAST_VALUE_COLUMNS, NA_VALUES, SUM_COLUMNS
+from clams_profiles import file_date_format, get_profile
+
+# Accumulating columns that are zeroed at the start of the kept data
+ACCUMULATED_COLUMNS = ['ACCO2', 'ACCCO2', 'FEED1 ACC', 'WHEEL ACC']
+
+
+def _round(expr, decimals):
+    """Round with numpy.round like pandas.
+
+    Polars' own round, and scaling by hand, can differ in the last digit because Polars divides by a constant by
+    multiplying with its reciprocal.
+    """
+    return expr.map_batches(lambda values: pl.Series(np.round(values.to_numpy(), decimals)).fill_nan(None),
+                            return_dtype=pl.Float64)
+
+
+def _compensated_sums(columns, mean=False):
+    """Sum or average the lists of every field of a struct column like pandas' groupby sum and mean.
+
+    pandas adds the values of a group in order with Kahan summation, which can differ from Polars' sums in the last
+    digit. The lists are laid out in a matrix of groups by position by field so the summation runs over all groups and
+    fields at once.
+    """
+    names = columns.struct.fields
+    lengths = columns.struct.field(names[0]).list.len().to_numpy().astype(np.int64)
+    values = np.column_stack([columns.struct.field(name).explode().cast(pl.Float64).to_numpy() for name in names])
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    grid = np.full((len(lengths), lengths.max(initial=0), len(names)), np.nan)
+    grid[np.repeat(np.arange(len(lengths)), lengths), np.arange(len(values)) - np.repeat(offsets, lengths)] = values
+
+    total = np.zeros((len(lengths), len(names)))
+    compensation = np.zeros_like(total)
+    count = np.zeros_like(total)
+    with np.errstate(invalid='ignore'):
+        for position in range(grid.shape[1]):
+            value = grid[:, position]
+            present = ~np.isnan(value)
+            y = value - compensation
+            t = total + y
+            new_compensation = t - total - y
+            new_compensation[np.isnan(new_compensation)] = 0
+            total = np.where(present, t, total)
+            compensation = np.where(present, new_compensation, compensation)
+            count += present
+        if mean:
+            total = total / count
+    return pl.DataFrame(total, schema=names, orient='row').to_struct()
+
+
+def _bin_labels(columns, bin_hours):
+    """Number the bins of every "LED LIGHTNESS" value the way bin_clams_frame does.
+
+    A new bin starts at the first timestamp at least bin_hours after the start of the current bin.
+    """
+    led = columns.struct.field('LED LIGHTNESS').to_numpy()
+    times = columns.struct.field('DATE/TIME').dt.epoch('us').to_numpy()
+    width = bin_hours * 3600 * 10 ** 6
+
+    labels = np.full(len(led), np.nan)
+    for led_value in np.unique(led):
+        rows = np.flatnonzero(led == led_value)
+        start_time = times[rows[0]]
+        bin_label = 0
+        bin_labels = []
+        for timestamp in times[rows].tolist():
+            if timestamp - start_time >= width:
+                bin_label += 1
+                start_time = timestamp
+            bin_labels.append(bin_label)
+        labels[rows] = bin_labels
+    return pl.Series(labels)
+
+
+def _parse_date_time(file_path, strict):
+    """Return an expression parsing the "DATE/TIME" column of file_path like pd.to_datetime."""
+    date_time = pl.col('DATE/TIME')
+    return date_time.str.to_datetime(file_date_format(file_path), time_unit='us', strict=strict)
+
+
+def _as_read_back(df):
+    """Give a frame the dtypes pandas would read back from its .csv file.
+
+    pandas has no missing integers, so integer columns with missing values and columns without any value are read as
+    floats.
+    """
+    casts = {}
+    for name, dtype in df.schema.items():
+        null_count = df[name].null_count()
+        if (dtype.is_integer() and null_count) or (dtype == pl.String and null_count == len(df)):
+            casts[name] = pl.Float64
+    return df.cast(casts) if casts else df
+
+
+def _write_frame(df, path):
+    """Write a Polars frame with clams_io.write_csv, or directly when Polars writes the same file faster."""
+    # Text is written as-is by both pandas and Polars, quoted only where needed
+    if get_backend() != 'arrow' and all(dtype == pl.String for dtype in df.dtypes):
+        df.write_csv(path, line_terminator=os.linesep)
+    else:
+        write_csv(df.to_pandas(), path)
+
+
+def clean_plan(file_path, profile):
+    """Return a lazy query for the data rows of a raw Oxymax-CLAMS export, read as text like clean_clams_file."""
+    # Skip the metadata lines and the formatting rows below the header
+    return pl.scan_csv(file_path, skip_lines=profile.metadata_lines, infer_schema=False,
+                       null_values=NA_VALUES).slice(profile.formatting_rows)
+
+
+def trim_plan(file_path, trim_hours, keep_hours, start_dark):
+    """Return a lazy query trimming a cleaned file like trim_clams_file."""
+    lf = pl.scan_csv(file_path, infer_schema_length=None, null_values=NA_VALUES)
+    schema = lf.collect_schema()
+    date_time = pl.col('DATE/TIME')
+    led = pl.col('LED LIGHTNESS')
+    row = pl.col('_row')
+    light_period = pl.col('_light_period')
+
+    # Number the periods of constant "LED LIGHTNESS"
+    lf = lf.with_columns(_parse_date_time(file_path, strict=False)).with_row_index('_row').with_columns(
+        (led != led.shift(1)).fill_null(True).cum_sum().alias('_light_period'))
+
+    # The kept data starts at the first light change after the trimmed hours, or the one after it if that change
+    # does not start the requested cycle
+    trim_start = row.filter(date_time >= date_time.first() + pl.duration(hours=trim_hours)).first()
+    next_period = light_period.gather(trim_start) + 1
+    first_change = row.filter(light_period == next_period).first()
+    wrong_cycle = (led.gather(first_change) != 0) if start_dark else (led.gather(first_change) == 0)
+    start_index = row.filter(light_period == next_period + wrong_cycle.cast(pl.UInt32)).first()
+
+    # Zero columns that contain accumulative variables to appropriately account for variable trimming times
+    zeroed = []
+    for name in ACCUMULATED_COLUMNS:
+        value = pl.col(name) - pl.col(name).gather(start_index - 1)
+        zeroed.append(_round(value, 2) if schema[name].is_float() else value)
+
+    end_time = date_time.gather(start_index) + pl.duration(hours=keep_hours)
+    return lf.with_columns(zeroed).filter((row >= start_index) & (date_time <= end_time)).drop(
+        '_row', '_light_period')
+
+
+def bin_plan(trimmed, bin_hours):
+    """Return a lazy query binning a trimmed frame like bin_clams_frame."""
+    bin_hours = int(bin_hours)
+    keys = ['LED LIGHTNESS', 'BIN']
+
+    lf = trimmed.lazy().drop(DROPPED_COLUMNS, strict=False)
+    lf = lf.with_columns((pl.col('XAMB') + pl.col('YAMB')).alias('AMB'))
+    lf = lf.with_columns(pl.col('AMB').cum_sum().alias('AMB ACC'))
+    lf = lf.with_columns(pl.struct('LED LIGHTNESS', 'DATE/TIME').map_batches(
+        lambda columns: _bin_labels(columns, bin_hours), return_dtype=pl.Float64).alias('BIN'))
+    schema = lf.collect_schema()
+
+    # Only the columns of the binned file are aggregated
+    mean_columns = [name for name in BINNED_COLUMNS
+                    if name in schema and name not in LAST_VALUE_COLUMNS + SUM_COLUMNS + keys]
+    float_sum_columns = [name for name in SUM_COLUMNS if not schema[name].is_integer()]
+    aggregations = [pl.col(name).drop_nulls().last() for name in LAST_VALUE_COLUMNS
+                    if name in BINNED_COLUMNS]
+    aggregations += [pl.col(name).sum() for name in SUM_COLUMNS if name not in float_sum_columns]
+    aggregations += [pl.col(name) for name in mean_columns + float_sum_columns]
+    aggregations += [
+        pl.col('DATE/TIME').drop_nulls().first().alias('DATE/TIME_start'),
+        pl.col('DATE/TIME').drop_nulls().last().alias('DATE/TIME_end'),
+        pl.col('INTERVAL').drop_nulls().first().alias('INTERVAL_start'),
+        pl.col('INTERVAL').drop_nulls().last().alias('INTERVAL_end'),
+    ]
+    lf = lf.filter(pl.col('LED LIGHTNESS').is_not_null()).group_by(keys).agg(aggregations)
+    compensated = [pl.struct(mean_columns).map_batches(
+        lambda columns: _compensated_sums(columns, mean=True),
+        return_dtype=pl.Struct({name: pl.Float64 for name in mean_columns})).alias('_means')]
+    if float_sum_columns:
+        compensated.append(pl.struct(float_sum_columns).map_batches(
+            lambda columns: _compensated_sums(columns),
+            return_dtype=pl.Struct({name: pl.Float64 for name in float_sum_columns})).alias('_sums'))
+    lf = lf.with_columns(compensated).drop(mean_columns + float_sum_columns).unnest(
+        [expression.meta.output_name() for expression in compensated])
+
+    # Calculate the duration of each bin in hours and drop bins with a duration of 0
+    duration = (pl.col('DATE/TIME_end') - pl.col('DATE/TIME_start')).dt.total_microseconds() / 10 ** 6 / 3600
+    lf = lf.with_columns(duration.alias('DURATION')).filter(pl.col('DURATION') != 0)
+
+    # Number the bins in time order and add the DAY, HOUR and 24 HOUR columns
+    hour = pl.col('HOUR').cast(pl.Int64)
+    lf = lf.sort('INTERVAL_start').with_row_index('HOUR').with_columns(
+        ((pl.col('BIN') // (12 / bin_hours) + 1).cast(pl.Int64)).alias('DAY'),
+        ((hour % (24 // bin_hours) + 1) * bin_hours).alias('24 HOUR'),
+        ((hour + 1) * bin_hours).alias('HOUR'))
+
+    # Round all variables to 4 decimal places
+    lf = lf.select(BINNED_COLUMNS)
+    return lf.with_columns(_round(pl.col(name), 4) for name, dtype in lf.collect_schema().items()
+                           if dtype.is_float())
+
+
+class PolarsEngine:
+    """The steps of clams_processing.run_pipeline, with the same arguments and outputs."""
+
+    def clean_all_clams_data(self, directory_path):
+        # As in the pandas engine, files cleaned by a previous run are kept
+        output_directory = os.path.join(directory_path, "Cleaned_CLAMS_data")
+        if os.path.exists(output_directory):
+            return
+        os.makedirs(output_directory)
+
+        # Process all CSV files in the directory, regardless of extension case
+        csv_pattern = re.compile(r"\.csv$", re.IGNORECASE)
+        all_files = glob.iglob(os.path.join(directory_path, "*"))
+        csv_files = [file_path for file_path in all_files if csv_pattern.search(file_path)]
+
+        # Exports holding several channels are split by the streaming splitter of the pandas engine
+        single_files = []
+        plans = []
+        output_paths = []
+        for file_path in csv_files:
+            profile = get_profile(file_path)
+            metadata = clams_processing.read_export_metadata(file_path, profile.metadata_lines)
+            subject_ids = clams_processing.channel_subject_ids(metadata)
+            if subject_ids is not None:
+                clams_processing.split_clams_file(file_path, output_directory, subject_ids, profile)
+                continue
+            subject_id = (metadata.get('Subject ID') or [''])[0]
+            base_name, ext = os.path.splitext(os.path.basename(file_path))
+            single_files.append(file_path)
+            plans.append(clean_plan(file_path, profile))
+            output_paths.append(os.path.join(output_directory, f"{base_name}_ID{subject_id}{ext.lower()}"))
+
+        frames = pl.collect_all(plans)
+        with WriteBehind(_write_frame) as writer:
+            for file_path, output_path, df in zip(single_files, output_paths, frames):
+                writer.write(df, output_path)
+                print(f"Cleaning {os.path.basename(file_path)}")
+
+    def trim_all_clams_data(self, directory_path, trim_hours, keep_hours, start_dark):
+        trimmed_directory = os.path.join(directory_path, "Trimmed_CLAMS_data")
+        os.makedirs(trimmed_directory, exist_ok=True)
+
+        cleaned_directory = os.path.join(directory_path, "Cleaned_CLAMS_data")
+        files = [f for f in os.listdir(cleaned_directory) if
+                 os.path.isfile(os.path.join(cleaned_directory, f)) and f.endswith('.csv')]
+
+        plans = [trim_plan(os.path.join(cleaned_directory, file), trim_hours, keep_hours, start_dark) for file in files]
+        # Frames are written behind while the next ones are converted
+        with WriteBehind(_write_frame) as writer:
+            for file, df in zip(files, pl.collect_all(plans)):
+                base_name, ext = os.path.splitext(file)
+                output_path = os.path.join(trimmed_directory, f"{base_name}_trimmed{ext.lower()}")
+                writer.write(df, output_path)
+                print(f"Trimming {file}")
+
+    def process_directory(self, directory_path, bin_hours, step_hours=None):
+        if step_hours is not None:
+            # Rolling windows are computed from cumulative sums by the pandas engine
+            clams_processing.process_directory(directory_path, bin_hours, step_hours)
+            return
+        bin_hours = int(bin_hours)
+        trimmed_directory = os.path.join(directory_path, "Trimmed_CLAMS_data")
+        csv_files = [f for f in os.listdir(trimmed_directory) if
+                     f.endswith('.csv') and os.path.isfile(os.path.join(trimmed_directory, f))]
+
+        plans = []
+        for csv_file in csv_files:
+            file_path = os.path.join(trimmed_directory, csv_file)
+            trimmed = _as_read_back(pl.read_csv(file_path, infer_schema_length=None, null_values=NA_VALUES)
+                                    .with_columns(_parse_date_time(file_path, strict=True)))
+            plans.append(bin_plan(trimmed, bin_hours))
+
+        with WriteBehind(_write_frame) as writer:
+            for csv_file, df in zip(csv_files, pl.collect_all(plans)):
+                output_path = os.path.join(trimmed_directory, csv_file).replace(
+                    "Trimmed_CLAMS_data", f"{bin_hours}hour_bins_Binned_CLAMS_data"
+                ).replace(
+                    ".csv", f"_{bin_hours}hour_bins.csv"
+                )
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                writer.write(df, output_path)
+                print(f"Binning {csv_file}")
+
+    @staticmethod
+    def recombine_columns(directory_path, experiment_config_file, bin_hours, step_hours=None):
+        return clams_processing.recombine_columns(directory_path, experiment_config_file, bin_hours, step_hours)
+
+    @staticmethod
+    def reformat_csvs_in_directory(input_dir, combined_data=None):
+        clams_processing.reformat_csvs_in_directory(input_dir, combined_data)
@@ -0,0 +1,134 @@
+"""Downsampled previews of cleaned recordings, to plot them in the browser without downloading the results.
+
+Every variable of a subject is reduced to a fixed number of points with the Largest-Triangle-Three-Buckets algorithm
+(Steinarsson, 2013), which keeps the peaks and the shape of the series instead of averaging them away. The LED lightness
+is kept at full resolution as its runs, the light and dark phases the trim stage starts the kept data at.
+
+Times are given in hours since the first timestamp of the subject, the "start" of its preview.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from clams_io import read_csv
+from clams_processing import clean_clams_export, extract_id_number
+from clams_profiles import parse_datetimes
+
+# Columns of the cleaned files that are previewed, when the export has them
+PREVIEW_VARIABLES = ['VO2', 'VCO2', 'RER', 'HEAT', 'FLOW', 'FEED1', 'FEED1 ACC', 'WHEEL', 'WHEEL ACC', 'XAMB', 'YAMB',
+                     'ENCLOSURE TEMP']
+
+
+def lttb(x, y, threshold):
+    """Downsample a series to threshold points with the Largest-Triangle-Three-Buckets algorithm.
+
+    The first and last points are kept. The points between them are split into threshold - 2 buckets of equal size, and
+    from every bucket the point forming the largest triangle with the point kept from the previous bucket and the
+    average of the next bucket is kept.
+
+    Parameters:
+    x (ndarray): increasing x values
+    y (ndarray): y values, without NaN
+    threshold (int): number of points to keep
+
+    Returns:
+    tuple: the x and y values of the kept points, the whole series if it has no more than threshold points
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
+
+    every = (n - 2) / (threshold - 2)
+    edges = np.floor(np.arange(threshold - 1) * every).astype(int) + 1
+    edges[-1] = n - 1
+    counts = np.diff(edges)
+    # Average of every bucket, the last point stands in for the bucket after the last one
+    average_x = np.append(np.add.reduceat(x[:-1], edges[:-1]) / counts, x[-1])
+    average_y = np.append(np.add.reduceat(y[:-1], edges[:-1]) / counts, y[-1])
+
+    selected = np.empty(threshold, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        bucket_x, bucket_y = x[start:end], y[start:end]
+        # Twice the area of the triangles, the constant factor does not change the largest
+        area = np.abs((x[a] - average_x[i + 1]) * (bucket_y - y[a]) - (x[a] - bucket_x) * (average_y[i + 1] - y[a]))
+        a = start + int(area.argmax())
+        selected[i + 1] = a
+    return x[selected], y[selected]
+
+
+def light_phases(hours, lightness):
+    """Return the runs of equal LED lightness of a recording.
+
+    Parameters:
+    hours (ndarray): time of every row in hours since the start of the recording
+    lightness (ndarray): LED LIGHTNESS of every row
+
+    Returns:
+    list of dict: "start" and "end", the hours of the first and last row of the run, and "dark", True if the LED
+        lightness is 0 as the trim stage counts it
+    """
+    starts = np.flatnonzero(np.r_[True, lightness[1:] != lightness[:-1]])
+    ends = np.r_[starts[1:] - 1, len(lightness) - 1]
+    return [{'start': round(float(hours[start]), 4), 'end': round(float(hours[end]), 4),
+             'dark': bool(lightness[start] == 0)} for start, end in zip(starts, ends)]
+
+
+def preview_subject(file_path, points):
+    """Compute the preview of one cleaned subject file.
+
+    Parameters:
+    file_path (string): path to the cleaned .csv file
+    points (int): number of points to reduce every variable to
+
+    Returns:
+    dict: "start" (ISO timestamp of the first row), "hours" (span of the recording), "rows", "points", "phases" (see
+        light_phases) and "series", the "hours" and "values" of the kept points of every variable
+    """
+    df = read_csv(file_path)
+    times = parse_datetimes(df['DATE/TIME'], errors='coerce')
+    df = df[times.notna()].reset_index(drop=True)
+    times = times.dropna().reset_index(drop=True)
+    if df.empty:
+        raise ValueError(f"{os.path.basename(file_path)} has no rows with a valid DATE/TIME")
+
+    start = times.iloc[0]
+    hours = ((times - start) / pd.Timedelta(hours=1)).to_numpy(dtype=float)
+    lightness = pd.to_numeric(df['LED LIGHTNESS'], errors='coerce').ffill().to_numpy(dtype=float)
+
+    series = {}
+    for variable in PREVIEW_VARIABLES:
+        if variable not in df.columns:
+            continue
+        values = pd.to_numeric(df[variable], errors='coerce').to_numpy(dtype=float)
+        valid = ~np.isnan(values)
+        x, y = lttb(hours[valid], values[valid], points)
+        series[variable] = {'hours': np.round(x, 4).tolist(), 'values': y.tolist()}
+
+    return {
+        'start': start.isoformat(),
+        'hours': round(float(hours[-1]), 4),
+        'rows': len(df),
+        'points': points,
+        'phases': light_phases(hours, lightness),
+        'series': series,
+    }
+
+
+def preview_export(file_path, output_directory, points):
+    """Clean a raw export and compute the preview of every subject in it.
+
+    Parameters:
+    file_path (string): path to the raw .csv file exported by Oxymax-CLAMS
+    output_directory (string): directory to save the cleaned files to
+    points (int): number of points to reduce every variable to
+
+    Returns:
+    dict: subject ID (int) -> its preview, see preview_subject
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    return {int(extract_id_number(os.path.basename(path))): preview_subject(path, points)
+            for path in clean_clams_export(file_path, output_directory)}
@@ -1,24 +1,46 @@
+import contextlib
+import csv
+import functools
 import glob
+import itertools
 import os
 import re
+import sys
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
 import numpy as np
 import pandas as pd
 
+from clams_array import CombinedArray
+from clams_io import WriteBehind, read_ahead, read_csv, write_csv
+from clams_profiles import channel_subject_ids, get_profile, parse_datetimes, read_export_metadata
+from instrumentation import file_step, stage
 
-def clean_all_clams_data(directory_path):
-    """Reformat all CLAMS data files (.csv) in the provided directory by dropping unnecessary rows.
+# Fields pandas' parser reads as missing values
+NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A',
+             'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+
+def clean_clams_file(file_path, output_directory, profile=None):
+    """Clean an individual raw CLAMS data file and save it to output_directory.
 
     Parameters:
-    directory_path (string): directory containing .csv files to clean
+    file_path (string): path to the raw .csv file exported by Oxymax-CLAMS
+    output_directory (string): directory to save the cleaned file to
+    profile (ExportProfile): layout of the export, detected from the file if not given
 
     Returns:
-    Nothing. Prints new filenames saved to "Cleaned_CLAMS_data" directory.
+    string: path of the cleaned file
     """
+    if profile is None:
+        profile = get_profile(file_path)
+
+    with file_step('clean', file_path) as step:
+        step['profile'] = profile.signature
 
-    def clean_file(file_path, output_directory):
-        """Helper function to clean individual file."""
         # Read the file as plain text to extract metadata
         with open(file_path, 'r') as f:
             lines = f.readlines()
@@ -30,10 +52,11 @@ def clean_all_clams_data(directory_path):
                 break
 
         # Read the data chunk of the CSV file
-        df = pd.read_csv(file_path, skiprows=range(0, 22))
+        df = read_csv(file_path, skiprows=profile.metadata_lines)
+        step['rows_in'] = len(df)
 
-        # Drop additional 2 formatting rows
-        df.drop([0, 1], inplace=True)
+        # Drop the formatting rows (units and "====" in most exports)
+        df.drop(list(range(profile.formatting_rows)), inplace=True)
 
         # Construct the new file name
         file_name = os.path.basename(file_path)
@@ -43,8 +66,101 @@ def clean_all_clams_data(directory_path):
 
         # Save the cleaned data to the new directory
         output_path = os.path.join(output_directory, new_file_name)
-        df.to_csv(output_path, index=False)
-        print(f"Cleaning {file_name}")
+        write_csv(df, output_path)
+        step.update(rows_out=len(df), output_path=output_path)
+
+    print(f"Cleaning {file_name}")
+    return output_path
+
+
+def split_clams_file(file_path, output_directory, subject_ids, profile=None):
+    """Clean a raw export holding several channels into one cleaned file per subject, reading it once.
+
+    Data rows are streamed to the cleaned file of their CHAN, so the export never has to fit in memory. Rows without a
+    numeric CHAN, such as a separator or summary row at the end of the export, are skipped. The values are copied as
+    they are in the export, missing values as empty fields, so they read back as the file clean_clams_file writes for
+    the subject but are not reformatted the way pandas writes numbers (e.g. "22.50" stays "22.50").
+
+    Parameters:
+    file_path (string): path to the raw .csv file exported by Oxymax-CLAMS
+    output_directory (string): directory to save the cleaned files to
+    subject_ids (dict): subject ID by channel number, see channel_subject_ids
+    profile (ExportProfile): layout of the export, detected from the file if not given
+
+    Returns:
+    list of str: paths of the cleaned files, in the order their channels first appear
+    """
+    if profile is None:
+        profile = get_profile(file_path)
+    file_name = os.path.basename(file_path)
+    base_name, ext = os.path.splitext(file_name)
+    na_values = set(NA_VALUES)
+
+    with file_step('clean', file_path) as step, contextlib.ExitStack() as outputs, \
+            open(file_path, 'r', newline='') as f:
+        step['profile'] = profile.signature
+        for _ in range(profile.metadata_lines):
+            f.readline()
+        rows = (row for row in csv.reader(f) if row)
+        header = next(rows)
+        if 'CHAN' not in header:
+            raise ValueError(f"{file_name} has several subject IDs but no CHAN column")
+        chan_index = header.index('CHAN')
+
+        # Skip the formatting rows
+        rows_in = sum(1 for _ in itertools.islice(rows, profile.formatting_rows))
+        rows_out = 0
+        writers = {}
+        output_paths = []
+        for row in rows:
+            rows_in += 1
+            channel = row[chan_index].strip() if len(row) > chan_index else ''
+            if not channel.isdigit():
+                continue
+            if channel not in writers:
+                if channel not in subject_ids:
+                    raise ValueError(f"Channel {channel} of {file_name} has no subject ID in the metadata")
+                output_path = os.path.join(output_directory, f"{base_name}_ID{subject_ids[channel]}{ext.lower()}")
+                output_file = outputs.enter_context(open(output_path, 'w', newline=''))
+                writers[channel] = csv.writer(output_file, lineterminator=os.linesep)
+                writers[channel].writerow(header)
+                output_paths.append(output_path)
+            # Short rows are padded and missing values written as empty fields, as pandas would
+            writers[channel].writerow([value if value not in na_values else '' for value in row]
+                                      + [''] * (len(header) - len(row)))
+            rows_out += 1
+        step.update(rows_in=rows_in, rows_out=rows_out, output_path=output_paths)
+
+    print(f"Cleaning {file_name}: {len(output_paths)} subjects")
+    return output_paths
+
+
+def clean_clams_export(file_path, output_directory):
+    """Clean a raw export into one cleaned file per subject, splitting exports that hold several channels.
+
+    Parameters:
+    file_path (string): path to the raw .csv file exported by Oxymax-CLAMS
+    output_directory (string): directory to save the cleaned files to
+
+    Returns:
+    list of str: paths of the cleaned files
+    """
+    profile = get_profile(file_path)
+    subject_ids = channel_subject_ids(read_export_metadata(file_path, profile.metadata_lines))
+    if subject_ids is None:
+        return [clean_clams_file(file_path, output_directory, profile)]
+    return split_clams_file(file_path, output_directory, subject_ids, profile)
+
+
+def clean_all_clams_data(directory_path):
+    """Reformat all CLAMS data files (.csv) in the provided directory by dropping unnecessary rows.
+
+    Parameters:
+    directory_path (string): directory containing .csv files to clean
+
+    Returns:
+    Nothing. Prints new filenames saved to "Cleaned_CLAMS_data" directory.
+    """
 
     # Create the output directory if it doesn't exist
     output_directory = os.path.join(directory_path, "Cleaned_CLAMS_data")
@@ -57,7 +173,7 @@ def clean_all_clams_data(directory_path):
         csv_files = [file_path for file_path in all_files if csv_pattern.search(file_path)]
 
         for file_path in csv_files:
-            clean_file(file_path, output_directory)
+            clean_clams_export(file_path, output_directory)
 
 
 def quality_control(directory_path):
@@ -94,7 +210,7 @@ def quality_control(directory_path):
         # Build the full file path before reading it
         file_path = os.path.join(cleaned_directory, file)
         try:
-            df = pd.read_csv(file_path)
+            df = read_csv(file_path)
         except Exception as e:
             print(f"Error reading {file_path}: {e}")
             continue
@@ -121,46 +237,35 @@ def quality_control(directory_path):
         # Save the quality-controlled file to the QC_Filtered directory.
         out_filename = os.path.join(qc_dir, file)
         try:
-            df_qc.to_csv(out_filename, index=False)
+            write_csv(df_qc, out_filename)
             dropped_rows = len(df) - len(df_qc)
             print(f"Processed '{file}': dropped {dropped_rows} rows; saved QC file to '{out_filename}'.")
         except Exception as e:
             print(f"Error writing quality-controlled file for {file}: {e}")
 
 
-def trim_all_clams_data(directory_path, trim_hours, keep_hours, start_dark):
-    """Trims all cleaned CLAMS data files in the specified directory.
+def trim_clams_file(file_path, trimmed_directory, trim_hours, keep_hours, start_dark, df=None, writer=None):
+    """Trim an individual cleaned CLAMS data file and save it to trimmed_directory.
 
     Parameters:
-    directory_path (string): path to the directory containing cleaned .csv files
+    file_path (string): path to the cleaned .csv file
+    trimmed_directory (string): directory to save the trimmed file to
     trim_hours (int): number of hours to trim from the beginning
     keep_hours (int): number of hours to keep in the resulting file
+    start_dark (bool): start the kept data at a dark cycle instead of a light cycle
+    df (DataFrame): the cleaned file if it was already read, see clams_io.read_ahead
+    writer (WriteBehind): writer to queue the trimmed file to, it is written before returning by default
 
     Returns:
-    Nothing. Saves the trimmed data to new CSV files in the "Trimmed_CLAMS_data" directory.
+    string: path of the trimmed file
     """
-
-    # Create a new directory for trimmed files if it doesn't exist
-    trimmed_directory = os.path.join(directory_path, "Trimmed_CLAMS_data")
-    if not os.path.exists(trimmed_directory):
-        os.makedirs(trimmed_directory)
-
-    # Get the path to the cleaned data files
-    # qc_directory = os.path.join(directory_path, "QC_Filtered")
-    qc_directory = os.path.join(directory_path, "Cleaned_CLAMS_data")
-
-    # List all files in the directory
-    files = [f for f in os.listdir(qc_directory) if
-             os.path.isfile(os.path.join(qc_directory, f)) and f.endswith('.csv')]
-
-    for file in files:
-        file_path = os.path.join(qc_directory, file)
-
-        # Read the cleaned CSV file
-        df = pd.read_csv(file_path)
+    with file_step('trim', file_path) as step:
+        # Read the cleaned CSV file, unless it was read ahead
+        if df is None:
+            df = read_csv(file_path)
 
         # Convert the 'DATE/TIME' column to datetime format
-        df['DATE/TIME'] = pd.to_datetime(df['DATE/TIME'], errors='coerce')
+        df['DATE/TIME'] = parse_datetimes(df['DATE/TIME'], errors='coerce')
 
         # Calculate the starting timestamp after trimming
         start_index = df[df['DATE/TIME'] >= df['DATE/TIME'].iloc[0] + timedelta(hours=trim_hours)].index[0]
@@ -181,7 +286,7 @@ def trim_all_clams_data(directory_path, trim_hours, keep_hours, start_dark):
         # Zero columns that contain accumulative variables to appropriately account for variable trimming times
         columns_to_zero = ['ACCO2', 'ACCCO2', 'FEED1 ACC', 'WHEEL ACC']
         for col in columns_to_zero:
-                df[col] = (df[col] - df[col].iloc[start_index - 1]).round(2)
+            df[col] = (df[col] - df[col].iloc[start_index - 1]).round(2)
 
         # Calculate the ending timestamp
         end_time = df['DATE/TIME'].iloc[start_index] + timedelta(hours=keep_hours)
@@ -191,24 +296,87 @@ def trim_all_clams_data(directory_path, trim_hours, keep_hours, start_dark):
 
         # Save the resulting data to a new CSV file in the "Trimmed_CLAMS_data" directory
         file_name = os.path.basename(file_path)
-        base_name, ext = os.path.splitext(file)
+        base_name, ext = os.path.splitext(file_name)
         ext = ext.lower()
         new_file_name = os.path.join(trimmed_directory, f"{base_name}_trimmed{ext}")
-        df_result.to_csv(new_file_name, index=False)
-        print(f"Trimming {file_name}")
+        if writer is None:
+            write_csv(df_result, new_file_name)
+            step['output_path'] = new_file_name
+        else:
+            step['pending'] = writer.write(df_result, new_file_name)
+        step.update(rows_in=len(df), rows_out=len(df_result))
+
+    print(f"Trimming {file_name}")
+    return new_file_name
 
 
-def bin_clams_data(file_path, bin_hours):
-    df = pd.read_csv(file_path)
+def trim_all_clams_data(directory_path, trim_hours, keep_hours, start_dark):
+    """Trims all cleaned CLAMS data files in the specified directory.
+
+    Parameters:
+    directory_path (string): path to the directory containing cleaned .csv files
+    trim_hours (int): number of hours to trim from the beginning
+    keep_hours (int): number of hours to keep in the resulting file
+
+    Returns:
+    Nothing. Saves the trimmed data to new CSV files in the "Trimmed_CLAMS_data" directory.
+    """
+
+    # Create a new directory for trimmed files if it doesn't exist
+    trimmed_directory = os.path.join(directory_path, "Trimmed_CLAMS_data")
+    if not os.path.exists(trimmed_directory):
+        os.makedirs(trimmed_directory)
+
+    # Get the path to the cleaned data files
+    # qc_directory = os.path.join(directory_path, "QC_Filtered")
+    qc_directory = os.path.join(directory_path, "Cleaned_CLAMS_data")
+
+    # List all files in the directory
+    files = [f for f in os.listdir(qc_directory) if
+             os.path.isfile(os.path.join(qc_directory, f)) and f.endswith('.csv')]
+
+    # The next files are read while one is trimmed and the trimmed files are written behind. Leaving the block waits
+    # for the writes, the bin stage reads them.
+    file_paths = [os.path.join(qc_directory, file) for file in files]
+    with WriteBehind() as writer:
+        for file_path, df in read_ahead(file_paths):
+            trim_clams_file(file_path, trimmed_directory, trim_hours, keep_hours, start_dark, df, writer)
+
+
+# Columns dropped before binning
+DROPPED_COLUMNS = ["STATUS1", "O2IN", "O2OUT", "DO2", "CO2IN", "CO2OUT", "DCO2", "XTOT", "YTOT", "LED HUE",
+                   "LED SATURATION", "BIN"]
+
+# Columns to retain the last value in the bin
+LAST_VALUE_COLUMNS = ["INTERVAL", "CHAN", "DATE/TIME", "ACCO2", "ACCCO2", "FEED1 ACC", "WHEEL ACC", "AMB ACC"]
+
+# Columns to sum within the bin
+SUM_COLUMNS = ["WHEEL", "FEED1", "AMB"]
+
+# Columns of the binned files, in order
+BINNED_COLUMNS = ["CHAN", "INTERVAL_start", "INTERVAL_end", "DATE/TIME_start", "DATE/TIME_end", "DURATION",
+                  "VO2", "ACCO2", "VCO2", "ACCCO2", "RER", "HEAT", "FLOW", "PRESSURE", "FEED1", "FEED1 ACC",
+                  "AMB", "AMB ACC", "WHEEL", "WHEEL ACC", "ENCLOSURE TEMP", "ENCLOSURE SETPOINT", "LED LIGHTNESS",
+                  "DAY", "HOUR", "24 HOUR"]
+
+
+def bin_clams_frame(df, bin_hours):
+    """Bin a trimmed CLAMS data frame into bins of bin_hours within each light cycle.
+
+    Parameters:
+    df (DataFrame): trimmed CLAMS data
+    bin_hours (int): size of the bins in hours
+
+    Returns:
+    DataFrame: one row per bin
+    """
     bin_hours = int(bin_hours)
 
     # Convert 'DATE/TIME' column to datetime format
-    df['DATE/TIME'] = pd.to_datetime(df['DATE/TIME'])
+    df['DATE/TIME'] = parse_datetimes(df['DATE/TIME'])
 
     # Drop unnecessary columns
-    columns_to_drop = ["STATUS1", "O2IN", "O2OUT", "DO2", "CO2IN", "CO2OUT", "DCO2", "XTOT", "YTOT", "LED HUE",
-                       "LED SATURATION", "BIN"]
-    df = df.drop(columns=columns_to_drop, errors='ignore')
+    df = df.drop(columns=DROPPED_COLUMNS, errors='ignore')
 
     # Add AMB & AMB ACC columns to the original dataframe
     df['AMB'] = df['XAMB'] + df['YAMB']
@@ -232,19 +400,13 @@ def bin_clams_data(file_path, bin_hours):
 
         df.loc[subset.index, 'BIN'] = bin_labels
 
-    # Columns to retain the last value in the bin
-    last_val_columns = ["INTERVAL", "CHAN", "DATE/TIME", "ACCO2", "ACCCO2", "FEED1 ACC", "WHEEL ACC", "AMB ACC"]
-
-    # Columns to sum within the bin
-    sum_columns = ["WHEEL", "FEED1", "AMB"]
-
     # Columns to average (excluding the ones we're taking the last value or summing)
-    avg_columns = df.columns.difference(last_val_columns + sum_columns + ['BIN', 'LED LIGHTNESS'])
+    avg_columns = df.columns.difference(LAST_VALUE_COLUMNS + SUM_COLUMNS + ['BIN', 'LED LIGHTNESS'])
 
     # Group by "LED LIGHTNESS" and "BIN" and calculate the mean, sum, or last value as appropriate
-    df_binned = df.groupby(['LED LIGHTNESS', 'BIN']).agg({**{col: 'last' for col in last_val_columns},
+    df_binned = df.groupby(['LED LIGHTNESS', 'BIN']).agg({**{col: 'last' for col in LAST_VALUE_COLUMNS},
                                                           **{col: 'mean' for col in avg_columns},
-                                                          **{col: 'sum' for col in sum_columns}}).reset_index()
+                                                          **{col: 'sum' for col in SUM_COLUMNS}}).reset_index()
 
     # Add start and end time columns
     start_times = df.groupby(['LED LIGHTNESS', 'BIN'])['DATE/TIME'].first().reset_index(name='DATE/TIME_start')
@@ -281,31 +443,167 @@ def bin_clams_data(file_path, bin_hours):
     df_binned['HOUR'] = (df_binned['HOUR'] + 1) * bin_hours
     df_binned['24 HOUR'] = (df_binned['24 HOUR'] + 1) * bin_hours
 
-    # Reorder columns based on your request
-    desired_order = ["CHAN", "INTERVAL_start", "INTERVAL_end", "DATE/TIME_start", "DATE/TIME_end", "DURATION",
-                     "VO2", "ACCO2", "VCO2", "ACCCO2", "RER", "HEAT", "FLOW", "PRESSURE", "FEED1", "FEED1 ACC",
-                     "AMB", "AMB ACC", "WHEEL", "WHEEL ACC", "ENCLOSURE TEMP", "ENCLOSURE SETPOINT", "LED LIGHTNESS", "DAY", "HOUR", "24 HOUR"]
-    df_binned = df_binned[desired_order]
+    # Reorder columns
+    df_binned = df_binned[BINNED_COLUMNS]
 
     # Round all variables to 4 decimal places
-    df_binned = df_binned.round(4)
+    return df_binned.round(4)
 
-    # Save the binned data to a new CSV file
-    output_path = file_path.replace(
-        "Trimmed_CLAMS_data", f"{bin_hours}hour_bins_Binned_CLAMS_data"
+
+def roll_clams_frame(df, window_hours, step_hours):
+    """Aggregate a trimmed CLAMS data frame over rolling windows of window_hours that start every step_hours.
+
+    Unlike the bins of bin_clams_frame the windows overlap and run across light cycles. The sums and means of every
+    window are differences of cumulative sums, so the cost does not depend on how much the windows overlap.
+
+    Parameters:
+    df (DataFrame): trimmed CLAMS data
+    window_hours (float): length of the windows in hours
+    step_hours (float): time between the starts of consecutive windows in hours
+
+    Returns:
+    DataFrame: one row per window with the columns of the binned files. HOUR is the end of the window in hours since
+    the start of the data and LED LIGHTNESS the mean lightness over the window.
+    """
+    if window_hours <= 0 or step_hours <= 0:
+        raise ValueError(f"Window and step must be positive, got {window_hours} and {step_hours} hours")
+
+    # Convert 'DATE/TIME' column to datetime format
+    df['DATE/TIME'] = parse_datetimes(df['DATE/TIME'])
+
+    # Drop unnecessary columns
+    df = df.drop(columns=DROPPED_COLUMNS, errors='ignore')
+
+    # Add AMB & AMB ACC columns to the original dataframe
+    df['AMB'] = df['XAMB'] + df['YAMB']
+    df['AMB ACC'] = df['AMB'].cumsum()
+
+    # Windows start every step_hours from the first sample, in whole microseconds so boundaries are exact. Only windows
+    # that end before the sample following the last one are complete.
+    elapsed = (df['DATE/TIME'] - df['DATE/TIME'].iloc[0]).to_numpy().astype('timedelta64[us]').astype(np.int64)
+    window = round(window_hours * 3600 * 10 ** 6)
+    step = round(step_hours * 3600 * 10 ** 6)
+    interval = int(np.median(np.diff(elapsed))) if len(elapsed) > 1 else 0
+    starts = np.arange(0, max(elapsed[-1] + interval - window, -1) + 1, step) if len(elapsed) else np.array([], int)
+    first = np.searchsorted(elapsed, starts, side='left')
+    end = np.searchsorted(elapsed, starts + window, side='left')
+
+    # Sums and means from cumulative sums. Columns are centred on their mean first, which keeps the cumulative sums
+    # small and the differences accurate.
+    mean_columns = [col for col in BINNED_COLUMNS if col in df.columns and col not in LAST_VALUE_COLUMNS + SUM_COLUMNS]
+    sum_columns = SUM_COLUMNS
+    values = df[mean_columns + sum_columns].to_numpy(dtype=float)
+    present = ~np.isnan(values)
+    centre = np.nan_to_num(np.nanmean(values, axis=0)) if len(values) else np.zeros(values.shape[1])
+    prefix_sums = np.vstack([np.zeros(values.shape[1]), np.cumsum(np.where(present, values - centre, 0), axis=0)])
+    prefix_counts = np.vstack([np.zeros(values.shape[1], int), np.cumsum(present, axis=0)])
+    counts = prefix_counts[end] - prefix_counts[first]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sums = prefix_sums[end] - prefix_sums[first] + counts * centre
+        means = sums / counts
+
+    df_rolled = pd.DataFrame({
+        **{col: means[:, i] for i, col in enumerate(mean_columns)},
+        **{col: sums[:, len(mean_columns) + i] for i, col in enumerate(sum_columns)},
+    })
+
+    # The last value of accumulating columns, from the last row of the window with a value
+    last_rows = end - 1
+    for col in LAST_VALUE_COLUMNS:
+        if col in BINNED_COLUMNS and col in df.columns:
+            column = df[col]
+            filled = column.ffill().to_numpy()
+            seen = np.concatenate([[0], np.cumsum(column.notna().to_numpy())])
+            df_rolled[col] = np.where(seen[end] > seen[first], filled[np.maximum(last_rows, 0)], np.nan)
+            if column.notna().all():
+                df_rolled[col] = df_rolled[col].astype(column.dtype)
+
+    # Add start and end interval and time columns and the duration in hours
+    df_rolled['INTERVAL_start'] = df['INTERVAL'].to_numpy()[np.minimum(first, len(df) - 1)]
+    df_rolled['INTERVAL_end'] = df['INTERVAL'].to_numpy()[np.maximum(last_rows, 0)]
+    df_rolled['DATE/TIME_start'] = df['DATE/TIME'].to_numpy()[np.minimum(first, len(df) - 1)]
+    df_rolled['DATE/TIME_end'] = df['DATE/TIME'].to_numpy()[np.maximum(last_rows, 0)]
+    df_rolled['DURATION'] = (df_rolled['DATE/TIME_end'] - df_rolled['DATE/TIME_start']).dt.total_seconds() / 3600
+
+    # Label each window by its end in hours, rounded so steps like 20 minutes do not leave binary fractions
+    df_rolled['HOUR'] = np.round((starts + window) / (3600 * 10 ** 6), 6)
+    df_rolled['DAY'] = np.ceil(df_rolled['HOUR'] / 24).astype(int)
+    df_rolled['24 HOUR'] = np.round(df_rolled['HOUR'] - 24 * (df_rolled['DAY'] - 1), 6)
+
+    # Drop empty windows and windows with a single sample
+    df_rolled = df_rolled[(end > first) & (df_rolled['DURATION'] != 0)].reset_index(drop=True)
+
+    # Reorder columns and round all variables to 4 decimal places
+    return df_rolled[BINNED_COLUMNS].round(4)
+
+
+def bin_label(bin_hours, step_hours=None):
+    """Return the name of the outputs of a bin size, e.g. "4hour_bins", or "3hour_rolling_0.5hour_step" for windows.
+
+    Parameters:
+    bin_hours (number): size of the bins, or length of the rolling windows, in hours
+    step_hours (number): time between the starts of rolling windows in hours, None for fixed bins
+
+    Returns:
+    string: prefix of the binned and combined directories and suffix of the binned files
+    """
+    if step_hours is None:
+        return f"{int(bin_hours)}hour_bins"
+    return f"{bin_hours:g}hour_rolling_{step_hours:g}hour_step"
+
+
+def binned_file_path(file_path, bin_hours, step_hours=None):
+    """Return the path bin_clams_data saves the binned data of a trimmed file to."""
+    label = bin_label(bin_hours, step_hours)
+    return file_path.replace(
+        "Trimmed_CLAMS_data", f"{label}_Binned_CLAMS_data"
     ).replace(
-        ".csv", f"_{bin_hours}hour_bins.csv"
+        ".csv", f"_{label}.csv"
     )
 
+
+def bin_clams_data(file_path, bin_hours, step_hours=None, df=None, writer=None):
+    """Bin a trimmed CLAMS data file and save it to the matching "Binned_CLAMS_data" directory.
+
+    Parameters:
+    file_path (string): path to the trimmed .csv file
+    bin_hours (int): size of the bins, or length of the rolling windows, in hours
+    step_hours (float): time between the starts of rolling windows in hours, None for fixed bins
+    df (DataFrame): the trimmed file if it was already read, see clams_io.read_ahead
+    writer (WriteBehind): writer to queue the binned file to, it is written before returning by default
+
+    Returns:
+    string: path of the binned file
+    """
+    if step_hours is None:
+        bin_hours = int(bin_hours)
+
+    # Save the binned data to a new CSV file
+    output_path = binned_file_path(file_path, bin_hours, step_hours)
+
     # Check if the directory exists, if not, create it
     output_directory = os.path.dirname(output_path)
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
 
-    df_binned.to_csv(output_path, index=False)
+    with file_step('bin', file_path) as step:
+        if df is None:
+            df = read_csv(file_path)
+        if step_hours is None:
+            df_binned = bin_clams_frame(df, bin_hours)
+        else:
+            df_binned = roll_clams_frame(df, bin_hours, step_hours)
+        if writer is None:
+            write_csv(df_binned, output_path)
+            step['output_path'] = output_path
+        else:
+            step['pending'] = writer.write(df_binned, output_path)
+        step.update(rows_in=len(df), rows_out=len(df_binned))
 
+    return output_path
 
-def process_directory(directory_path, bin_hours):
+
+def process_directory(directory_path, bin_hours, step_hours=None):
     # Get path to trimmed directory
     trimmed_directory = os.path.join(directory_path, "Trimmed_CLAMS_data")
 
@@ -313,11 +611,20 @@ def process_directory(directory_path, bin_hours):
     csv_files = [f for f in os.listdir(trimmed_directory) if
                  f.endswith('.csv') and os.path.isfile(os.path.join(trimmed_directory, f))]
 
-    # Process each .CSV file
-    for csv_file in csv_files:
-        file_path = os.path.join(trimmed_directory, csv_file)
-        bin_clams_data(file_path, bin_hours)
-        print(f"Binning {csv_file}")
+    # Process each .CSV file, reading the next ones ahead and writing the binned files behind. Leaving the block waits
+    # for the writes, recombine_columns reads them.
+    file_paths = [os.path.join(trimmed_directory, csv_file) for csv_file in csv_files]
+    with WriteBehind() as writer:
+        for file_path, df in read_ahead(file_paths):
+            bin_clams_data(file_path, bin_hours, step_hours, df, writer)
+            print(f"Binning {os.path.basename(file_path)}")
+
+
+# Desired output variables
+OUTPUT_VARIABLES = ['ACCCO2', 'ACCO2', 'FEED1 ACC', 'FEED1', 'RER', 'AMB', 'AMB ACC', 'VCO2', 'VO2', 'WHEEL ACC', 'WHEEL']
+
+# Columns to include in the combined output
+COMBINED_COLUMNS = ['ID', 'GROUP_LABEL', 'DAY', 'HOUR', '24 HOUR'] + OUTPUT_VARIABLES
 
 
 def extract_id_number(filename):
@@ -329,96 +636,189 @@ def extract_id_number(filename):
         return None
 
 
-def recombine_columns(directory_path, experiment_config_file, bin_hours):
-    # Use bin_hours to create a directory for each binned version
-    bin_hours = int(bin_hours)
+def load_binned_subject(file_path, config_df, selected_columns, df=None):
+    """Read one binned subject file and label it with the subject's ID and GROUP_LABEL.
 
-    # Define Combined CLAMS data directory for each bin window
-    combined_directory = os.path.join(directory_path, f"{bin_hours}hour_bins_Combined_CLAMS_data")
+    Parameters:
+    file_path (string): path to the binned .csv file, named with the subject's ID
+    config_df (DataFrame): experiment configuration with "ID" and "GROUP_LABEL" columns
+    selected_columns (list of str): columns to return, in order
+    df (DataFrame): the binned file if it was already read, see clams_io.read_ahead
+
+    Returns:
+    DataFrame: the subject's binned data restricted to selected_columns
+    """
+    with file_step('recombine', file_path) as step:
+        # Read the current .csv file into a DataFrame, unless it was read ahead
+        if df is None:
+            df = read_csv(file_path)
+
+        # Get the 'ID' number from the file name
+        file_id = extract_id_number(os.path.basename(file_path))
+
+        df = label_binned_subject(df, file_id, config_df, selected_columns)
+        step.update(rows_in=len(df), rows_out=len(df))
+
+    return df
+
+
+def label_binned_subject(df, file_id, config_df, selected_columns):
+    """Label the binned data of one subject with its ID and GROUP_LABEL.
+
+    Parameters:
+    df (DataFrame): the subject's binned data
+    file_id (string): the subject's ID
+    config_df (DataFrame): experiment configuration with "ID" and "GROUP_LABEL" columns
+    selected_columns (list of str): columns to return, in order
+
+    Returns:
+    DataFrame: the labelled data restricted to selected_columns
+    """
+    # Find the GROUP_LABEL for the current ID
+    group_label = config_df[config_df['ID'] == int(file_id)]['GROUP_LABEL'].values
+    if len(group_label) > 0:
+        group_label = group_label[0]
+    else:
+        group_label = ""
+
+    # Add columns 'ID', 'DAY', 'HOUR', '24 HOUR'
+    df['ID'] = file_id
+    df['GROUP_LABEL'] = group_label
+    df['DAY'] = df['DAY'].astype(int)
+    for column in ['HOUR', '24 HOUR']:
+        # Rolling windows stepped by fractions of an hour end between whole hours
+        if (df[column] % 1 == 0).all():
+            df[column] = df[column].astype(int)
+
+    # Filter and reorder columns
+    return df[selected_columns]
+
+
+def combine_subjects(subject_frames):
+    """Stack the binned data of several subjects, as returned by load_binned_subject, into one CombinedArray."""
+    return CombinedArray.from_subjects(subject_frames, OUTPUT_VARIABLES)
+
+
+def write_combined_columns(combined_data, combined_directory):
+    """Save the combined data of all subjects to one .csv file per output variable in combined_directory.
+
+    The group summaries of every output variable are saved to the Group_Summaries subdirectory, see
+    write_group_summaries.
+
+    Parameters:
+    combined_data (CombinedArray): the combined data, as returned by combine_subjects
+    combined_directory (string): directory to write the .csv files to
+    """
     if not os.path.exists(combined_directory):
         os.makedirs(combined_directory)
 
-    # Define input directory
-    input_directory = os.path.join(directory_path, f"{bin_hours}hour_bins_Binned_CLAMS_data")
+    # Slice the combined data by the output variables and save to separate .csv files, written while the next
+    # variables and the group summaries are computed
+    with WriteBehind() as writer:
+        for variable in OUTPUT_VARIABLES:
+            output_filename = os.path.join(combined_directory, f"{variable}.csv")
+            writer.write(combined_data.variable(variable), output_filename)
 
-    # Desired output variables
-    output_variables = ['ACCCO2', 'ACCO2', 'FEED1 ACC', 'FEED1', 'RER', 'AMB', 'AMB ACC', 'VCO2', 'VO2', 'WHEEL ACC', 'WHEEL']
+        write_group_summaries(combined_data, os.path.join(combined_directory, "Group_Summaries"))
 
-    # Define columns to include in the output
-    selected_columns = ['ID', 'GROUP_LABEL', 'DAY', 'HOUR', '24 HOUR'] + output_variables
 
-    # Read the experiment configuration
-    config_df = pd.read_csv(experiment_config_file)
-    print(f'CONFIGRESULTS: {config_df.columns}')
+def write_group_summaries(combined_data, summary_directory):
+    """Save the mean, SD, SEM and N of every group per DAY and HOUR to one .csv file per output variable.
 
-    # Create an empty DataFrame to store the combined data
-    combined_data = pd.DataFrame(columns=selected_columns)
+    Parameters:
+    combined_data (CombinedArray): the combined data, as returned by combine_subjects
+    summary_directory (string): directory to write the .csv files to
+    """
+    os.makedirs(summary_directory, exist_ok=True)
 
-    # Loop through all files in the specified directory
-    for filename in os.listdir(input_directory):
-        if filename.endswith(".csv"):
-            file_path = os.path.join(input_directory, filename)
-            # Read the current .csv file into a DataFrame
-            df = pd.read_csv(file_path)
+    # All variables and bins of a group are summarized in one pass over its subjects
+    with WriteBehind() as writer:
+        for variable, summary in combined_data.group_summary().items():
+            writer.write(summary, os.path.join(summary_directory, f"{variable}.csv"))
+    print(f"Summarizing groups to {summary_directory}")
 
-            # Get the 'ID' number from the file name
-            file_id = extract_id_number(filename)
 
-            # Find the GROUP_LABEL for the current ID
-            group_label = config_df[config_df['ID'] == int(file_id)]['GROUP_LABEL'].values
-            if len(group_label) > 0:
-                group_label = group_label[0]
-            else:
-                group_label = ""
+def recombine_columns(directory_path, experiment_config_file, bin_hours, step_hours=None):
+    # Use bin_hours to create a directory for each binned version
+    label = bin_label(bin_hours, step_hours)
+
+    # Define Combined CLAMS data directory for each bin window
+    combined_directory = os.path.join(directory_path, f"{label}_Combined_CLAMS_data")
 
-            # Add columns 'ID', 'DAY', 'HOUR', '24 HOUR'
-            df['ID'] = file_id
-            df['GROUP_LABEL'] = group_label
-            df['DAY'] = df['DAY'].astype(int)
-            df['HOUR'] = df['HOUR'].astype(int)
-            df['24 HOUR'] = df['24 HOUR'].astype(int)
+    # Define input directory
+    input_directory = os.path.join(directory_path, f"{label}_Binned_CLAMS_data")
 
-            # Filter and reorder columns
-            df = df[selected_columns]
+    # Read the experiment configuration
+    config_df = read_csv(experiment_config_file)
+    print(f'CONFIGRESULTS: {config_df.columns}')
 
-            # Append the data to the combined DataFrame
-            combined_data = pd.concat([combined_data, df], ignore_index=True)
+    # Read every subject in the specified directory, the combined data is returned for reformatting
+    file_paths = [os.path.join(input_directory, filename) for filename in os.listdir(input_directory)
+                  if filename.endswith(".csv")]
+    subject_frames = []
+    for file_path, df in read_ahead(file_paths):
+        subject_frames.append(load_binned_subject(file_path, config_df, COMBINED_COLUMNS, df))
 
-    # Group the combined data by the output variables and save to separate .csv files
-    for variable in output_variables:
-        output_filename = os.path.join(combined_directory, f"{variable}.csv")
-        variable_data = combined_data[['ID', 'GROUP_LABEL', 'DAY', 'HOUR', '24 HOUR', variable]]
-        variable_data.to_csv(output_filename, index=False)
+    combined_data = combine_subjects(subject_frames)
+    write_combined_columns(combined_data, combined_directory)
+    return combined_data
 
 
 def reformat_csv(input_csv_path, output_csv_path):
     """Reformat a CLAMS CSV file to a "tidy" format."""
-    df = pd.read_csv(input_csv_path)
+    with file_step('reformat', input_csv_path) as step:
+        df = read_csv(input_csv_path)
+
+        # Replace missing values in "GROUP_LABEL" with a placeholder value
+        df["GROUP_LABEL"].fillna("NO_LABEL", inplace=True)
 
-    # Replace missing values in "GROUP_LABEL" with a placeholder value
-    df["GROUP_LABEL"].fillna("NO_LABEL", inplace=True)
+        # Extract the name of the last column
+        last_column_name = df.columns[-1]
 
-    # Extract the name of the last column
-    last_column_name = df.columns[-1]
+        # Pivot the table using "ID", "GROUP_LABEL", "DAY", and "24 HOUR" as indices
+        pivot_table = df.pivot_table(index=["ID", "GROUP_LABEL", "DAY"],
+                                     columns="24 HOUR", values=last_column_name,
+                                     aggfunc="first").reset_index()
 
-    # Pivot the table using "ID", "GROUP_LABEL", "DAY", and "24 HOUR" as indices
-    pivot_table = df.pivot_table(index=["ID", "GROUP_LABEL", "DAY"],
-                                 columns="24 HOUR", values=last_column_name,
-                                 aggfunc="first").reset_index()
+        # Flatten the column index and rename columns
+        pivot_table.columns = ["ID", "GROUP_LABEL", "DAY"] + [f"{last_column_name}_{hour}" for hour in
+                                                              pivot_table.columns[3:]]
 
-    # Flatten the column index and rename columns
-    pivot_table.columns = ["ID", "GROUP_LABEL", "DAY"] + [f"{last_column_name}_{hour}" for hour in
-                                                          pivot_table.columns[3:]]
+        # Save the pivot table to a new CSV file
+        write_csv(pivot_table, output_csv_path)
+        step.update(rows_in=len(df), rows_out=len(pivot_table), output_path=output_csv_path)
 
-    # Save the pivot table to a new CSV file
-    pivot_table.to_csv(output_csv_path, index=False)
+
+def reformat_combined_data(combined_data, variable, output_csv_path, writer=None):
+    """Save one variable of the combined data in the "tidy" format of reformat_csv, sliced from the array.
+
+    The file is queued to writer if given, see clams_io.WriteBehind, otherwise it is written before returning.
+    """
+    with file_step('reformat', output_csv_path) as step:
+        wide = combined_data.wide(variable)
+        if writer is None:
+            write_csv(wide, output_csv_path)
+            step['output_path'] = output_csv_path
+        else:
+            step['pending'] = writer.write(wide, output_csv_path)
+        step.update(rows_in=int(combined_data.present.sum()), rows_out=len(wide))
 
 
 # Function to process all CSV files in a directory
-def reformat_csvs_in_directory(input_dir):
+def reformat_csvs_in_directory(input_dir, combined_data=None):
     output_dir = os.path.join(input_dir, "Reformatted_CSVs")
     os.makedirs(output_dir, exist_ok=True)
 
+    # The combined data returned by recombine_columns is reformatted without reading its files back
+    if combined_data is not None:
+        with WriteBehind() as writer:
+            for variable in OUTPUT_VARIABLES:
+                filename = f"{variable}.csv"
+                reformat_combined_data(combined_data, variable, os.path.join(output_dir, f"reformatted_{filename}"),
+                                       writer)
+                print(f"Reformatting '{filename}' to reformatted_'{filename}'")
+        return
+
     for filename in os.listdir(input_dir):
         if filename.endswith(".csv"):
             input_csv_path = os.path.join(input_dir, filename)
@@ -426,3 +826,307 @@ def reformat_csvs_in_directory(input_dir):
             reformat_csv(input_csv_path, output_csv_path)
             print(f"Reformatting '{filename}' to reformatted_'{filename}'")
 
+
+# Engines that implement the steps of run_pipeline
+ENGINES = ('pandas', 'polars')
+
+
+def get_engine(name=None):
+    """Return the object providing the pipeline steps of an engine.
+
+    Parameters:
+    name (string): "pandas" or "polars", defaults to the CLAMS_ENGINE environment variable or "pandas"
+
+    Returns:
+    object: with the clean_all_clams_data, trim_all_clams_data, process_directory, recombine_columns and
+        reformat_csvs_in_directory steps
+    """
+    if name is None:
+        name = os.environ.get('CLAMS_ENGINE', 'pandas')
+    if name not in ENGINES:
+        raise ValueError(f"Unknown engine {name!r}, expected one of: {', '.join(ENGINES)}")
+    if name == 'pandas':
+        return sys.modules[__name__]
+
+    try:
+        from clams_polars import PolarsEngine
+    except ImportError:
+        raise ImportError("The polars engine requires polars and pyarrow, install them with: "
+                          "pip install polars pyarrow")
+    return PolarsEngine()
+
+
+def warm_up():
+    """Load the modules the configured engine and CSV backend use, e.g. in a worker before it forks its processes.
+
+    A small file is written, read back and its timestamps parsed, which imports the parts of pandas (and pyarrow) that
+    are only loaded on first use.
+    """
+    get_engine()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'warm_up.csv')
+        write_csv(pd.DataFrame({'DATE/TIME': ['01/01/2024 10:00:00 AM', '01/01/2024 10:00:07 AM'], 'VO2': [1.0, 2.0]}),
+                  path)
+        parse_datetimes(read_csv(path)['DATE/TIME'])
+
+
+def run_pipeline(directory_path, trim_hours, keep_hours, bin_hours, start_dark, experiment_config_file=None,
+                 progress_callback=None, engine=None, rolling_windows=None, combined_callback=None):
+    """Clean, trim, bin, recombine and reformat all CLAMS data files in the provided directory.
+
+    Parameters:
+    directory_path (string): directory containing the raw .csv files
+    trim_hours (int): number of hours to trim from the beginning of the cleaned data
+    keep_hours (int): number of hours to keep in the trimmed data
+    bin_hours (list of int): sizes of the bins in hours, each processed into its own set of directories
+    start_dark (bool): start the kept data at a dark cycle instead of a light cycle
+    experiment_config_file (string): path to the experiment configuration file, defaults to
+        "config/experiment_config.csv" inside directory_path
+    progress_callback (callable): called as progress_callback(step, completed, total) before every step and with
+        step None once all steps are done. An exception raised by the callback stops the pipeline.
+    engine (string): "pandas" or "polars", see get_engine. Both produce identical files.
+    rolling_windows (list of tuple): (window_hours, step_hours) of rolling windows, each processed into its own set of
+        directories after the fixed bins
+    combined_callback (callable): called as combined_callback(bin_hours, step_hours, combined_data) with the
+        CombinedArray of every bin size once it is recombined, step_hours None for fixed bins, e.g. to load the
+        results into a database
+
+    Returns:
+    Nothing. Saves the output of every stage to its directory inside directory_path.
+    """
+    if experiment_config_file is None:
+        experiment_config_file = os.path.join(directory_path, 'config', 'experiment_config.csv')
+    steps = get_engine(engine)
+
+    # Clean and trim, then bin, recombine and reformat for every bin size and rolling window
+    bin_sizes = [(bin_hour, None) for bin_hour in bin_hours] + [tuple(window) for window in rolling_windows or []]
+    total_steps = 2 + 3 * len(bin_sizes)
+    completed_steps = 0
+
+    def advance(step):
+        nonlocal completed_steps
+        if progress_callback is not None:
+            progress_callback(step, completed_steps, total_steps)
+        completed_steps += 1
+
+    advance('clean')
+    with stage('clean'):
+        steps.clean_all_clams_data(directory_path)
+    # quality_control(directory_path)
+    advance('trim')
+    with stage('trim'):
+        steps.trim_all_clams_data(directory_path, trim_hours, keep_hours, start_dark)
+
+    # Loop through the bin hours and process the data
+    for bin_hour, step_hours in bin_sizes:
+        name = f'{bin_hour}h' if step_hours is None else f'{bin_hour:g}h rolling every {step_hours:g}h'
+        fields = {'bin_hours': bin_hour} if step_hours is None else {'bin_hours': bin_hour, 'step_hours': step_hours}
+        advance(f'bin {name}')
+        with stage('bin', **fields):
+            steps.process_directory(directory_path, bin_hour, step_hours)
+        advance(f'recombine {name}')
+        with stage('recombine', **fields):
+            combined_data = steps.recombine_columns(directory_path, experiment_config_file, bin_hour, step_hours)
+        if combined_callback is not None:
+            combined_callback(bin_hour, step_hours, combined_data)
+        advance(f'reformat {name}')
+        with stage('reformat', **fields):
+            steps.reformat_csvs_in_directory(
+                os.path.join(directory_path, f'{bin_label(bin_hour, step_hours)}_Combined_CLAMS_data'), combined_data)
+
+    if progress_callback is not None:
+        progress_callback(None, total_steps, total_steps)
+
+
+# Subjects processed at the same time by stream_pipeline by default
+MAX_SUBJECTS_IN_FLIGHT = 2
+
+
+def cleaned_subjects(directory_path):
+    """Yield the path of every cleaned subject file, cleaning the raw exports one at a time as they are consumed.
+
+    As in clean_all_clams_data, the files of an existing "Cleaned_CLAMS_data" directory are used instead of cleaning
+    the raw exports again.
+
+    Parameters:
+    directory_path (string): directory containing the raw .csv files
+
+    Yields:
+    string: path of a cleaned subject file
+    """
+    output_directory = os.path.join(directory_path, "Cleaned_CLAMS_data")
+    if os.path.exists(output_directory):
+        for f in os.listdir(output_directory):
+            if os.path.isfile(os.path.join(output_directory, f)) and f.endswith('.csv'):
+                yield os.path.join(output_directory, f)
+        return
+
+    os.makedirs(output_directory)
+    csv_pattern = re.compile(r"\.csv$", re.IGNORECASE)
+    csv_files = [file_path for file_path in glob.iglob(os.path.join(directory_path, "*"))
+                 if csv_pattern.search(file_path)]
+    for file_path in csv_files:
+        yield from clean_clams_export(file_path, output_directory)
+
+
+def process_subject(file_path, trimmed_directory, trim_hours, keep_hours, start_dark, bin_sizes, config_df):
+    """Trim and bin one cleaned subject file for every bin size and label its binned data.
+
+    The trimmed file is read once for all bin sizes. The binned files are read back before labelling, so the combined
+    outputs are the same as those of recombine_columns.
+
+    Parameters:
+    file_path (string): path to the cleaned .csv file
+    trimmed_directory (string): directory to save the trimmed file to
+    trim_hours (int): number of hours to trim from the beginning
+    keep_hours (int): number of hours to keep in the trimmed file
+    start_dark (bool): start the kept data at a dark cycle instead of a light cycle
+    bin_sizes (list of tuple): (bin_hours, step_hours) of every bin size, step_hours None for fixed bins
+    config_df (DataFrame): experiment configuration with "ID" and "GROUP_LABEL" columns
+
+    Returns:
+    dict: (path of the binned file, labelled binned data) by bin size
+    """
+    trimmed_path = trim_clams_file(file_path, trimmed_directory, trim_hours, keep_hours, start_dark)
+    trimmed = read_csv(trimmed_path)
+
+    binned = {}
+    for bin_hour, step_hours in bin_sizes:
+        binned_path = bin_clams_data(trimmed_path, bin_hour, step_hours, trimmed.copy())
+        print(f"Binning {os.path.basename(trimmed_path)}")
+        binned[(bin_hour, step_hours)] = (binned_path, load_binned_subject(binned_path, config_df, COMBINED_COLUMNS))
+    return binned
+
+
+def stream_subjects(directory_path, trim_hours, keep_hours, start_dark, bin_sizes, config_df, max_subjects=None):
+    """Clean, trim and bin the subjects of an experiment one by one, yielding each as soon as it is binned.
+
+    Cleaning runs as the subjects are consumed and at most max_subjects subjects are trimmed and binned at the same
+    time, on background threads, so only their data is held in memory however many subjects the experiment has.
+
+    Parameters:
+    directory_path (string): directory containing the raw .csv files
+    trim_hours (int): number of hours to trim from the beginning of the cleaned data
+    keep_hours (int): number of hours to keep in the trimmed data
+    start_dark (bool): start the kept data at a dark cycle instead of a light cycle
+    bin_sizes (list of tuple): (bin_hours, step_hours) of every bin size, step_hours None for fixed bins
+    config_df (DataFrame): experiment configuration with "ID" and "GROUP_LABEL" columns
+    max_subjects (int): subjects in flight, MAX_SUBJECTS_IN_FLIGHT by default. With 1 every subject is processed in
+        the calling thread.
+
+    Yields:
+    dict: the binned files and labelled data of a subject by bin size, see process_subject, in the order the
+        subjects were cleaned
+    """
+    if max_subjects is None:
+        max_subjects = MAX_SUBJECTS_IN_FLIGHT
+    trimmed_directory = os.path.join(directory_path, "Trimmed_CLAMS_data")
+    os.makedirs(trimmed_directory, exist_ok=True)
+    process = functools.partial(process_subject, trimmed_directory=trimmed_directory, trim_hours=trim_hours,
+                                keep_hours=keep_hours, start_dark=start_dark, bin_sizes=bin_sizes, config_df=config_df)
+
+    if max_subjects <= 1:
+        for file_path in cleaned_subjects(directory_path):
+            yield process(file_path)
+        return
+
+    # The next raw export is cleaned while the subjects submitted before it are trimmed and binned
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=max_subjects, thread_name_prefix='clams-subject') as executor:
+        try:
+            for file_path in cleaned_subjects(directory_path):
+                in_flight.append(executor.submit(process, file_path))
+                if len(in_flight) >= max_subjects:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            # Closing the generator early or a failed subject drops the subjects not started yet
+            for future in in_flight:
+                future.cancel()
+
+
+def stream_pipeline(directory_path, trim_hours, keep_hours, bin_hours, start_dark, experiment_config_file=None,
+                    progress_callback=None, rolling_windows=None, max_subjects=None, combined_callback=None):
+    """Run the pipeline subject by subject instead of stage by stage.
+
+    Every subject is cleaned, trimmed and binned for all bin sizes before the next ones are started, see
+    stream_subjects. max_subjects bounds the subjects whose raw, trimmed and binned frames are in memory at the same
+    time. As each subject finishes, its binned data is stored as a one-subject CombinedArray and its frames are
+    released. The combined outputs need every subject, so the binned values of the whole cohort are still held until
+    the bin size is combined. The trimmed and binned files are read back from disk as in the stage-by-stage pipeline,
+    so their values and dtypes match. Writes the same files as run_pipeline with the pandas engine.
+
+    Parameters:
+    directory_path (string): directory containing the raw .csv files
+    trim_hours (int): number of hours to trim from the beginning of the cleaned data
+    keep_hours (int): number of hours to keep in the trimmed data
+    bin_hours (list of int): sizes of the bins in hours, each processed into its own set of directories
+    start_dark (bool): start the kept data at a dark cycle instead of a light cycle
+    experiment_config_file (string): path to the experiment configuration file, defaults to
+        "config/experiment_config.csv" inside directory_path
+    progress_callback (callable): called as in run_pipeline, with the "subjects" step for all cleaning, trimming and
+        binning
+    rolling_windows (list of tuple): (window_hours, step_hours) of rolling windows
+    max_subjects (int): subjects in flight, see stream_subjects
+    combined_callback (callable): called with the combined data of every bin size, as in run_pipeline
+
+    Returns:
+    Nothing. Saves the output of every stage to its directory inside directory_path.
+    """
+    if experiment_config_file is None:
+        experiment_config_file = os.path.join(directory_path, 'config', 'experiment_config.csv')
+    config_df = read_csv(experiment_config_file)
+    print(f'CONFIGRESULTS: {config_df.columns}')
+
+    bin_sizes = [(bin_hour, None) for bin_hour in bin_hours] + [tuple(window) for window in rolling_windows or []]
+    total_steps = 1 + 2 * len(bin_sizes)
+    completed_steps = 0
+
+    def advance(step):
+        nonlocal completed_steps
+        if progress_callback is not None:
+            progress_callback(step, completed_steps, total_steps)
+        completed_steps += 1
+
+    # Binned data of every subject by bin size and binned file name, as arrays so the frames of finished subjects are
+    # released
+    subjects = {bin_size: {} for bin_size in bin_sizes}
+    advance('subjects')
+    with stage('subjects', max_subjects=max_subjects or MAX_SUBJECTS_IN_FLIGHT):
+        for binned in stream_subjects(directory_path, trim_hours, keep_hours, start_dark, bin_sizes, config_df,
+                                      max_subjects):
+            for bin_size, (binned_path, df) in binned.items():
+                subjects[bin_size][os.path.basename(binned_path)] = combine_subjects([df])
+            del binned
+
+    for bin_hour, step_hours in bin_sizes:
+        name = f'{bin_hour}h' if step_hours is None else f'{bin_hour:g}h rolling every {step_hours:g}h'
+        fields = {'bin_hours': bin_hour} if step_hours is None else {'bin_hours': bin_hour, 'step_hours': step_hours}
+        label = bin_label(bin_hour, step_hours)
+        input_directory = os.path.join(directory_path, f"{label}_Binned_CLAMS_data")
+        combined_directory = os.path.join(directory_path, f"{label}_Combined_CLAMS_data")
+
+        advance(f'recombine {name}')
+        with stage('recombine', **fields):
+            # Subjects in the order recombine_columns reads them, binned files of a previous run are read from disk
+            streamed = subjects.pop((bin_hour, step_hours))
+            subject_arrays = []
+            for filename in os.listdir(input_directory):
+                if filename.endswith(".csv"):
+                    array = streamed.pop(filename, None)
+                    if array is None:
+                        array = combine_subjects([load_binned_subject(os.path.join(input_directory, filename),
+                                                                      config_df, COMBINED_COLUMNS)])
+                    subject_arrays.append(array)
+            combined_data = CombinedArray.concatenate(subject_arrays) if subject_arrays else combine_subjects([])
+            del streamed, subject_arrays
+            write_combined_columns(combined_data, combined_directory)
+        if combined_callback is not None:
+            combined_callback(bin_hour, step_hours, combined_data)
+        advance(f'reformat {name}')
+        with stage('reformat', **fields):
+            reformat_csvs_in_directory(combined_directory, combined_data)
+
+    if progress_callback is not None:
+        progress_callback(None, total_steps, total_steps)
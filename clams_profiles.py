@@ -0,0 +1,355 @@
+"""Layouts of raw Oxymax-CLAMS exports and the cached plans used to parse them.
+
+Versions of the Oxymax software differ in the number of metadata lines, the columns, the units and the date format of
+their exports. get_profile recognizes the layout of an export from its first lines and returns an ExportProfile, the
+plan used to parse every export with that layout: where the column header row is, how many formatting rows follow it
+and the format of the DATE/TIME values. Profiles are cached by a signature of the header and of the date format, so the
+layout is detected and checked once per process and later files with the same signature are parsed straight away.
+Day-first and month-first exports have the same header and timestamps of the same shape, only their values tell them
+apart: when the timestamps of a layout could have the day and month in either order, the order of every export is
+chosen from the timestamps at its start, and also at its end if the start fits both orders equally.
+
+parse_datetimes parses timestamps with an explicit format instead of letting pandas infer one for every column. The
+format is that of the layout the timestamps were exported with, or the one pandas infers from the first value, cached by
+the shape of that value. When layouts with both orders of day and month have been seen, the format is chosen from the
+first and last timestamps of the column as for the exports.
+
+pandas is only imported by the functions that parse timestamps, so the web tier can check the header of an export
+without loading it.
+"""
+import csv
+import hashlib
+import itertools
+import json
+import os
+import re
+from datetime import datetime
+
+# Lines searched for the column header row
+MAX_HEADER_LINES = 200
+
+# Columns of the raw exports the binned columns (clams_processing.BINNED_COLUMNS) are computed from, AMB and AMB ACC are
+# summed from XAMB and YAMB
+EXPORT_COLUMNS = ["INTERVAL", "DATE/TIME", "CHAN", "VO2", "ACCO2", "VCO2", "ACCCO2", "RER", "HEAT", "FLOW", "PRESSURE",
+                  "FEED1", "FEED1 ACC", "WHEEL", "WHEEL ACC", "ENCLOSURE TEMP", "ENCLOSURE SETPOINT", "LED LIGHTNESS",
+                  "XAMB", "YAMB"]
+
+# Data rows whose timestamps are checked against the date format of a new layout
+DATE_SAMPLE_ROWS = 100
+
+# Signature -> ExportProfile
+_profiles = {}
+
+# Shape of the timestamps of a detected layout -> their formats, one per order of day and month seen
+_layout_date_formats = {}
+
+# Shape of a timestamp, with its numbers -> format pandas infers from it
+_date_formats = {}
+
+# Shape of a timestamp, with its numbers -> formats it could have, with the month first and with the day first
+_candidate_formats = {}
+
+
+class ExportProfile:
+    """Parse plan of one layout of raw exports.
+
+    Attributes:
+    signature (string): hash of the header, the key of the profile cache
+    metadata_lines (int): number of lines before the column header row
+    columns (list of str): column names
+    units (dict): unit of every column that has one
+    formatting_rows (int): number of rows between the column header row and the data, e.g. units and "====" rows
+    date_format (string): strptime format of the DATE/TIME values, or None if none fits them
+    """
+
+    def __init__(self, signature, metadata_lines, columns, units, formatting_rows, date_format):
+        self.signature = signature
+        self.metadata_lines = metadata_lines
+        self.columns = columns
+        self.units = units
+        self.formatting_rows = formatting_rows
+        self.date_format = date_format
+
+    def __repr__(self):
+        return (f"ExportProfile({self.signature}: {self.metadata_lines} metadata lines, {len(self.columns)} columns, "
+                f"{self.formatting_rows} formatting rows, dates as {self.date_format})")
+
+
+def _date_shape(value, numbers=False):
+    """Return the shape of a timestamp: its characters with every number replaced by its number of digits.
+
+    With numbers=True each number is also marked by whether it could be a month or a day, which is all
+    guess_datetime_format looks at besides the other characters, so timestamps of the same shape get the same guess.
+    """
+    def number_shape(match):
+        if not numbers:
+            return f"<{len(match.group())}>"
+        number = int(match.group())
+        kind = 'm' if number <= 12 else 'd' if number <= 31 else 'n'
+        return f"<{len(match.group())}{kind}>"
+
+    return re.sub(r'\d+', number_shape, value.strip())
+
+
+def _choose_format(samples, formats):
+    """Return the format that parses every sample into the shortest recording, None if none parses them all.
+
+    A format with day and month swapped parses the timestamps of the first 12 days of a month too, into a recording of
+    months instead of days, or ending before it starts.
+    """
+    spans = _format_spans(samples, formats)
+    return min(spans, key=spans.get) if spans else None
+
+
+def _format_spans(samples, formats):
+    """Return whether the samples end before they start and the time they span, by every format that parses them."""
+    spans = {}
+    for fmt in formats:
+        try:
+            parsed = [datetime.strptime(value, fmt) for value in samples]
+        except ValueError:
+            continue
+        spans[fmt] = (parsed[-1] < parsed[0], parsed[-1] - parsed[0])
+    return spans
+
+
+def _has_date(row, date_index):
+    """Return whether a CSV row is a data row, with a timestamp in its DATE/TIME column."""
+    return date_index < len(row) and any(character.isdigit() for character in row[date_index])
+
+
+def date_format(value, samples=()):
+    """Return the format of a timestamp, or None if no format can be inferred.
+
+    Timestamps shaped like those of a detected export layout get the format of that layout, others the format pandas
+    infers from them. If layouts with both orders of day and month have that shape, the format is chosen from samples.
+
+    Parameters:
+    value (string): a timestamp, e.g. "01/01/2024 10:00:07 AM"
+    samples (list of str): timestamps of the same column in order, e.g. its first and last ones
+
+    Returns:
+    string: strptime format, e.g. "%m/%d/%Y %I:%M:%S %p"
+    """
+    shape = _date_shape(value)
+    formats = _layout_date_formats.get(shape)
+    if formats:
+        if len(formats) == 1:
+            return formats[0]
+        return _choose_format([value.strip() for value in samples] or [value.strip()], formats) or formats[0]
+    key = _date_shape(value, numbers=True)
+    if key not in _date_formats:
+        from pandas.tseries.api import guess_datetime_format
+
+        _date_formats[key] = guess_datetime_format(value)
+    return _date_formats[key]
+
+
+def parse_datetimes(values, errors='raise'):
+    """Parse timestamps like pd.to_datetime, with the format of the first value looked up by date_format.
+
+    Parameters:
+    values (Series): timestamps as text, values that are already timestamps are returned as they are
+    errors (string): "raise" or "coerce", as for pd.to_datetime
+
+    Returns:
+    Series: the parsed timestamps
+    """
+    import pandas as pd
+
+    if not pd.api.types.is_string_dtype(values):
+        return pd.to_datetime(values, errors=errors)
+    first_value = values.dropna()
+    if first_value.empty or not isinstance(first_value.iloc[0], str):
+        return pd.to_datetime(values, errors=errors)
+    shape = _date_shape(first_value.iloc[0])
+    samples = []
+    if len(_layout_date_formats.get(shape, [])) > 1:
+        samples = first_value.iloc[:DATE_SAMPLE_ROWS].tolist() + first_value.iloc[-DATE_SAMPLE_ROWS:].tolist()
+        samples = [value for value in samples if isinstance(value, str) and _date_shape(value) == shape]
+    # Without a format pandas falls back to parsing each value on its own
+    return pd.to_datetime(values, format=date_format(first_value.iloc[0], samples), errors=errors)
+
+
+def file_date_format(file_path):
+    """Return the format of the DATE/TIME column of a cleaned or trimmed file, as parse_datetimes would use it.
+
+    Parameters:
+    file_path (string): path to a .csv file with a DATE/TIME column
+
+    Returns:
+    string: strptime format, or None if the file has no timestamp or no format can be inferred
+    """
+    with open(file_path, newline='') as f:
+        rows = csv.reader(f)
+        columns = next(rows, [])
+        if 'DATE/TIME' not in columns:
+            return None
+        date_index = columns.index('DATE/TIME')
+        dates = [row[date_index] for row in itertools.islice(rows, DATE_SAMPLE_ROWS) if _has_date(row, date_index)]
+    if not dates:
+        return None
+    if len(_layout_date_formats.get(_date_shape(dates[0]), [])) > 1:
+        dates += [row[date_index] for row in _tail_rows(file_path)[-DATE_SAMPLE_ROWS:]
+                  if _has_date(row, date_index) and _date_shape(row[date_index]) == _date_shape(dates[0])]
+    return date_format(dates[0], dates)
+
+
+def _tail_rows(file_path, size=16384):
+    """Return the complete CSV rows in the last size bytes of a file."""
+    with open(file_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(f.tell() - size, 0))
+        lines = f.read().decode(errors='replace').splitlines()
+    return [row for row in csv.reader(lines[1:]) if row]
+
+
+def _read_layout(file_path):
+    """Read the column header, the formatting rows and samples of the timestamps of a raw export."""
+    file_name = os.path.basename(file_path)
+    with open(file_path, 'r', newline='') as f:
+        for metadata_lines, line in enumerate(itertools.islice(f, MAX_HEADER_LINES)):
+            columns = next(csv.reader([line]), [])
+            if 'DATE/TIME' in columns:
+                break
+        else:
+            raise ValueError(f"{file_name} has no column header row with a DATE/TIME column in its first "
+                             f"{MAX_HEADER_LINES} lines, it may not be an Oxymax-CLAMS export")
+
+        # Rows up to the first one with a timestamp hold units and other formatting
+        date_index = columns.index('DATE/TIME')
+        rows = (row for row in csv.reader(f) if row)
+        formatting = []
+        dates = []
+        for row in rows:
+            if _has_date(row, date_index):
+                dates = [row[date_index]]
+                dates += [row[date_index] for row in itertools.islice(rows, DATE_SAMPLE_ROWS - 1)
+                          if _has_date(row, date_index)]
+                break
+            formatting.append(row)
+    return metadata_lines, columns, formatting, dates
+
+
+def _date_candidates(value):
+    """Return the formats a timestamp could have, with the month first and with the day first."""
+    key = _date_shape(value, numbers=True)
+    if key not in _candidate_formats:
+        from pandas.tseries.api import guess_datetime_format
+
+        candidates = []
+        for dayfirst in (False, True):
+            fmt = guess_datetime_format(value.strip(), dayfirst=dayfirst)
+            if fmt is not None and fmt not in candidates:
+                candidates.append(fmt)
+        _candidate_formats[key] = candidates
+    return _candidate_formats[key]
+
+
+def _detect_date_format(file_path, date_index, dates, candidates):
+    """Return the format of candidates that parses the sampled timestamps of an export.
+
+    pandas infers the order of day and month from the first timestamp alone, so day-first exports starting before the
+    13th are read month-first and every later day is lost. The format that parses every sample into the shortest
+    recording is kept. The timestamps at the end of the file are only read when those at its start fit several
+    candidates equally, e.g. when they all fall on one day.
+    """
+    samples = [value.strip() for value in dates]
+    spans = _format_spans(samples, candidates)
+    if len(spans) > 1 and len(set(spans.values())) == 1:
+        tail_dates = [row[date_index] for row in _tail_rows(file_path) if _has_date(row, date_index)]
+        samples += [value.strip() for value in tail_dates[-DATE_SAMPLE_ROWS:]]
+        spans = _format_spans(samples, candidates)
+
+    file_name = os.path.basename(file_path)
+    if spans:
+        return min(spans, key=spans.get)
+    if candidates:
+        print(f"Some timestamps of {file_name} do not match the date format {candidates[0]}, they are dropped")
+        return candidates[0]
+    print(f"Could not detect the date format of {file_name} from {samples[0]!r}, timestamps will be parsed one by one")
+    return None
+
+
+def _signature(layout, fmt):
+    """Return the key of the profile cache, a hash of the layout and of the format of its timestamps."""
+    return hashlib.sha1(json.dumps(layout + [fmt]).encode()).hexdigest()[:12]
+
+
+def get_profile(file_path):
+    """Return the parse plan of a raw export, detecting its layout if no export with the same header was seen before.
+
+    The date format is part of the signature: exports with the same header but another order of day and month get
+    their own profile. It is only detected from the sampled timestamps when the first timestamp of the export could
+    have the day and month in either order, other exports of a known layout get its profile straight away.
+
+    Parameters:
+    file_path (string): path to the raw .csv file exported by Oxymax-CLAMS
+
+    Returns:
+    ExportProfile: the parse plan of the layout of the export
+    """
+    metadata_lines, columns, formatting, dates = _read_layout(file_path)
+    date_shape = _date_shape(dates[0]) if dates else None
+    layout = [metadata_lines, columns, formatting, date_shape]
+    candidates = _date_candidates(dates[0]) if dates else []
+
+    # When the first timestamp fits a single format, the timestamps are only checked in the first export of the layout
+    if len(candidates) == 1 and _signature(layout, candidates[0]) in _profiles:
+        return _profiles[_signature(layout, candidates[0])]
+    fmt = _detect_date_format(file_path, columns.index('DATE/TIME'), dates, candidates) if dates else None
+    signature = _signature(layout, fmt)
+    if signature in _profiles:
+        return _profiles[signature]
+
+    units_row = next((row for row in formatting if any(value.strip().strip('=') for value in row)), [])
+    units = {column: unit.strip() for column, unit in zip(columns, units_row) if unit.strip()}
+    if fmt is not None:
+        # Cleaned files keep the timestamps of the export, their format is looked up by shape
+        formats = _layout_date_formats.setdefault(date_shape, [])
+        if fmt not in formats:
+            formats.append(fmt)
+
+    profile = ExportProfile(signature, metadata_lines, columns, units, len(formatting), fmt)
+    _profiles[signature] = profile
+    print(f"Detected export layout {profile}")
+    return profile
+
+
+def read_export_metadata(file_path, metadata_lines):
+    """Read the metadata lines at the top of a raw Oxymax-CLAMS export.
+
+    Parameters:
+    file_path (string): path to the raw .csv file exported by Oxymax-CLAMS
+    metadata_lines (int): number of lines before the column header row, see ExportProfile
+
+    Returns:
+    dict: name of every metadata line -> list of the non-empty values that follow it
+    """
+    metadata = {}
+    with open(file_path, 'r', newline='') as f:
+        for row in csv.reader(itertools.islice(f, metadata_lines)):
+            if row:
+                metadata[row[0].strip()] = [value.strip() for value in row[1:] if value.strip()]
+    return metadata
+
+
+def channel_subject_ids(metadata):
+    """Return the subject ID of every channel of an export holding several channels.
+
+    Multi-channel exports list one value per channel on their "Subject ID" line, in the order of the channels on their
+    "Channel" (or "Cage") line.
+
+    Parameters:
+    metadata (dict): metadata of the export, see read_export_metadata
+
+    Returns:
+    dict: subject ID by channel number, or None if the export holds a single subject
+    """
+    subject_ids = metadata.get('Subject ID', [])
+    if len(subject_ids) < 2:
+        return None
+    channels = metadata.get('Channel') or metadata.get('Cage') or []
+    if len(channels) != len(subject_ids):
+        raise ValueError(f"Found {len(subject_ids)} subject IDs but {len(channels)} channels in the metadata")
+    return dict(zip(channels, subject_ids))
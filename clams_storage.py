@@ -0,0 +1,501 @@
+"""Storage of uploads and results, on the local filesystem or in an S3-compatible object store.
+
+The web app writes uploads to the storage and serves the zipped results from it, and the workers fetch the uploads into
+a local workspace, run the pipeline there and store the zipped results. Web and worker nodes therefore only share the
+storage, not a filesystem, and the many small reads and writes of the pipeline stay on the local disk of the worker.
+
+Objects are named by keys with "/" separators, e.g. "<upload_id>/config/experiment_config.csv". open_storage returns the
+backend for a URL:
+    - a path, or file:///path, for LocalStorage: keys are paths below that directory
+    - s3://bucket/prefix for S3Storage, which requires boto3. Set endpoint_url for other S3-compatible stores such as
+      MinIO.
+
+Both backends stream reads and writes, so files are never held in memory as a whole. Fetched inputs can be cached on
+the worker by their key and version, so an upload processed again is not downloaded again.
+
+Uploaded files are stored once per content, as blobs named by their SHA-256 digest ("blobs/<2 digits>/<digest>"). An
+upload holds references to its blobs, empty objects "refs/<upload_id>/<digest>/<name>", and in a local storage also
+hard links to them at "<upload_id>/<name>" so it can be processed in place. collect_garbage deletes the blobs no
+upload references.
+"""
+import contextlib
+import hashlib
+import io
+import os
+import re
+import shutil
+import tempfile
+import time
+
+# Size of the chunks streamed to and from the storage
+CHUNK_SIZE = 1024 * 1024
+
+# Prefixes of the blobs of uploaded files and of the references of uploads to them
+BLOB_PREFIX = 'blobs/'
+REFERENCE_PREFIX = 'refs/'
+
+
+class _AtomicWriter(io.FileIO):
+    """File written under a temporary name and renamed when closed, so readers never see a partial file."""
+
+    def __init__(self, path):
+        fd, self._temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+        os.chmod(self._temporary, 0o644)
+        super().__init__(fd, 'wb')
+        self._path = path
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            os.replace(self._temporary, self._path)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and not self.closed:
+            # Discard the partial file
+            super().close()
+            os.remove(self._temporary)
+        return super().__exit__(exc_type, exc_value, traceback)
+
+
+class LocalStorage:
+    """Objects stored as files below a root directory.
+
+    Attributes:
+    root (string): directory holding the objects
+    local (bool): True, files can be processed in place, see path
+    """
+    local = True
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def __repr__(self):
+        return f"LocalStorage({self.root})"
+
+    def path(self, key):
+        """Return the path of the file of a key."""
+        path = os.path.abspath(os.path.join(self.root, *key.split('/')))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise ValueError(f"Key {key!r} is outside of the storage")
+        return path
+
+    def open(self, key, mode='rb'):
+        """Open an object for reading ("rb") or writing ("wb") as a file object."""
+        path = self.path(key)
+        if 'w' in mode:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            return _AtomicWriter(path)
+        return open(path, mode)
+
+    def read_head(self, key, size):
+        """Return the first size bytes of an object."""
+        with open(self.path(key), 'rb') as f:
+            return f.read(size)
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.path(key))
+
+    def modified(self, key):
+        """Return the time an object was last written or touched, in seconds since the epoch."""
+        return os.path.getmtime(self.path(key))
+
+    def touch(self, key):
+        """Set the modification time of an object to now, return False if it does not exist."""
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def link(self, source_key, key):
+        """Make key a hard link to the file of source_key, or a copy where hard links are not supported."""
+        source, path = self.path(source_key), self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.link"
+        try:
+            os.link(source, temporary)
+        except OSError:
+            shutil.copyfile(source, temporary)
+        os.replace(temporary, path)
+
+    def list(self, prefix):
+        """Return the key, size and version of every object whose key starts with prefix.
+
+        Returns:
+        list of tuple: (key, size in bytes, version) sorted by key, the version changes whenever the object does
+        """
+        objects = []
+        directory = self.path(prefix.rstrip('/')) if prefix.rstrip('/') else self.root
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    stat = os.stat(path)
+                    objects.append((key, stat.st_size, f"{stat.st_mtime_ns}-{stat.st_size}"))
+        return sorted(objects)
+
+    def delete(self, prefix):
+        """Delete an object, or every object below prefix if it ends with "/"."""
+        path = self.path(prefix.rstrip('/'))
+        if prefix.endswith('/'):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.isfile(path):
+            os.remove(path)
+
+    def upload_file(self, file_path, key):
+        """Store a local file under key."""
+        path = self.path(key)
+        if os.path.abspath(file_path) != path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(file_path, path)
+
+    def download_file(self, key, file_path):
+        """Copy an object to a local file."""
+        shutil.copyfile(self.path(key), file_path)
+
+
+class _S3Writer(io.RawIOBase):
+    """Writable file object that buffers to a spooled temporary file and uploads it when closed."""
+
+    def __init__(self, client, bucket, key):
+        super().__init__()
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._buffer = tempfile.SpooledTemporaryFile(max_size=8 * CHUNK_SIZE)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self._buffer.write(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._buffer.seek(0)
+                # upload_fileobj sends large files in parts, without reading them into memory
+                self._client.upload_fileobj(self._buffer, self._bucket, self._key)
+            finally:
+                self._buffer.close()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and not self.closed:
+            # Discard the partial file instead of uploading it
+            self._buffer.close()
+            io.RawIOBase.close(self)
+        return super().__exit__(exc_type, exc_value, traceback)
+
+
+class S3Storage:
+    """Objects stored in a bucket of Amazon S3 or an S3-compatible object store.
+
+    Attributes:
+    bucket (string): name of the bucket
+    prefix (string): prefix added to every key, e.g. "clams/"
+    local (bool): False, objects are fetched to a workspace to be processed
+    """
+    local = False
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, client=None):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise ImportError("The S3 storage requires boto3, install it with: pip install boto3")
+            client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+
+    def __repr__(self):
+        return f"S3Storage(s3://{self.bucket}/{self.prefix})"
+
+    def _name(self, key):
+        return self.prefix + key
+
+    def open(self, key, mode='rb'):
+        """Open an object for reading ("rb") or writing ("wb") as a streaming file object."""
+        if 'w' in mode:
+            return _S3Writer(self.client, self.bucket, self._name(key))
+        return self.client.get_object(Bucket=self.bucket, Key=self._name(key))['Body']
+
+    def read_head(self, key, size):
+        """Return the first size bytes of an object, with a ranged request."""
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._name(key), Range=f'bytes=0-{size - 1}')
+        except self.client.exceptions.ClientError as e:
+            # The range of an empty object is not satisfiable
+            if e.response['Error']['Code'] == 'InvalidRange':
+                return b''
+            raise
+        return response['Body'].read()
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._name(key))
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def size(self, key):
+        return self.client.head_object(Bucket=self.bucket, Key=self._name(key))['ContentLength']
+
+    def modified(self, key):
+        """Return the time an object was last written or touched, in seconds since the epoch."""
+        return self.client.head_object(Bucket=self.bucket, Key=self._name(key))['LastModified'].timestamp()
+
+    def touch(self, key):
+        """Set the modification time of an object to now, return False if it does not exist."""
+        try:
+            # An object copied onto itself, in the store without transferring it
+            self.client.copy_object(Bucket=self.bucket, Key=self._name(key), MetadataDirective='REPLACE',
+                                    CopySource={'Bucket': self.bucket, 'Key': self._name(key)})
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def list(self, prefix):
+        """Return the key, size and version (ETag) of every object whose key starts with prefix, sorted by key."""
+        objects = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._name(prefix)):
+            for item in page.get('Contents', []):
+                objects.append((item['Key'][len(self.prefix):], item['Size'], item['ETag'].strip('"')))
+        return sorted(objects)
+
+    def delete(self, prefix):
+        """Delete an object, or every object below prefix if it ends with "/"."""
+        keys = [key for key, _, _ in self.list(prefix)] if prefix.endswith('/') else [prefix]
+        # Up to 1000 objects are deleted per request
+        for start in range(0, len(keys), 1000):
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': self._name(key)} for key in keys[start:start + 1000]], 'Quiet': True})
+
+    def upload_file(self, file_path, key):
+        self.client.upload_file(file_path, self.bucket, self._name(key))
+
+    def download_file(self, key, file_path):
+        self.client.download_file(self.bucket, self._name(key), file_path)
+
+
+def open_storage(url, endpoint_url=None):
+    """Return the storage backend for a URL.
+
+    Parameters:
+    url (string): a directory, file:///directory or s3://bucket/prefix
+    endpoint_url (string): endpoint of an S3-compatible object store, defaults to Amazon S3
+
+    Returns:
+    LocalStorage or S3Storage
+    """
+    if url.startswith('s3://'):
+        bucket, _, prefix = url[len('s3://'):].partition('/')
+        return S3Storage(bucket, prefix, endpoint_url=endpoint_url)
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    return LocalStorage(url)
+
+
+def _cache_file(cache_directory, key, version):
+    name = hashlib.sha1(f"{key}\n{version}".encode()).hexdigest()
+    return os.path.join(cache_directory, name[:2], name)
+
+
+def prune_cache(cache_directory, max_bytes):
+    """Delete the least recently used files of a worker cache until it holds at most max_bytes."""
+    files = []
+    for root, _, names in os.walk(cache_directory):
+        for name in names:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+
+
+def blob_key(digest):
+    """Return the key of the blob of a SHA-256 digest."""
+    return f"{BLOB_PREFIX}{digest[:2]}/{digest}"
+
+
+def put_blob(storage, digest, chunks):
+    """Store content as the blob of its SHA-256 digest, unless it is stored already.
+
+    Parameters:
+    storage (LocalStorage or S3Storage): storage of the blobs
+    digest (string): hexadecimal SHA-256 digest of the content
+    chunks (iterable): the content as chunks of bytes, only read when the blob is new
+
+    Returns:
+    bool: True if the blob was written, False if it was stored already
+    """
+    key = blob_key(digest)
+    # Touching a stored blob keeps collect_garbage from deleting it while it is referenced
+    if storage.touch(key):
+        return False
+    with storage.open(key, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    return True
+
+
+def store_upload_file(storage, upload_id, name, digest, chunks):
+    """Store a file of an upload as a reference to the blob of its content.
+
+    Parameters:
+    storage (LocalStorage or S3Storage): storage of the uploads
+    upload_id (string): ID of the upload
+    name (string): name of the file in the upload, e.g. "config/experiment_config.csv"
+    digest (string): hexadecimal SHA-256 digest of the content
+    chunks (iterable): the content as chunks of bytes, only read when no upload stored it before
+
+    Returns:
+    bool: True if the content was written, False if it was stored already
+    """
+    prefix = f"{REFERENCE_PREFIX}{upload_id}/"
+    # Replace the reference of an earlier file with the same name
+    for key, _, _ in storage.list(prefix):
+        reference_digest, _, reference_name = key[len(prefix):].partition('/')
+        if reference_name == name and reference_digest != digest:
+            storage.delete(key)
+    # The reference is recorded before the blob is stored, so it never looks unused to collect_garbage
+    with storage.open(f"{prefix}{digest}/{name}", 'wb'):
+        pass
+    written = put_blob(storage, digest, chunks)
+    if storage.local:
+        storage.link(blob_key(digest), f"{upload_id}/{name}")
+    return written
+
+
+def references(storage, upload_id):
+    """Return the name and blob digest of every file of an upload stored by reference, sorted by name."""
+    prefix = f"{REFERENCE_PREFIX}{upload_id}/"
+    return sorted(tuple(reversed(key[len(prefix):].split('/', 1))) for key, _, _ in storage.list(prefix))
+
+
+def delete_upload(storage, upload_id):
+    """Delete the files of an upload and its references, the blobs are left to collect_garbage."""
+    storage.delete(f"{upload_id}/")
+    storage.delete(f"{REFERENCE_PREFIX}{upload_id}/")
+
+
+def collect_garbage(storage, min_age=3600):
+    """Delete the blobs no upload references.
+
+    Parameters:
+    storage (LocalStorage or S3Storage): storage of the uploads
+    min_age (float): seconds since a blob was last stored or reused before it can be deleted, so blobs of uploads in
+        progress are kept
+
+    Returns:
+    int: number of blobs deleted
+    """
+    referenced = {key[len(REFERENCE_PREFIX):].split('/')[1] for key, _, _ in storage.list(REFERENCE_PREFIX)}
+    deleted = 0
+    for key, _, _ in storage.list(BLOB_PREFIX):
+        digest = key.rsplit('/', 1)[-1]
+        # Temporary files of blobs being written are skipped
+        if not re.fullmatch(r'[0-9a-f]{64}', digest) or digest in referenced:
+            continue
+        if time.time() - storage.modified(key) > min_age:
+            storage.delete(key)
+            deleted += 1
+    return deleted
+
+
+def fetch(storage, prefix, directory, cache_directory=None, blobs=()):
+    """Copy every object below prefix into a local directory, keeping the structure of their keys.
+
+    Parameters:
+    storage (LocalStorage or S3Storage): storage holding the objects
+    prefix (string): prefix of the keys to fetch, ending with "/"
+    directory (string): local directory to copy the objects to
+    cache_directory (string): directory of the worker cache. Objects are downloaded to the cache once per version and
+        linked into directory.
+    blobs (list): name and digest of the files stored by reference, see references. They are copied into directory
+        under their name and cached by their digest.
+
+    Returns:
+    int: number of bytes downloaded, 0 when every object was cached
+    """
+    objects = [(key, key[len(prefix):], version) for key, _, version in storage.list(prefix)]
+    objects += [(blob_key(digest), name, digest) for name, digest in blobs]
+    downloaded = 0
+    for key, name, version in objects:
+        target = os.path.join(directory, *name.split('/'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if cache_directory is None:
+            storage.download_file(key, target)
+            downloaded += os.path.getsize(target)
+            continue
+
+        cached = _cache_file(cache_directory, key, version)
+        if os.path.exists(cached):
+            # Mark as recently used for prune_cache
+            os.utime(cached)
+        else:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            # Downloaded under a temporary name so other workers never see a partial file
+            fd, temporary = tempfile.mkstemp(dir=os.path.dirname(cached))
+            os.close(fd)
+            try:
+                storage.download_file(key, temporary)
+                os.replace(temporary, cached)
+            finally:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+            downloaded += os.path.getsize(cached)
+        try:
+            os.link(cached, target)
+        except OSError:
+            shutil.copyfile(cached, target)
+    return downloaded
+
+
+@contextlib.contextmanager
+def workspace(storage, prefix, workspace_root, cache_directory=None, cache_bytes=None, blobs=()):
+    """Provide a local directory with the objects below prefix to process.
+
+    Local storage is processed in place and its outputs stay in the storage. Objects of a remote storage are fetched
+    into a new directory in workspace_root that is deleted afterwards; store the results with storage.upload_file.
+
+    Parameters:
+    storage (LocalStorage or S3Storage): storage holding the objects
+    prefix (string): prefix of the keys of the objects, ending with "/"
+    workspace_root (string): local directory to create the workspace in
+    cache_directory (string): directory of the worker cache of fetched objects, see fetch
+    cache_bytes (int): size the worker cache is pruned to after fetching
+    blobs (list): name and digest of the files stored by reference, fetched from a remote storage, see fetch
+
+    Yields:
+    string: path of the directory holding the objects
+    """
+    if storage.local:
+        yield storage.path(prefix.rstrip('/'))
+        return
+
+    os.makedirs(workspace_root, exist_ok=True)
+    # The directory is named like the prefix, as it is in a local storage, e.g. for the paths in zipped results
+    parent = tempfile.mkdtemp(dir=workspace_root)
+    directory = os.path.join(parent, *prefix.strip('/').split('/'))
+    try:
+        fetch(storage, prefix, directory, cache_directory, blobs)
+        if cache_directory is not None and cache_bytes is not None:
+            prune_cache(cache_directory, cache_bytes)
+        yield directory
+    finally:
+        shutil.rmtree(parent, ignore_errors=True)
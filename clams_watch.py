@@ -0,0 +1,410 @@
+"""Watch-folder ingestion daemon.
+
+Watches a directory tree that CLAMS acquisition PCs export into and keeps the processed outputs of every experiment up
+to date. Any directory below the watched root that directly contains raw .csv exports is treated as an experiment,
+with its configuration in config/experiment_config.csv as usual.
+
+Only new or changed exports are cleaned, trimmed and binned. The combined outputs of each bin size are rebuilt from
+per-subject results kept in memory, so a single new export does not re-read every subject. Files are processed once
+their size and modification time have not changed for --settle seconds, so partially written exports are skipped
+until the copy has finished.
+
+Changes are detected with inotify on Linux and by polling elsewhere (or with --poll).
+
+Usage:
+    python clams_watch.py /shared/clams_exports --trim 2 --keep 48 --bin 1 4 --start-cycle light
+"""
+import argparse
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import re
+import select
+import struct
+import sys
+import time
+
+from clams_batch import OUTPUT_DIRECTORY_PATTERN, parse_bin_hours, parse_start_cycle
+
+logger = logging.getLogger(__name__)
+
+CSV_PATTERN = re.compile(r"\.csv$", re.IGNORECASE)
+
+# Name of the file in an experiment's config directory recording which exports have been processed
+STATE_FILE = '.watch_state.json'
+
+
+class PollingWatcher:
+    """Wakes up every interval seconds and reports that anything may have changed."""
+
+    def __init__(self, root, interval=5.0):
+        self.root = root
+        self.interval = interval
+
+    def wait(self, timeout):
+        """Sleep and return None, meaning every directory has to be checked."""
+        time.sleep(min(timeout, self.interval))
+        return None
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Reports the directories below root in which files were written, moved or deleted, using Linux inotify."""
+
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_ISDIR = 0x40000000
+    EVENT_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, root):
+        self.root = root
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories = {}
+        for directory, dirs, _ in os.walk(root):
+            dirs[:] = [d for d in dirs if not OUTPUT_DIRECTORY_PATTERN.match(d)]
+            self._add_watch(directory)
+
+    def _add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.EVENT_MASK)
+        if wd < 0:
+            logger.warning(f"Cannot watch {directory}: {os.strerror(ctypes.get_errno())}")
+            return
+        self._directories[wd] = directory
+
+    def wait(self, timeout):
+        """Block until files change or timeout seconds pass, and return the set of directories with changes."""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        changed = set()
+        if not readable:
+            return changed
+
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, name_length = self.EVENT_HEADER.unpack_from(buffer, offset)
+            offset += self.EVENT_HEADER.size
+            name = buffer[offset:offset + name_length].rstrip(b'\0').decode(errors='replace')
+            offset += name_length
+
+            directory = self._directories.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+            if mask & self.IN_ISDIR:
+                # Watch new experiment directories as they are created
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and not OUTPUT_DIRECTORY_PATTERN.match(name):
+                    self._add_watch(path)
+                    changed.add(path)
+            else:
+                changed.add(directory)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+def create_watcher(root, poll=False, interval=5.0):
+    """Return an inotify watcher where available, otherwise a polling watcher."""
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root)
+        except OSError as e:
+            logger.warning(f"inotify unavailable ({e}), falling back to polling")
+    return PollingWatcher(root, interval)
+
+
+def find_experiments(root):
+    """Return every directory below root that directly contains raw .csv exports."""
+    experiments = []
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if not OUTPUT_DIRECTORY_PATTERN.match(d) and d != 'config']
+        if any(CSV_PATTERN.search(f) for f in files):
+            experiments.append(directory)
+    return experiments
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class Experiment:
+    """Incrementally processed outputs of one experiment directory."""
+
+    def __init__(self, directory_path, trim_hours, keep_hours, bin_hours, start_dark):
+        self.directory_path = directory_path
+        self.trim_hours = trim_hours
+        self.keep_hours = keep_hours
+        self.bin_hours = bin_hours
+        self.start_dark = start_dark
+        self.config_file = os.path.join(directory_path, 'config', 'experiment_config.csv')
+        self.cleaned_directory = os.path.join(directory_path, 'Cleaned_CLAMS_data')
+        self.trimmed_directory = os.path.join(directory_path, 'Trimmed_CLAMS_data')
+        self.state_path = os.path.join(directory_path, 'config', STATE_FILE)
+        # Raw file name -> {'signature': [size, mtime_ns], 'cleaned': paths of the cleaned files, 'trimmed': paths of
+        # the trimmed files}, and the signature of the configuration the combined outputs were written with
+        self.state, self.config_signature = self._load_state()
+        # Bin hours -> {binned file path -> subject DataFrame}, filled lazily from the binned files on disk
+        self.subjects = {}
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}, None
+        if 'files' not in state:
+            # Written before the configuration was recorded, the combined outputs are rewritten once
+            return state, None
+        return state['files'], state['config_signature']
+
+    def _save_state(self):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(self.state_path, 'w') as f:
+            json.dump({'config_signature': self.config_signature, 'files': self.state}, f, indent=2)
+
+    def raw_files(self):
+        return sorted(f for f in os.listdir(self.directory_path)
+                      if CSV_PATTERN.search(f) and os.path.isfile(os.path.join(self.directory_path, f)))
+
+    def changed_files(self):
+        """Return the raw files whose size or modification time differ from when they were last processed."""
+        changed = {}
+        for file_name in self.raw_files():
+            try:
+                signature = _signature(os.path.join(self.directory_path, file_name))
+            except FileNotFoundError:
+                continue
+            if self.state.get(file_name, {}).get('signature') != signature:
+                changed[file_name] = signature
+        return changed
+
+    def config_changed(self):
+        """Return True if the experiment configuration changed since the combined outputs were last written.
+
+        The signature is kept in the state file, so a change made between two runs with --once is noticed too.
+        """
+        processed = any(entry.get('trimmed') for entry in self.state.values())
+        return processed and _signature(self.config_file) != self.config_signature
+
+    def _load_subjects(self, bin_hour, config_df):
+        """Load the binned subjects of one bin size from disk, reusing frames already in memory."""
+        import clams_processing
+
+        binned_directory = os.path.join(self.directory_path, f"{bin_hour}hour_bins_Binned_CLAMS_data")
+        cached = self.subjects.setdefault(bin_hour, {})
+        if not os.path.isdir(binned_directory):
+            return cached
+        for file_name in sorted(os.listdir(binned_directory)):
+            path = os.path.join(binned_directory, file_name)
+            if file_name.endswith('.csv') and path not in cached:
+                cached[path] = clams_processing.load_binned_subject(path, config_df,
+                                                                    clams_processing.COMBINED_COLUMNS)
+        return cached
+
+    def process(self, file_names):
+        """Clean, trim and bin the given raw files and update the combined outputs of every bin size.
+
+        Returns:
+        list of str: the files that could not be processed
+        """
+        import clams_processing
+        from clams_io import read_csv
+
+        os.makedirs(self.cleaned_directory, exist_ok=True)
+        os.makedirs(self.trimmed_directory, exist_ok=True)
+
+        # The group labels of every subject change with the configuration, so reload all subjects if it changed
+        config_signature = _signature(self.config_file)
+        if config_signature != self.config_signature:
+            self.subjects = {}
+            self.config_signature = config_signature
+        config_df = read_csv(self.config_file)
+
+        failed = []
+        updated = []
+        for file_name in file_names:
+            raw_path = os.path.join(self.directory_path, file_name)
+            try:
+                signature = _signature(raw_path)
+                cleaned_paths = clams_processing.clean_clams_export(raw_path, self.cleaned_directory)
+                trimmed_paths = [clams_processing.trim_clams_file(cleaned_path, self.trimmed_directory,
+                                                                  self.trim_hours, self.keep_hours, self.start_dark)
+                                 for cleaned_path in cleaned_paths]
+            except Exception as e:
+                logger.error(f"Could not process {raw_path}: {type(e).__name__}: {e}")
+                failed.append(file_name)
+                continue
+
+            # A multi-channel export yields several subjects, states written before these were split hold one path
+            previous = self.state.get(file_name, {})
+            previous_trimmed = previous.get('trimmed') or []
+            if isinstance(previous_trimmed, str):
+                previous_trimmed = [previous_trimmed]
+            # States written before the cleaned paths were recorded hold the trimmed paths only
+            previous_cleaned = previous.get('cleaned') or [None] * len(previous_trimmed)
+            for previous_cleaned_path, previous_path in zip(previous_cleaned, previous_trimmed):
+                if previous_path not in trimmed_paths:
+                    # The subject IDs in the export changed, so drop the outputs of the old subjects
+                    self._remove_subject(previous_path, previous_cleaned_path)
+            self.state[file_name] = {'signature': signature, 'cleaned': cleaned_paths, 'trimmed': trimmed_paths}
+            updated += trimmed_paths
+
+        for bin_hour in self.bin_hours:
+            subjects = self._load_subjects(bin_hour, config_df)
+            for trimmed_path in updated:
+                binned_path = clams_processing.bin_clams_data(trimmed_path, bin_hour)
+                subjects[binned_path] = clams_processing.load_binned_subject(binned_path, config_df,
+                                                                             clams_processing.COMBINED_COLUMNS)
+
+            combined_directory = os.path.join(self.directory_path, f"{bin_hour}hour_bins_Combined_CLAMS_data")
+            combined_data = clams_processing.combine_subjects(subjects[path] for path in sorted(subjects))
+            clams_processing.write_combined_columns(combined_data, combined_directory)
+            clams_processing.reformat_csvs_in_directory(combined_directory, combined_data)
+
+        self._save_state()
+        return failed
+
+    def _remove_subject(self, trimmed_path, cleaned_path=None):
+        """Delete the cleaned, trimmed and binned files of a subject that is no longer in its export.
+
+        Parameters:
+        trimmed_path (string): path of the trimmed file
+        cleaned_path (string): path of the cleaned file as clean_clams_export returned it, derived from the trimmed
+            file name as trim_clams_file builds it if not recorded
+        """
+        import clams_processing
+
+        if cleaned_path is None:
+            base_name, ext = os.path.splitext(os.path.basename(trimmed_path))
+            cleaned_path = os.path.join(self.cleaned_directory, base_name[:-len('_trimmed')] + ext)
+        paths = [trimmed_path, cleaned_path]
+        for bin_hour in self.bin_hours:
+            binned_path = clams_processing.binned_file_path(trimmed_path, bin_hour)
+            paths.append(binned_path)
+            self.subjects.get(bin_hour, {}).pop(binned_path, None)
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def watch(root, trim_hours, keep_hours, bin_hours, start_dark, settle=10.0, poll=False, poll_interval=5.0,
+          once=False):
+    """Process new and changed exports below root until interrupted.
+
+    Parameters:
+    root (string): directory tree to watch
+    trim_hours (int): number of hours to trim from the beginning of the cleaned data
+    keep_hours (int): number of hours to keep in the trimmed data
+    bin_hours (list of int): sizes of the bins in hours
+    start_dark (bool): start the kept data at a dark cycle instead of a light cycle
+    settle (float): seconds a file must stay unchanged before it is processed
+    poll (bool): always poll instead of using inotify
+    poll_interval (float): seconds between scans when polling
+    once (bool): process everything that is already settled and return, instead of watching
+    """
+    experiments = {}
+    # Raw file path -> (signature, time the signature was first seen)
+    pending = {}
+    watcher = None if once else create_watcher(root, poll, poll_interval)
+    changed_directories = None
+    try:
+        while True:
+            now = time.monotonic()
+            directories = find_experiments(root)
+            if changed_directories is not None:
+                # A change to the configuration counts as a change to its experiment
+                changed_directories = {os.path.dirname(d) if os.path.basename(d) == 'config' else d
+                                       for d in changed_directories}
+                directories = [d for d in directories
+                               if d in changed_directories or any(p.startswith(d + os.sep) for p in pending)]
+
+            ready = {}
+            for directory in directories:
+                if not os.path.exists(os.path.join(directory, 'config', 'experiment_config.csv')):
+                    continue
+                if directory not in experiments:
+                    experiments[directory] = Experiment(directory, trim_hours, keep_hours, bin_hours, start_dark)
+                experiment = experiments[directory]
+                if experiment.config_changed():
+                    # Rewrites the combined outputs with the new group labels
+                    ready.setdefault(directory, [])
+                for file_name, signature in experiment.changed_files().items():
+                    path = os.path.join(directory, file_name)
+                    if path not in pending or pending[path][0] != signature:
+                        # New or still being written, restart the settle timer
+                        pending[path] = (signature, now)
+                    elif once or now - pending[path][1] >= settle:
+                        ready.setdefault(directory, []).append(file_name)
+
+            for directory, file_names in ready.items():
+                if file_names:
+                    logger.info(f"Processing {len(file_names)} new or changed file(s) in {directory}")
+                else:
+                    logger.info(f"Configuration of {directory} changed, updating combined outputs")
+                failed = experiments[directory].process(file_names)
+                for file_name in file_names:
+                    if file_name not in failed:
+                        pending.pop(os.path.join(directory, file_name), None)
+                    else:
+                        # Retry only once the file changes again
+                        path = os.path.join(directory, file_name)
+                        experiments[directory].state[file_name] = {'signature': pending.pop(path)[0]}
+
+            if once:
+                if not pending:
+                    return
+                time.sleep(0.1)
+                continue
+            changed_directories = watcher.wait(settle if pending else 60)
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Watch a directory tree and process CLAMS exports as they arrive.")
+    parser.add_argument('root', help="directory tree the CLAMS exports are saved to")
+    parser.add_argument('--trim', type=int, default=0, help="hours to trim from the beginning (default: 0)")
+    parser.add_argument('--keep', type=int, required=True, help="hours to keep after trimming")
+    parser.add_argument('--bin', nargs='+', default=['1'], help="bin sizes in hours (default: 1)")
+    parser.add_argument('--start-cycle', default='light', help="'light' or 'dark' (default: light)")
+    parser.add_argument('--settle', type=float, default=10.0,
+                        help="seconds a file must stay unchanged before it is processed (default: 10)")
+    parser.add_argument('--poll', action='store_true', help="poll for changes instead of using inotify")
+    parser.add_argument('--poll-interval', type=float, default=5.0,
+                        help="seconds between scans when polling (default: 5)")
+    parser.add_argument('--once', action='store_true', help="process pending changes once and exit")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    try:
+        bin_hours = parse_bin_hours(args.bin)
+        start_dark = parse_start_cycle(args.start_cycle)
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        watch(args.root, args.trim, args.keep, bin_hours, start_dark, args.settle, args.poll, args.poll_interval,
+              args.once)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
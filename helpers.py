@@ -1,6 +1,5 @@
 import os
 import zipfile
-import requests
 
 
 def get_latest_version():
@@ -9,6 +8,9 @@ def get_latest_version():
     repo_name = 'CLAMSwrangler-web'  # Replace with your actual repo name
     url = f'https://api.github.com/repos/{repo_owner}/{repo_name}/releases/latest'
 
+    # Imported here, the web and worker processes only use zip_directory
+    import requests
+
     response = requests.get(url)
     if response.status_code == 200:
         latest_release = response.json()
@@ -0,0 +1,222 @@
+"""Timing and memory instrumentation for the CLAMS processing pipeline.
+
+Pipeline stages are wrapped in `stage()` and per-file steps in `file_step()`. Both measure wall time, CPU time and peak
+RSS, and emit one structured (JSON) log record when they finish. While a `collect()` block is active the stage records
+are also gathered into a JobMetrics object so they can be attached to a job result. Per-file records are only summed
+into their stage there, their detail stays in the logs so a job result does not grow with the number of files.
+"""
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Collector of the job currently running in this process, if any
+_collector = None
+
+# Per-file values summed into the record of their stage
+FILE_TOTALS = ('rows_in', 'rows_out', 'bytes_read', 'bytes_written')
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS high-water mark where the OS allows it (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes, or None if unavailable."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+class JobMetrics:
+    """Stage measurements of a single job and running totals of its per-file steps.
+
+    Attributes:
+    stages (list of dict): record of every finished stage
+    file_totals (dict): number of file steps ("files") and the sum of each of FILE_TOTALS over them so far
+    """
+
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        self.stages = []
+        self.file_totals = dict.fromkeys(('files',) + FILE_TOTALS, 0)
+        self._lock = threading.Lock()
+
+    def add(self, kind, record):
+        with self._lock:
+            if kind == 'stage':
+                self.stages.append(record)
+                return
+            self.file_totals['files'] += 1
+            for key in FILE_TOTALS:
+                self.file_totals[key] += record.get(key) or 0
+
+    def totals(self):
+        """Return a copy of the running totals of the file steps."""
+        with self._lock:
+            return dict(self.file_totals)
+
+    def as_dict(self):
+        """Return the stage measurements and totals as a JSON-serializable dict."""
+        with self._lock:
+            return {
+                'stages': list(self.stages),
+                'files': self.file_totals['files'],
+                'total_wall_seconds': round(sum(s['wall_seconds'] for s in self.stages), 4),
+                'peak_rss_bytes': max((s['peak_rss_bytes'] or 0 for s in self.stages), default=None),
+            }
+
+
+def _emit(kind, record):
+    if _collector is not None:
+        _collector.add(kind, record)
+        record = {'job_id': _collector.job_id, **record}
+    logger.info(json.dumps({'event': kind, **record}, default=str))
+
+
+@contextlib.contextmanager
+def collect(job_id=None):
+    """Collect all stage and file step records emitted in this process while the block is active.
+
+    Parameters:
+    job_id (string): identifier added to every structured log record
+
+    Yields:
+    JobMetrics: the collected measurements
+    """
+    global _collector
+    previous = _collector
+    _collector = JobMetrics(job_id)
+    try:
+        yield _collector
+    finally:
+        _collector = previous
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """Measure one pipeline stage.
+
+    Rows and bytes of the file steps run inside the stage are summed into the stage record, unless the caller sets them
+    in the yielded dict.
+
+    Parameters:
+    name (string): stage name, e.g. "clean" or "bin"
+    **fields: extra values added to the record, e.g. bin_hours=4
+    """
+    collector = _collector
+    totals_before = collector.totals() if collector is not None else None
+    info = {}
+    _reset_peak_rss()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield info
+    finally:
+        record = {
+            'stage': name,
+            **fields,
+            'wall_seconds': round(time.perf_counter() - wall_start, 4),
+            'cpu_seconds': round(time.process_time() - cpu_start, 4),
+            'peak_rss_bytes': peak_rss(),
+        }
+        if collector is not None:
+            totals = collector.totals()
+            for key in ('files',) + FILE_TOTALS:
+                record[key] = totals[key] - totals_before[key]
+        record.update(info)
+        _emit('stage', record)
+
+
+@contextlib.contextmanager
+def file_step(step, file_path):
+    """Measure one per-file step of a stage.
+
+    The yielded dict can be filled in by the caller with "rows_in", "rows_out" and "output_path" (a path or a list of
+    paths); the number of bytes read from file_path and written to output_path are added when the step finishes. An
+    output queued by clams_io.WriteBehind is set as "pending" instead, the record is then emitted once it is written.
+
+    Parameters:
+    step (string): step name, usually the name of the enclosing stage
+    file_path (string): input file of the step
+    """
+    info = {}
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield info
+    finally:
+        pending = info.pop('pending', None)
+        output_paths = [pending.path] if pending is not None else info.pop('output_path', None)
+        if not isinstance(output_paths, list):
+            output_paths = [output_paths]
+        wall_seconds = round(time.perf_counter() - wall_start, 4)
+        cpu_seconds = round(time.thread_time() - cpu_start, 4)
+
+        def emit():
+            record = {
+                'step': step,
+                'file': os.path.basename(file_path),
+                **info,
+                'bytes_read': _file_size(file_path),
+                'bytes_written': sum(_file_size(output_path) for output_path in output_paths),
+                'wall_seconds': wall_seconds,
+                'cpu_seconds': cpu_seconds,
+                'peak_rss_bytes': peak_rss(),
+            }
+            _emit('file', record)
+
+        if pending is not None:
+            pending.when_written(emit)
+        else:
+            emit()
+
+
+@contextlib.contextmanager
+def profile(output_path):
+    """Profile the block with cProfile and dump the stats to output_path. Does nothing if output_path is None."""
+    if output_path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        profiler.dump_stats(output_path)
+        logger.info(json.dumps({'event': 'profile', 'path': output_path}))
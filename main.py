@@ -1,6 +1,9 @@
+import importlib
 import os
 import platform
+import queue
 import sys
+import threading
 import time
 import tkinter as tk
 import webbrowser
@@ -8,38 +11,42 @@ from datetime import datetime
 from shutil import move
 from tkinter import filedialog, font, messagebox
 
-import pandas as pd
-import requests
 import ttkbootstrap as ttk
 from ttkbootstrap.constants import *
 
-from clams_processing import clean_all_clams_data, trim_all_clams_data, process_directory, recombine_columns, \
-    reformat_csvs_in_directory
+from clams_batch import OUTPUT_DIRECTORY_PATTERN, remove_outputs
 
 VERSION = "v1.0.4"
 
+# How often the main loop moves queued log messages and progress updates into the window, in milliseconds
+LOG_PUMP_INTERVAL = 100
+
+# Messages from the processing thread to the main loop. Tk widgets may only be touched from the main loop, so the
+# processing thread puts ("log", text), ("progress", step, completed, total) and ("finished", status, error) here.
+events = queue.Queue()
+cancel_requested = threading.Event()
+
+
+class ProcessingCancelled(Exception):
+    pass
+
 
 class StdoutRedirect:
-    def __init__(self, text_widget):
-        self.text_widget = text_widget
+    """Sends printed text to the events queue instead of writing it to the output_text widget directly."""
+
+    def __init__(self, event_queue):
+        self.event_queue = event_queue
         self._stdout = sys.stdout
 
     def write(self, message):
-        original_stdout = sys.stdout
-        sys.stdout = self._stdout
-        try:
-            self.text_widget.insert(tk.END, message)
-            self.text_widget.see(tk.END)  # Scroll to the end
+        self.event_queue.put(("log", message))
+        # Still echo to the console when there is one, it is None in a windowed build
+        if self._stdout is not None:
             self._stdout.write(message)
-            self.text_widget.see(tk.END)  # Scroll to the end
-            self._stdout.flush()  # Flush the buffer
-        except Exception as e:
-            print(f"An exception occurred: {e}")
-        finally:
-            sys.stdout = original_stdout
 
     def flush(self):
-        self._stdout.flush()
+        if self._stdout is not None:
+            self._stdout.flush()
 
 
 def check_for_update():
@@ -48,6 +55,8 @@ def check_for_update():
     repo_name = 'CLAMSwrangler'  # Replace with your actual repo name
     url = f'https://api.github.com/repos/{repo_owner}/{repo_name}/releases/latest'
 
+    import requests
+
     response = requests.get(url)
     if response.status_code == 200:
         latest_release = response.json()
@@ -145,6 +154,8 @@ def browse_config_file():
         config_file_entry.insert(0, experiment_config_file)
 
         # Check the format of the experiment configuration file
+        import pandas as pd
+
         try:
             config_df = pd.read_csv(experiment_config_file)
             expected_columns = ["ID", "GROUP LABEL"]
@@ -228,6 +239,7 @@ def main_process_clams_data():
 
     except ValueError as e:
         output_text.insert(tk.END, f"Error: {str(e)} Value must be a whole integer!\n")
+        return
 
     # this has a default value and can not be modified, so no need for error handling
     start_dark = start_cycle_var.get() == "Start Dark"
@@ -244,6 +256,7 @@ def main_process_clams_data():
 
     except ValueError as e:
         output_text.insert(tk.END, f"Error: {str(e)} Value must be a whole integer!\n")
+        return
 
     # handle bin hours errors
     try:
@@ -262,10 +275,7 @@ def main_process_clams_data():
 
     except ValueError as e:
         output_text.insert(tk.END, f"Error: {str(e)} Value must be a whole integer!\n")
-
-    # Redirect stdout to the output_text widget
-    original_stdout = sys.stdout
-    sys.stdout = StdoutRedirect(output_text)
+        return
 
     # Check if the experiment configuration file exists
     experiment_config_file = os.path.join(directory_path, 'config/experiment_config.csv')
@@ -276,6 +286,8 @@ def main_process_clams_data():
         # Check if the user provided a config file to be copied
         selected_config_file = config_file_entry.get()
         if selected_config_file and os.path.exists(selected_config_file):
+            import pandas as pd
+
             try:
                 # Read the selected config file
                 config_df = pd.read_csv(selected_config_file)
@@ -289,38 +301,113 @@ def main_process_clams_data():
                 # Handle errors while reading/copying the selected config file
                 output_text.insert(tk.END, f"Error copying config file: {str(e)}\n")
 
-    output_text.insert("end", "\nCleaning all CLAMS data...\n")
-    clean_all_clams_data(directory_path)
-
-    output_text.insert("end", "\nTrimming all cleaned CLAMS data...\n")
-    trim_all_clams_data(directory_path, trim_hours, keep_hours, start_dark)
+    # Keep the values used for this run for the log file, the entries may change while it is processing
+    input_values = {
+        "Directory Path": directory_path,
+        "Trim Hours": trim_hours_entry.get(),
+        "Start Cycle": start_cycle_var.get(),
+        "Keep Hours": keep_hours_entry.get(),
+        "Bin Hours": bin_hours_entry.get(),
+        "Config File": config_file_entry.get(),
+    }
 
-    output_text.insert("end", "\nBinning all trimmed CLAMS data...\n")
-    process_directory(directory_path, bin_hours)
+    # Redirect stdout to the events queue, the main loop copies it into output_text in batches
+    sys.stdout = StdoutRedirect(events)
+    cancel_requested.clear()
+    start_button.config(state=tk.DISABLED)
+    cancel_button.config(state=tk.NORMAL)
+    progress_bar.config(value=0)
+
+    # Process on a separate thread so the window keeps responding
+    worker = threading.Thread(target=process_clams_data_in_background, daemon=True,
+                              args=(directory_path, trim_hours, keep_hours, bin_hours, start_dark,
+                                    experiment_config_file))
+    worker.start()
+    root.after(LOG_PUMP_INTERVAL, pump_events, directory_path, input_values)
+
+
+def process_clams_data_in_background(directory_path, trim_hours, keep_hours, bin_hours, start_dark,
+                                     experiment_config_file):
+    """Run the pipeline and report its progress through the events queue. Runs on the processing thread."""
+    def report_progress(step, completed, total):
+        if cancel_requested.is_set():
+            raise ProcessingCancelled()
+        events.put(("progress", step, completed, total))
 
-    # Path to experiment config file
-    experiment_config_file = os.path.join(directory_path, 'config/experiment_config.csv')
+    try:
+        from clams_processing import run_pipeline
+
+        run_pipeline(directory_path, trim_hours, keep_hours, [bin_hours], start_dark, experiment_config_file,
+                     progress_callback=report_progress)
+        events.put(("finished", "success", None))
+    except ProcessingCancelled:
+        events.put(("finished", "cancelled", None))
+    except Exception as e:
+        events.put(("finished", "failure", e))
+
+
+def cancel_processing():
+    """Stop processing before the next step starts."""
+    cancel_requested.set()
+    cancel_button.config(state=tk.DISABLED)
+    output_text.insert(tk.END, "\nCancelling after the current step...\n")
+    output_text.see(tk.END)
+
+
+def pump_events(directory_path, input_values):
+    """Move everything queued by the processing thread into the window, then schedule the next call."""
+    messages = []
+    finished = None
+    while True:
+        try:
+            event = events.get_nowait()
+        except queue.Empty:
+            break
+        if event[0] == "log":
+            messages.append(event[1])
+        elif event[0] == "progress":
+            step, completed, total = event[1:]
+            progress_bar.config(maximum=total, value=completed)
+            if step is not None:
+                messages.append(f"\nStep {completed + 1} of {total}: {step}\n")
+        else:
+            finished = event[1:]
 
-    output_text.insert("end", "\nCombining all binned CLAMS data...\n")
-    recombine_columns(directory_path, experiment_config_file)
+    # A single insert per batch instead of one per print keeps the widget cheap to update
+    if messages:
+        output_text.insert(tk.END, "".join(messages))
+        output_text.see(tk.END)
 
-    output_text.insert("end", "\nReformatting all combined CLAMS data...\n")
-    reformat_csvs_in_directory(os.path.join(directory_path, 'Combined_CLAMS_data'))
+    if finished is None:
+        root.after(LOG_PUMP_INTERVAL, pump_events, directory_path, input_values)
+    else:
+        finish_processing(directory_path, input_values, *finished)
 
-    output_text.insert("end", "\nAll CLAMS files processed successfully!")
 
+def finish_processing(directory_path, input_values, status, error):
+    """Restore the window after the processing thread has finished and archive the results of a successful run."""
     # Restore the original stdout
-    sys.stdout = original_stdout
+    if isinstance(sys.stdout, StdoutRedirect):
+        sys.stdout = sys.stdout._stdout
+    start_button.config(state=tk.NORMAL)
+    cancel_button.config(state=tk.DISABLED)
+
+    if status == "cancelled":
+        # Partial outputs would be skipped or mixed into the next run
+        remove_outputs(directory_path)
+        progress_bar.config(value=0)
+        output_text.insert(tk.END, "Processing cancelled, partial outputs were removed.\n")
+        output_text.see(tk.END)
+        return
+    if status == "failure":
+        output_text.insert(tk.END, f"\nError while processing: {error}\n")
+        output_text.see(tk.END)
+        return
+
+    output_text.insert("end", "\nAll CLAMS files processed successfully!")
+    output_text.see(tk.END)
 
     # Log user input values and output text
-    input_values = {
-        "Directory Path": directory_path_entry.get(),
-        "Trim Hours": trim_hours_entry.get(),
-        "Start Cycle": start_cycle_var,
-        "Keep Hours": keep_hours_entry.get(),
-        "Bin Hours": bin_hours_entry.get(),
-        "Config File": config_file_entry.get(),
-    }
     output_text_content = output_text.get("1.0", tk.END)
     log_user_input_and_output(input_values, output_text_content)
 
@@ -329,8 +416,9 @@ def main_process_clams_data():
     timestamped_dir = os.path.join(directory_path, f'timestamp_{timestamp}')
     os.makedirs(timestamped_dir, exist_ok=True)
 
-    # Move the relevant folders to the timestamped directory
-    folders_to_move = ['Binned_CLAMS_data', 'Cleaned_CLAMS_data', 'Combined_CLAMS_data', 'config', 'Trimmed_CLAMS_data']
+    # Move the output folders and the config to the timestamped directory
+    folders_to_move = [name for name in os.listdir(directory_path)
+                       if name == 'config' or OUTPUT_DIRECTORY_PATTERN.match(name)]
     for folder in folders_to_move:
         source_folder = os.path.join(directory_path, folder)
         destination_folder = os.path.join(timestamped_dir, folder)
@@ -463,8 +551,14 @@ btn_add_config.grid(row=7, column=1, padx=2, pady=2)
 output_text = ttk.Text(input_frame, wrap=tk.WORD, width=100, height=20)
 output_text.grid(row=8, column=0, columnspan=3, padx=10, pady=10)
 
+progress_bar = ttk.Progressbar(input_frame, mode="determinate")
+progress_bar.grid(row=9, column=0, columnspan=3, sticky=EW, padx=10, pady=2)
+
 start_button = ttk.Button(input_frame, text="Start Processing", command=main_process_clams_data)
-start_button.grid(row=9, column=0, columnspan=3, padx=10, pady=10)
+start_button.grid(row=10, column=0, columnspan=2, sticky=E, padx=10, pady=10)
+cancel_button = ttk.Button(input_frame, text="Cancel", command=cancel_processing, bootstyle=DANGER,
+                           state=tk.DISABLED)
+cancel_button.grid(row=10, column=2, sticky=W, padx=10, pady=10)
 
 # Set weights for rescaling window
 main_frame.grid_rowconfigure(0, weight=1)
@@ -500,5 +594,8 @@ exit_button.pack(side=tk.RIGHT, padx=10)
 update_button = ttk.Button(footer_frame, text="Check for Updates", command=check_for_update)
 update_button.pack(side=tk.RIGHT, padx=10)
 
+# pandas and the processing modules are imported in the background once the window is shown, so it opens without
+# waiting for them and they are usually loaded by the time the first run starts
+threading.Thread(target=importlib.import_module, args=('clams_processing',), daemon=True).start()
 
 root.mainloop()
@@ -0,0 +1,169 @@
+import contextlib
+import glob
+import io
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from clams_array import CombinedArray
+from clams_processing import write_group_summaries
+from tests.utils import make_experiment, run_pipeline
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+
+def subject_frame(subject_id, group_label, hours, vo2, wheel):
+    hours = np.array(hours)
+    return pd.DataFrame({'ID': subject_id, 'GROUP_LABEL': group_label, 'DAY': (hours - 1) // 24 + 1, 'HOUR': hours,
+                         '24 HOUR': (hours - 1) % 24 + 1, 'VO2': vo2, 'WHEEL': wheel})
+
+
+class CombinedArrayTests(unittest.TestCase):
+
+    def setUp(self):
+        # The second subject has no row for the second bin
+        self.frames = [subject_frame('1001', 'Control', [1, 2, 3], [2900.5, 3000.25, np.nan], [0, 12, 7]),
+                       subject_frame('1002', 'Treated', [1, 3], [3100.0, 3050.75], [3, 4])]
+        self.array = CombinedArray.from_subjects(self.frames, ['VO2', 'WHEEL'])
+
+    def assert_same_array(self, expected, actual):
+        np.testing.assert_array_equal(expected.values, actual.values)
+        np.testing.assert_array_equal(expected.present, actual.present)
+        for name in ('ids', 'group_labels', 'day', 'hour', 'hour_24'):
+            np.testing.assert_array_equal(getattr(expected, name), getattr(actual, name), err_msg=name)
+            self.assertEqual(getattr(expected, name).dtype, getattr(actual, name).dtype, name)
+        self.assertEqual(expected.variables, actual.variables)
+        self.assertEqual(expected.dtypes, actual.dtypes)
+        pd.testing.assert_frame_equal(expected.long(), actual.long())
+
+    def test_from_subjects(self):
+        self.assertEqual(self.array.values.shape, (2, 3, 2))
+        np.testing.assert_array_equal(self.array.present, [[True, True, True], [True, False, True]])
+        np.testing.assert_array_equal(self.array.hour, [1, 2, 3])
+        self.assertTrue(np.isnan(self.array.values[1, 1]).all())
+        self.assertEqual(self.array.dtypes, [np.dtype(float), np.dtype(np.int64)])
+
+    def test_long_table(self):
+        expected = pd.concat(self.frames, ignore_index=True)
+        pd.testing.assert_frame_equal(self.array.long(), expected, check_dtype=False)
+        # Integer variables keep their dtype
+        self.assertEqual(self.array.long()['WHEEL'].dtype, np.int64)
+
+    def test_duplicate_bins(self):
+        frames = [subject_frame('1001', 'Control', [1, 1], [1.0, 2.0], [0, 0])]
+        with self.assertRaises(ValueError):
+            CombinedArray.from_subjects(frames, ['VO2'])
+
+    def test_concatenate(self):
+        frames = self.frames + [subject_frame('1003', 'Control', [0.5, 4], [2800.0, 2950.5], [1, 2])]
+        parts = [CombinedArray.from_subjects([df], ['VO2', 'WHEEL']) for df in frames]
+        self.assert_same_array(CombinedArray.from_subjects(frames, ['VO2', 'WHEEL']), CombinedArray.concatenate(parts))
+        with self.assertRaises(ValueError):
+            CombinedArray.concatenate([self.array, CombinedArray.from_subjects(self.frames, ['VO2'])])
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'combined.npz')
+            self.array.save(path)
+            self.assert_same_array(self.array, CombinedArray.load(path))
+
+    def test_select(self):
+        control = self.array.select(self.array.groups()['Control'])
+        pd.testing.assert_frame_equal(control.long(), self.frames[0], check_dtype=False)
+
+    @unittest.skipUnless(HAS_PYARROW, 'pyarrow is not installed')
+    def test_write_arrow(self):
+        import pyarrow.feather as feather
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'combined.arrow')
+            self.array.write_arrow(path)
+            pd.testing.assert_frame_equal(feather.read_feather(path), self.array.long())
+
+
+class GroupSummaryTests(unittest.TestCase):
+    """Statistics of every group and bin, against values worked out by hand."""
+
+    def setUp(self):
+        # Subjects without a GROUP_LABEL, missing or empty, are summarized together
+        frames = [subject_frame('1001', 'Control', [1, 2, 3], [10.0, 20.0, np.nan], [1, 2, 3]),
+                  subject_frame('1002', 'Treated', [1, 3], [5.0, 9.0], [4, 5]),
+                  subject_frame('1003', 'Control', [1, 2, 3], [14.0, 26.0, 30.0], [6, 7, 8]),
+                  subject_frame('1004', np.nan, [1, 2, 3], [1.0, 2.0, 3.0], [0, 0, 0]),
+                  subject_frame('1005', '', [1, 2, 3], [3.0, 4.0, 5.0], [0, 0, 0])]
+        self.array = CombinedArray.from_subjects(frames, ['VO2', 'WHEEL'])
+        # Pairs 2 apart have an SD of sqrt(2) and a SEM of 1
+        root2 = 1.4142
+        self.expected = pd.DataFrame([
+            # Control: SD of 10 and 14 is sqrt(8), of 20 and 26 sqrt(18), a single subject in the last bin has no SD
+            ('Control', 1, 1, 1, 2, 12.0, 2.8284, 2.0),
+            ('Control', 1, 2, 2, 2, 23.0, 4.2426, 3.0),
+            ('Control', 1, 3, 3, 1, 30.0, np.nan, np.nan),
+            ('NO_LABEL', 1, 1, 1, 2, 2.0, root2, 1.0),
+            ('NO_LABEL', 1, 2, 2, 2, 3.0, root2, 1.0),
+            ('NO_LABEL', 1, 3, 3, 2, 4.0, root2, 1.0),
+            # Treated has no value in the second bin
+            ('Treated', 1, 1, 1, 1, 5.0, np.nan, np.nan),
+            ('Treated', 1, 3, 3, 1, 9.0, np.nan, np.nan),
+        ], columns=['GROUP_LABEL', 'DAY', 'HOUR', '24 HOUR', 'N', 'MEAN', 'SD', 'SEM'])
+
+    def test_group_summary(self):
+        summary = self.array.group_summary()
+        self.assertEqual(list(summary), ['VO2', 'WHEEL'])
+        pd.testing.assert_frame_equal(summary['VO2'], self.expected, check_dtype=False)
+        self.assertEqual(summary['WHEEL']['N'].tolist(), [2, 2, 2, 2, 2, 2, 1, 1])
+
+    def test_write_group_summaries(self):
+        with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+            write_group_summaries(self.array, directory)
+            self.assertEqual(sorted(os.listdir(directory)), ['VO2.csv', 'WHEEL.csv'])
+            pd.testing.assert_frame_equal(pd.read_csv(os.path.join(directory, 'VO2.csv')), self.expected,
+                                          check_dtype=False)
+
+
+class PipelineArrayTests(unittest.TestCase):
+    """The combined data of the pipeline holds the values of its combined files and survives a round trip."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.experiment = make_experiment(os.path.join(cls.directory.name, 'experiment'))
+        cls.combined = {}
+        run_pipeline(cls.experiment, combined_callback=lambda bin_hours, step_hours, combined_data:
+                     cls.combined.setdefault((bin_hours, step_hours), combined_data))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def test_combined_files(self):
+        combined_data = self.combined[(1, None)]
+        paths = glob.glob(os.path.join(self.experiment, '1hour_bins_Combined_CLAMS_data', '*.csv'))
+        self.assertEqual(len(paths), len(combined_data.variables))
+        for path in paths:
+            variable = os.path.splitext(os.path.basename(path))[0]
+            with self.subTest(variable=variable):
+                # Compared as read back, IDs are written as text and read as numbers
+                actual = pd.read_csv(io.StringIO(combined_data.long([variable]).to_csv(index=False)))
+                pd.testing.assert_frame_equal(actual, pd.read_csv(path))
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for (bin_hours, _), combined_data in self.combined.items():
+                path = os.path.join(directory, f'{bin_hours}.npz')
+                combined_data.save(path)
+                loaded = CombinedArray.load(path)
+                # IDs and group labels are saved as text
+                pd.testing.assert_frame_equal(loaded.long(), combined_data.long(), check_dtype=False)
+                np.testing.assert_array_equal(loaded.values, combined_data.values)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+import clams_batch
+from tests.utils import BIN_HOURS, KEEP_HOURS, TRIM_HOURS, make_experiment
+
+
+def run_batch_cli(argv):
+    """Run the batch command line, return its exit code and the JSON report it printed."""
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(io.StringIO()):
+        exit_code = clams_batch.main(argv)
+    return exit_code, json.loads(stdout.getvalue())
+
+
+class ParseTests(unittest.TestCase):
+
+    def test_bin_hours(self):
+        self.assertEqual(clams_batch.parse_bin_hours('1;4, 12'), [1, 4, 12])
+        with self.assertRaises(ValueError):
+            clams_batch.parse_bin_hours('5')
+
+    def test_rolling_windows(self):
+        self.assertEqual(clams_batch.parse_rolling_windows('3:0.5;6:1'), [(3.0, 0.5), (6.0, 1.0)])
+        with self.assertRaises(ValueError):
+            clams_batch.parse_rolling_windows('3')
+
+    def test_start_cycle(self):
+        self.assertTrue(clams_batch.parse_start_cycle('Start Dark'))
+        self.assertFalse(clams_batch.parse_start_cycle('light'))
+        with self.assertRaises(ValueError):
+            clams_batch.parse_start_cycle('dusk')
+
+
+class ManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        make_experiment(os.path.join(self.directory.name, 'good'))
+        # An experiment without its configuration file fails when its subjects are recombined
+        make_experiment(os.path.join(self.directory.name, 'no_config'))
+        os.remove(os.path.join(self.directory.name, 'no_config', 'config', 'experiment_config.csv'))
+
+    def write_manifest(self, rows):
+        path = os.path.join(self.directory.name, 'experiments.csv')
+        with open(path, 'w') as f:
+            f.write('directory,bin_hours,start_cycle\n')
+            f.writelines(f'{row}\n' for row in rows)
+        return path
+
+    def options(self, manifest_path):
+        return ['--manifest', manifest_path, '--trim', str(TRIM_HOURS), '--keep', str(KEEP_HOURS), '--workers', '1']
+
+    def test_success(self):
+        bin_hours = ';'.join(map(str, BIN_HOURS))
+        exit_code, report = run_batch_cli(self.options(self.write_manifest([f'good,{bin_hours},dark'])))
+        self.assertEqual(exit_code, 0)
+        self.assertEqual((report['succeeded'], report['failed']), (1, 0))
+        [experiment] = report['experiments']
+        self.assertEqual(experiment['status'], 'success')
+        self.assertEqual((experiment['bin_hours'], experiment['start_dark']), (BIN_HOURS, True))
+        self.assertEqual([s['stage'] for s in experiment['metrics']['stages']][:2], ['clean', 'trim'])
+        self.assertTrue(os.path.exists(experiment['log_file']))
+        self.assertTrue(os.path.isdir(os.path.join(experiment['directory'], '4hour_bins_Combined_CLAMS_data')))
+
+    def test_failing_experiment(self):
+        output_path = os.path.join(self.directory.name, 'report.json')
+        exit_code, report = run_batch_cli(
+            self.options(self.write_manifest(['good,1,light', 'no_config,1,light', 'missing,1,light']))
+            + ['--output', output_path])
+        self.assertEqual(exit_code, 1)
+        self.assertEqual((report['succeeded'], report['failed']), (1, 2))
+        # Reported in the order of the manifest
+        self.assertEqual([(os.path.basename(e['directory']), e['status']) for e in report['experiments']],
+                         [('good', 'success'), ('no_config', 'failure'), ('missing', 'failure')])
+        self.assertIn('FileNotFoundError', report['experiments'][2]['error'])
+        with open(output_path) as f:
+            self.assertEqual(json.load(f)['experiments'], report['experiments'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import clams_processing
+from benchmarks.bench_engine import available_engines
+from benchmarks.bench_io import compare_outputs
+from tests.utils import copy_experiment, make_experiment, run_pipeline
+
+HAS_POLARS = 'polars' in available_engines()
+
+
+class EngineTests(unittest.TestCase):
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            clams_processing.get_engine('spark')
+
+    def test_default_engine(self):
+        self.assertIs(clams_processing.get_engine('pandas'), clams_processing)
+
+
+@unittest.skipUnless(HAS_POLARS, 'polars is not installed')
+class PolarsEngineTests(unittest.TestCase):
+    """The Polars engine writes the same files as the pandas engine."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        # Multi-channel exports are split by CHAN in the clean stage of both engines
+        cls.source = make_experiment(os.path.join(cls.directory.name, 'source'), channels_per_file=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def assert_same_outputs(self, **kwargs):
+        reference = copy_experiment(self.source, os.path.join(self.directory.name, 'pandas'))
+        run_pipeline(reference, engine='pandas', **kwargs)
+        directory_path = copy_experiment(self.source, os.path.join(self.directory.name, 'polars'))
+        run_pipeline(directory_path, engine='polars', **kwargs)
+        self.assertEqual(compare_outputs(reference, directory_path, identical=True), [])
+
+    def tearDown(self):
+        for engine in ('pandas', 'polars'):
+            directory_path = os.path.join(self.directory.name, engine)
+            shutil.rmtree(directory_path, ignore_errors=True)
+
+    def test_fixed_bins(self):
+        self.assert_same_outputs()
+
+    def test_rolling_windows(self):
+        self.assert_same_outputs(rolling_windows=[(6, 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
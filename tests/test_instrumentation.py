@@ -0,0 +1,36 @@
+import json
+import unittest
+
+from instrumentation import collect, file_step, stage
+
+
+class CollectTests(unittest.TestCase):
+
+    def test_stage_totals(self):
+        with self.assertLogs('instrumentation', 'INFO') as logs, collect(job_id='job') as metrics:
+            for stage_name, files in (('clean', 3), ('trim', 2)):
+                with stage(stage_name):
+                    for index in range(files):
+                        with file_step(stage_name, f'{index}.csv') as step:
+                            step.update(rows_in=10, rows_out=8)
+
+        result = metrics.as_dict()
+        # Only the number of file steps is returned, their records are logged
+        self.assertEqual(result['files'], 5)
+        self.assertEqual([(s['stage'], s['files'], s['rows_in'], s['rows_out']) for s in result['stages']],
+                         [('clean', 3, 30, 24), ('trim', 2, 20, 16)])
+        records = [json.loads(line.split(':', 2)[2]) for line in logs.output]
+        self.assertEqual(sum(record['event'] == 'file' for record in records), 5)
+        self.assertTrue(all(record['job_id'] == 'job' for record in records))
+
+    def test_rows_set_by_stage(self):
+        with collect() as metrics:
+            with stage('recombine') as info:
+                with file_step('recombine', 'a.csv') as step:
+                    step.update(rows_in=10, rows_out=10)
+                info['rows_out'] = 4
+        self.assertEqual(metrics.as_dict()['stages'][0]['rows_out'], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
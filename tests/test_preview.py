@@ -0,0 +1,58 @@
+import unittest
+
+import numpy as np
+
+from clams_preview import light_phases, lttb
+
+
+class LttbTests(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.x = np.arange(1000, dtype=float) / 4
+        self.y = rng.normal(3000, 100, 1000)
+
+    def test_endpoints_and_length(self):
+        x, y = lttb(self.x, self.y, 50)
+        self.assertEqual((len(x), len(y)), (50, 50))
+        self.assertEqual((x[0], x[-1]), (self.x[0], self.x[-1]))
+        self.assertEqual((y[0], y[-1]), (self.y[0], self.y[-1]))
+        # A point of every bucket, in order
+        self.assertTrue((np.diff(x) > 0).all())
+        np.testing.assert_array_equal(y, self.y[np.searchsorted(self.x, x)])
+
+    def test_largest_peak_kept(self):
+        self.y[537] = 10000
+        self.y[812] = -5000
+        x, y = lttb(self.x, self.y, 20)
+        self.assertIn(self.x[537], x)
+        self.assertIn(self.x[812], x)
+        self.assertEqual(y.max(), 10000)
+
+    def test_short_series(self):
+        # Series with no more points than asked for, or thresholds too small for buckets, are kept whole
+        for threshold in (1000, 2000, 2):
+            with self.subTest(threshold=threshold):
+                x, y = lttb(self.x, self.y, threshold)
+                self.assertIs(x, self.x)
+                self.assertIs(y, self.y)
+
+
+class LightPhaseTests(unittest.TestCase):
+
+    def test_runs(self):
+        hours = np.array([0, 0.25, 0.5, 0.75, 1, 1.25])
+        lightness = np.array([100, 100, 0, 0, 0, 100])
+        self.assertEqual(light_phases(hours, lightness), [
+            {'start': 0.0, 'end': 0.25, 'dark': False},
+            {'start': 0.5, 'end': 1.0, 'dark': True},
+            {'start': 1.25, 'end': 1.25, 'dark': False},
+        ])
+
+    def test_single_phase(self):
+        self.assertEqual(light_phases(np.array([0, 1 / 3]), np.array([0, 0])),
+                         [{'start': 0.0, 'end': 0.3333, 'dark': True}])
+
+
+if __name__ == '__main__':
+    unittest.main()
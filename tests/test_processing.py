@@ -0,0 +1,147 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import clams_processing
+from clams_io import read_csv
+from clams_processing import BINNED_COLUMNS, LAST_VALUE_COLUMNS, SUM_COLUMNS
+from clams_profiles import parse_datetimes
+from tests.utils import KEEP_HOURS, START_DARK, TRIM_HOURS, make_experiment
+
+
+def single_channel_export(lines, channel, subject_id):
+    """Lines of the export of one channel of a multi-channel export, as the software writes for a single cage."""
+    metadata = {'Subject ID': subject_id, 'Subject Mass': '25.00', 'Cage': channel, 'Channel': channel}
+    header_index = lines.index(':DATA\n') + 1
+    single = [f"{line.split(',')[0]},{metadata[line.split(',')[0]]}\n" if line.split(',')[0] in metadata else line
+              for line in lines[:header_index + 3]]
+    return single + [line for line in lines[header_index + 3:] if line.split(',')[1] == channel]
+
+
+class SplitExportTests(unittest.TestCase):
+    """Exports holding several channels are cleaned into the files of their subjects."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        source = make_experiment(os.path.join(self.directory.name, 'source'), subjects=2, channels_per_file=2)
+        self.export_path = os.path.join(source, 'synthetic_0001.CSV')
+        with open(self.export_path) as f:
+            self.lines = f.readlines()
+
+    def clean(self, file_path, name):
+        output_directory = os.path.join(self.directory.name, name)
+        os.makedirs(output_directory, exist_ok=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return clams_processing.clean_clams_export(file_path, output_directory)
+
+    def test_split_as_single_exports(self):
+        # A separator row closes the data of some exports
+        separator = self.lines[self.lines.index(':DATA\n') + 3]
+        with open(self.export_path, 'a') as f:
+            f.write(separator)
+        split_paths = self.clean(self.export_path, 'split')
+        self.assertEqual([os.path.basename(path) for path in split_paths],
+                         ['synthetic_0001_ID1001.csv', 'synthetic_0001_ID1002.csv'])
+
+        # Every split file reads back as the cleaned file of an export of its channel alone
+        for channel, subject_id, split_path in zip(['1', '2'], ['1001', '1002'], split_paths):
+            with self.subTest(channel=channel):
+                single_directory = os.path.join(self.directory.name, f"channel_{channel}")
+                os.makedirs(single_directory)
+                single_path = os.path.join(single_directory, 'synthetic_0001.CSV')
+                with open(single_path, 'w') as f:
+                    f.writelines(single_channel_export(self.lines, channel, subject_id))
+                [cleaned_path] = self.clean(single_path, f"cleaned_{channel}")
+                self.assertEqual(os.path.basename(cleaned_path), os.path.basename(split_path))
+                self.assertTrue(read_csv(split_path).equals(read_csv(cleaned_path)))
+
+    def test_channel_without_subject_id(self):
+        header_index = self.lines.index(':DATA\n') + 1
+        row = self.lines[header_index + 3].split(',')
+        row[1] = '3'
+        with open(self.export_path, 'a') as f:
+            f.write(','.join(row))
+        with self.assertRaisesRegex(ValueError, 'Channel 3'):
+            self.clean(self.export_path, 'split')
+
+
+def naive_windows(df, window_hours, step_hours):
+    """Aggregate every rolling window of a trimmed frame on its own, as roll_clams_frame should."""
+    df = df.copy()
+    df['DATE/TIME'] = parse_datetimes(df['DATE/TIME'])
+    df['AMB'] = df['XAMB'] + df['YAMB']
+    df['AMB ACC'] = df['AMB'].cumsum()
+    elapsed = (df['DATE/TIME'] - df['DATE/TIME'].iloc[0]).dt.total_seconds() / 3600
+    interval = elapsed.diff().median()
+
+    # Only windows that end before the sample following the last one are complete
+    windows = []
+    index = 0
+    while index * step_hours + window_hours <= elapsed.iloc[-1] + interval + 1e-9:
+        start = index * step_hours
+        index += 1
+        rows = df[(elapsed >= start - 1e-9) & (elapsed < start + window_hours - 1e-9)]
+        if len(rows) < 2:
+            continue
+        window = {column: rows[column].mean() for column in BINNED_COLUMNS if column in df.columns}
+        window.update({column: rows[column].sum() for column in SUM_COLUMNS})
+        window.update({column: rows[column].dropna().iloc[-1] for column in LAST_VALUE_COLUMNS
+                       if column in BINNED_COLUMNS})
+        hour = start + window_hours
+        window.update({
+            'INTERVAL_start': rows['INTERVAL'].iloc[0], 'INTERVAL_end': rows['INTERVAL'].iloc[-1],
+            'DATE/TIME_start': rows['DATE/TIME'].iloc[0], 'DATE/TIME_end': rows['DATE/TIME'].iloc[-1],
+            'HOUR': hour, 'DAY': int(np.ceil(hour / 24)), '24 HOUR': hour - 24 * (np.ceil(hour / 24) - 1)})
+        window['DURATION'] = (window['DATE/TIME_end'] - window['DATE/TIME_start']).total_seconds() / 3600
+        windows.append(window)
+    return pd.DataFrame(windows, columns=BINNED_COLUMNS).round(4)
+
+
+class RollingWindowTests(unittest.TestCase):
+    """roll_clams_frame gives the windows aggregated one by one."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        source = make_experiment(os.path.join(cls.directory.name, 'source'), subjects=1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            cleaned_path = clams_processing.clean_clams_file(os.path.join(source, 'synthetic_0001.CSV'),
+                                                             cls.directory.name)
+            trimmed_path = clams_processing.trim_clams_file(cleaned_path, cls.directory.name, TRIM_HOURS, KEEP_HOURS,
+                                                            START_DARK)
+        cls.trimmed = read_csv(trimmed_path)
+        # Missing values, including the last values of some windows
+        cls.trimmed.loc[[3, 10, 11], 'VO2'] = np.nan
+        cls.trimmed.loc[[7, 8, 20], 'WHEEL ACC'] = np.nan
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def assert_naive(self, window_hours, step_hours):
+        rolled = clams_processing.roll_clams_frame(self.trimmed.copy(), window_hours, step_hours)
+        expected = naive_windows(self.trimmed, window_hours, step_hours)
+        pd.testing.assert_frame_equal(rolled, expected, check_dtype=False, rtol=0, atol=2e-4)
+        return rolled
+
+    def test_windows(self):
+        for window_hours, step_hours in [(3, 0.5), (1, 1), (2, 3)]:
+            with self.subTest(window_hours=window_hours, step_hours=step_hours):
+                self.assertGreater(len(self.assert_naive(window_hours, step_hours)), 0)
+
+    def test_step_not_dividing_recording(self):
+        rolled = self.assert_naive(5, 1.75)
+        self.assertEqual(rolled['HOUR'].iloc[1] - rolled['HOUR'].iloc[0], 1.75)
+
+    def test_window_wider_than_recording(self):
+        self.assertEqual(len(self.assert_naive(KEEP_HOURS + 1, 1)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import glob
+import os
+import re
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import pandas as pd
+
+import clams_profiles
+from benchmarks.bench_engine import available_engines
+from tests.utils import make_experiment, run_pipeline
+
+
+def to_day_first(directory_path):
+    """Rewrite the month-first timestamps of the raw exports of an experiment day-first, as European exports are."""
+    for file_path in glob.glob(os.path.join(directory_path, '*.CSV')):
+        with open(file_path) as f:
+            text = f.read()
+        with open(file_path, 'w') as f:
+            f.write(re.sub(r'\b(\d\d)/(\d\d)/(\d{4})\b', r'\2/\1/\3', text))
+    return directory_path
+
+
+def reset_caches():
+    """Forget the layouts and date formats seen by this process, as in a new worker."""
+    clams_profiles._profiles.clear()
+    clams_profiles._layout_date_formats.clear()
+    clams_profiles._date_formats.clear()
+    clams_profiles._candidate_formats.clear()
+
+
+def trimmed_rows(directory_path):
+    return [len(pd.read_csv(path)) for path in sorted(glob.glob(os.path.join(directory_path, 'Trimmed_CLAMS_data',
+                                                                             '*.csv')))]
+
+
+class DateOrderTests(unittest.TestCase):
+    """Day-first and month-first exports of the same layout are processed in one process.
+
+    The synthetic exports start on the 1st of January and last two days, so every timestamp also parses with day and
+    month swapped.
+    """
+
+    def setUp(self):
+        # Profiles and date formats are cached for the whole process
+        reset_caches()
+        self.addCleanup(reset_caches)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def experiment(self, name, day_first):
+        directory_path = make_experiment(os.path.join(self.directory.name, name))
+        return to_day_first(directory_path) if day_first else directory_path
+
+    def assert_orders(self, orders, engine='pandas'):
+        # Each export alone keeps every row of the kept hours
+        expected = []
+        for day_first in orders:
+            reset_caches()
+            directory_path = self.experiment(f'alone_{len(expected)}', day_first)
+            run_pipeline(directory_path, engine=engine)
+            expected.append(trimmed_rows(directory_path))
+
+        reset_caches()
+        for i, day_first in enumerate(orders):
+            directory_path = self.experiment(f'together_{i}', day_first)
+            run_pipeline(directory_path, engine=engine)
+            self.assertEqual(trimmed_rows(directory_path), expected[i])
+
+    def test_day_first_then_month_first(self):
+        self.assert_orders([True, False])
+
+    def test_month_first_then_day_first(self):
+        self.assert_orders([False, True, False])
+
+    @unittest.skipUnless('polars' in available_engines(), 'polars is not installed')
+    def test_polars_engine(self):
+        self.assert_orders([True, False], engine='polars')
+
+    def test_profiles_by_date_order(self):
+        month_first = self.experiment('us', day_first=False)
+        day_first = self.experiment('eu', day_first=True)
+        us_profile = clams_profiles.get_profile(sorted(glob.glob(os.path.join(month_first, '*.CSV')))[0])
+        eu_profile = clams_profiles.get_profile(sorted(glob.glob(os.path.join(day_first, '*.CSV')))[0])
+        self.assertEqual(us_profile.date_format, '%m/%d/%Y %I:%M:%S %p')
+        self.assertEqual(eu_profile.date_format, '%d/%m/%Y %I:%M:%S %p')
+        self.assertNotEqual(us_profile.signature, eu_profile.signature)
+
+        # Cleaned files are parsed with the order their values fit once both layouts are known
+        times = pd.Series(['01/02/2024 10:00:00 AM', '01/02/2024 11:00:00 PM', '02/02/2024 09:00:00 AM'])
+        self.assertEqual(clams_profiles.parse_datetimes(times).dt.month.tolist(), [2, 2, 2])
+        times = pd.Series(['01/02/2024 10:00:00 AM', '01/02/2024 11:00:00 PM', '01/03/2024 09:00:00 AM'])
+        self.assertEqual(clams_profiles.parse_datetimes(times).dt.month.tolist(), [1, 1, 1])
+
+
+class ProfileCacheTests(unittest.TestCase):
+    """Exports of a known layout are only sampled again when their day and month could be in either order."""
+
+    def setUp(self):
+        reset_caches()
+        self.addCleanup(reset_caches)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def exports(self, name, day_first=False, **kwargs):
+        directory_path = make_experiment(os.path.join(self.directory.name, name), **kwargs)
+        if day_first:
+            to_day_first(directory_path)
+        return sorted(glob.glob(os.path.join(directory_path, '*.CSV')))
+
+    def test_known_layout(self):
+        # Timestamps from the 13th on only fit one order
+        first, second = self.exports('late', start_time=datetime(2024, 1, 13, 10))[:2]
+        profile = clams_profiles.get_profile(first)
+        self.assertEqual(profile.date_format, '%m/%d/%Y %I:%M:%S %p')
+        with mock.patch('clams_profiles._detect_date_format', side_effect=AssertionError('sampled again')):
+            self.assertIs(clams_profiles.get_profile(second), profile)
+
+    def test_order_from_first_rows(self):
+        # The first rows of the exports span two days, which only fits one order
+        export = self.exports('eu', day_first=True)[0]
+        with mock.patch('clams_profiles._tail_rows', side_effect=AssertionError('end of the file read')):
+            self.assertEqual(clams_profiles.get_profile(export).date_format, '%d/%m/%Y %I:%M:%S %p')
+
+    def test_order_from_last_rows(self):
+        # The first rows of exports sampled every minute fall on one day, the last ones tell the order
+        export = self.exports('eu', day_first=True, subjects=1, days=1, interval_minutes=1)[0]
+        with mock.patch('clams_profiles._tail_rows', wraps=clams_profiles._tail_rows) as tail_rows:
+            self.assertEqual(clams_profiles.get_profile(export).date_format, '%d/%m/%Y %I:%M:%S %p')
+        tail_rows.assert_called_once_with(export)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,278 @@
+import hashlib
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from clams_storage import (LocalStorage, S3Storage, blob_key, collect_garbage, delete_upload, fetch, open_storage,
+                           put_blob, references, store_upload_file, workspace)
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    boto3 = None
+
+BUCKET = 'clams-test'
+
+
+class StorageCase:
+    """Storage created for each test by make_storage."""
+
+    def make_storage(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.storage = self.make_storage()
+
+    def put(self, key, data):
+        with self.storage.open(key, 'wb') as f:
+            f.write(data)
+
+
+class StorageContract(StorageCase):
+    """Behaviour every storage backend shares, run against each backend by the subclasses."""
+
+    def test_write_and_read(self):
+        self.put('upload/config/experiment_config.csv', b'ID,GROUP\n1,A\n')
+        with self.storage.open('upload/config/experiment_config.csv') as f:
+            self.assertEqual(f.read(), b'ID,GROUP\n1,A\n')
+        self.assertTrue(self.storage.exists('upload/config/experiment_config.csv'))
+        self.assertFalse(self.storage.exists('upload/config/missing.csv'))
+        self.assertEqual(self.storage.size('upload/config/experiment_config.csv'), 13)
+
+    def test_failed_write_is_discarded(self):
+        with self.assertRaises(RuntimeError):
+            with self.storage.open('upload/partial.csv', 'wb') as f:
+                f.write(b'partial')
+                raise RuntimeError
+        self.assertFalse(self.storage.exists('upload/partial.csv'))
+
+    def test_read_head(self):
+        self.put('upload/data.csv', b'0123456789')
+        self.assertEqual(self.storage.read_head('upload/data.csv', 4), b'0123')
+        self.assertEqual(self.storage.read_head('upload/data.csv', 100), b'0123456789')
+        self.put('upload/empty.csv', b'')
+        self.assertEqual(self.storage.read_head('upload/empty.csv', 4), b'')
+
+    def test_list_and_delete(self):
+        for key in ('a/1.csv', 'a/b/2.csv', 'ab/3.csv', 'c/4.csv'):
+            self.put(key, key.encode())
+        self.assertEqual([key for key, _, _ in self.storage.list('a/')], ['a/1.csv', 'a/b/2.csv'])
+        self.assertEqual([size for _, size, _ in self.storage.list('c/')], [7])
+
+        self.storage.delete('a/1.csv')
+        self.assertEqual([key for key, _, _ in self.storage.list('a/')], ['a/b/2.csv'])
+        self.storage.delete('a/')
+        self.assertEqual([key for key, _, _ in self.storage.list('')], ['ab/3.csv', 'c/4.csv'])
+        # Deleting what does not exist is not an error
+        self.storage.delete('a/')
+        self.storage.delete('missing.csv')
+
+    def test_version_changes_with_content(self):
+        self.put('upload/data.csv', b'first')
+        [(_, _, first)] = self.storage.list('upload/')
+        self.put('upload/data.csv', b'second version')
+        [(_, _, second)] = self.storage.list('upload/')
+        self.assertNotEqual(first, second)
+
+    def test_touch(self):
+        self.assertFalse(self.storage.touch('upload/missing.csv'))
+        self.put('upload/data.csv', b'data')
+        self.assertTrue(self.storage.touch('upload/data.csv'))
+        with self.storage.open('upload/data.csv') as f:
+            self.assertEqual(f.read(), b'data')
+
+    def test_upload_and_download_file(self):
+        source = os.path.join(self.directory.name, 'source.csv')
+        with open(source, 'wb') as f:
+            f.write(b'results')
+        self.storage.upload_file(source, 'upload/results.csv')
+        target = os.path.join(self.directory.name, 'target.csv')
+        self.storage.download_file('upload/results.csv', target)
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), b'results')
+
+    def test_workspace(self):
+        self.put('upload/config/experiment_config.csv', b'config')
+        self.put('upload/data/1.csv', b'data')
+        with workspace(self.storage, 'upload/', os.path.join(self.directory.name, 'work')) as directory:
+            self.assertEqual(os.path.basename(directory), 'upload')
+            with open(os.path.join(directory, 'config', 'experiment_config.csv'), 'rb') as f:
+                self.assertEqual(f.read(), b'config')
+            with open(os.path.join(directory, 'data', '1.csv'), 'rb') as f:
+                self.assertEqual(f.read(), b'data')
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def unread():
+    """Content that fails the test if it is read, for blobs that are stored already."""
+    raise AssertionError('The content of a stored blob was read again')
+    yield
+
+
+class BlobContract(StorageCase):
+    """Uploaded files stored once per content and the blobs deleted once no upload references them."""
+
+    def store(self, upload_id, name, data):
+        return store_upload_file(self.storage, upload_id, name, digest(data), [data])
+
+    def blobs(self):
+        return [key for key, _, _ in self.storage.list('blobs/')]
+
+    def test_put_blob_once(self):
+        self.assertTrue(put_blob(self.storage, digest(b'data'), [b'da', b'ta']))
+        self.assertFalse(put_blob(self.storage, digest(b'data'), unread()))
+        self.assertEqual(self.blobs(), [blob_key(digest(b'data'))])
+        with self.storage.open(blob_key(digest(b'data'))) as f:
+            self.assertEqual(f.read(), b'data')
+
+    def test_uploads_share_blobs(self):
+        self.assertTrue(self.store('first', 'data/1.csv', b'same'))
+        self.assertTrue(self.store('first', 'config/experiment_config.csv', b'config'))
+        self.assertFalse(self.store('second', 'data/1.csv', b'same'))
+        self.assertEqual(len(self.blobs()), 2)
+        self.assertEqual(references(self.storage, 'first'), [
+            ('config/experiment_config.csv', digest(b'config')), ('data/1.csv', digest(b'same'))])
+        self.assertEqual(references(self.storage, 'second'), [('data/1.csv', digest(b'same'))])
+
+    def test_replaced_file(self):
+        self.store('upload', 'data/1.csv', b'first')
+        self.store('upload', 'data/1.csv', b'second')
+        self.assertEqual(references(self.storage, 'upload'), [('data/1.csv', digest(b'second'))])
+        # The blob of the replaced content is no longer referenced
+        self.assertEqual(collect_garbage(self.storage, min_age=-1), 1)
+        self.assertEqual(self.blobs(), [blob_key(digest(b'second'))])
+
+    def test_collect_garbage(self):
+        self.store('first', 'data/1.csv', b'shared')
+        self.store('first', 'data/2.csv', b'first only')
+        self.store('second', 'data/1.csv', b'shared')
+        self.assertEqual(collect_garbage(self.storage, min_age=-1), 0)
+
+        delete_upload(self.storage, 'first')
+        self.assertEqual(references(self.storage, 'first'), [])
+        self.assertEqual(self.storage.list('first/'), [])
+        # The blob is kept until it is older than min_age, in case an upload in progress stores it again
+        self.assertEqual(collect_garbage(self.storage), 0)
+        self.assertEqual(len(self.blobs()), 2)
+        self.assertEqual(collect_garbage(self.storage, min_age=-1), 1)
+        self.assertEqual(self.blobs(), [blob_key(digest(b'shared'))])
+
+        delete_upload(self.storage, 'second')
+        self.assertEqual(collect_garbage(self.storage, min_age=-1), 1)
+        self.assertEqual(self.blobs(), [])
+
+    def test_workspace_of_blobs(self):
+        self.store('upload', 'data/1.csv', b'data')
+        blobs = references(self.storage, 'upload')
+        with workspace(self.storage, 'upload/', os.path.join(self.directory.name, 'work'), blobs=blobs) as directory:
+            with open(os.path.join(directory, 'data', '1.csv'), 'rb') as f:
+                self.assertEqual(f.read(), b'data')
+
+
+class LocalStorageTests(StorageContract, unittest.TestCase):
+
+    def make_storage(self):
+        return LocalStorage(os.path.join(self.directory.name, 'storage'))
+
+    def test_key_outside_of_storage(self):
+        with self.assertRaises(ValueError):
+            self.storage.path('../outside.csv')
+
+    def test_open_storage(self):
+        storage = open_storage(f"file://{self.directory.name}")
+        self.assertIsInstance(storage, LocalStorage)
+        self.assertEqual(storage.root, os.path.abspath(self.directory.name))
+
+
+@unittest.skipIf(boto3 is None, 'boto3 and moto are not installed')
+class S3StorageTests(StorageContract, unittest.TestCase):
+    """The S3 backend, against the S3 API mocked by moto."""
+
+    def make_storage(self):
+        # moto refuses to run with real credentials, fake ones keep the tests from reaching AWS
+        environment = mock.patch.dict(os.environ, {
+            'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing', 'AWS_SESSION_TOKEN': 'testing',
+            'AWS_DEFAULT_REGION': 'us-east-1'})
+        environment.start()
+        self.addCleanup(environment.stop)
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        boto3.client('s3').create_bucket(Bucket=BUCKET)
+        return S3Storage(BUCKET, prefix='clams')
+
+    def test_prefix(self):
+        self.put('upload/data.csv', b'data')
+        names = [item['Key'] for item in self.storage.client.list_objects_v2(Bucket=BUCKET)['Contents']]
+        self.assertEqual(names, ['clams/upload/data.csv'])
+        self.assertEqual([key for key, _, _ in self.storage.list('')], ['upload/data.csv'])
+
+    def test_open_storage(self):
+        storage = open_storage(f"s3://{BUCKET}/clams/")
+        self.assertIsInstance(storage, S3Storage)
+        self.assertEqual((storage.bucket, storage.prefix), (BUCKET, 'clams/'))
+
+    def test_delete_many(self):
+        # Deleted in requests of up to 1000 objects
+        client = self.storage.client
+        for index in range(1001):
+            client.put_object(Bucket=BUCKET, Key=f"clams/upload/{index}.csv", Body=b'')
+        self.storage.delete('upload/')
+        self.assertEqual(self.storage.list('upload/'), [])
+
+    def test_fetch_cached(self):
+        self.put('upload/data.csv', b'data')
+        cache = os.path.join(self.directory.name, 'cache')
+        first = os.path.join(self.directory.name, 'first')
+        self.assertEqual(fetch(self.storage, 'upload/', first, cache), 4)
+        # The same version is linked from the cache instead of downloaded again
+        second = os.path.join(self.directory.name, 'second')
+        self.assertEqual(fetch(self.storage, 'upload/', second, cache), 0)
+        with open(os.path.join(second, 'data.csv'), 'rb') as f:
+            self.assertEqual(f.read(), b'data')
+        self.put('upload/data.csv', b'changed')
+        self.assertEqual(fetch(self.storage, 'upload/', os.path.join(self.directory.name, 'third'), cache), 7)
+
+
+class LocalBlobTests(BlobContract, unittest.TestCase):
+    make_storage = LocalStorageTests.make_storage
+
+    def test_upload_links_blobs(self):
+        self.store('upload', 'data/1.csv', b'data')
+        self.assertTrue(os.path.samefile(self.storage.path('upload/data/1.csv'),
+                                         self.storage.path(blob_key(digest(b'data')))))
+
+    def test_reuse_keeps_blob(self):
+        self.store('first', 'data/1.csv', b'data')
+        delete_upload(self.storage, 'first')
+        path = self.storage.path(blob_key(digest(b'data')))
+        old = time.time() - 7200
+        os.utime(path, (old, old))
+        # Storing the content again makes the blob recent, so it is not collected before the new reference is read
+        self.assertFalse(put_blob(self.storage, digest(b'data'), unread()))
+        self.assertEqual(collect_garbage(self.storage), 0)
+        os.utime(path, (old, old))
+        self.assertEqual(collect_garbage(self.storage), 1)
+
+    def test_partial_blob_kept(self):
+        with self.storage.open('blobs/ab/.abc.tmp', 'wb') as f:
+            f.write(b'partial')
+        self.assertEqual(collect_garbage(self.storage, min_age=-1), 0)
+        self.assertEqual(self.blobs(), ['blobs/ab/.abc.tmp'])
+
+
+@unittest.skipIf(boto3 is None, 'boto3 and moto are not installed')
+class S3BlobTests(BlobContract, unittest.TestCase):
+    make_storage = S3StorageTests.make_storage
+
+
+if __name__ == '__main__':
+    unittest.main()
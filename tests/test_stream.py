@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+
+import clams_processing
+from benchmarks.bench_io import compare_outputs
+from tests.utils import copy_experiment, make_experiment, run_pipeline
+
+
+class StreamPipelineTests(unittest.TestCase):
+    """Processing subject by subject writes the same files as processing stage by stage."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.source = make_experiment(os.path.join(cls.directory.name, 'source'), subjects=5)
+        cls.reference = copy_experiment(cls.source, os.path.join(cls.directory.name, 'stages'))
+        run_pipeline(cls.reference, rolling_windows=[(6, 2)])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def test_same_outputs(self):
+        for max_subjects in (1, 2, 8):
+            with self.subTest(max_subjects=max_subjects):
+                directory = copy_experiment(self.source, os.path.join(self.directory.name, f'stream_{max_subjects}'))
+                run_pipeline(directory, clams_processing.stream_pipeline, rolling_windows=[(6, 2)],
+                             max_subjects=max_subjects)
+                self.assertEqual(compare_outputs(self.reference, directory, identical=True), [])
+
+    def test_binned_files_of_previous_run(self):
+        # Binned files without a cleaned subject to stream are read from disk
+        directory = copy_experiment(self.reference, os.path.join(self.directory.name, 'previous'))
+        cleaned_directory = os.path.join(directory, 'Cleaned_CLAMS_data')
+        removed = sorted(os.listdir(cleaned_directory))[0]
+        os.remove(os.path.join(cleaned_directory, removed))
+        run_pipeline(directory, clams_processing.stream_pipeline, rolling_windows=[(6, 2)])
+        self.assertEqual(compare_outputs(self.reference, directory, identical=True),
+                         [os.path.join('Cleaned_CLAMS_data', removed)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import contextlib
+import glob
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+import clams_watch
+from tests.utils import BIN_HOURS, KEEP_HOURS, START_DARK, TRIM_HOURS, config_file, copy_experiment, make_experiment, \
+    run_pipeline
+
+
+class WatchOnceTests(unittest.TestCase):
+    """Runs with --once keep the outputs of an export folder up to date as exports arrive and change."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.source = make_experiment(os.path.join(self.directory.name, 'source'), subjects=3)
+        self.root = os.path.join(self.directory.name, 'exports')
+        self.experiment = os.path.join(self.root, 'experiment')
+        os.makedirs(os.path.join(self.experiment, 'config'))
+        shutil.copy(config_file(self.source), os.path.join(self.experiment, 'config'))
+        for name in ('synthetic_0001.CSV', 'synthetic_0002.CSV'):
+            shutil.copy(os.path.join(self.source, name), self.experiment)
+
+    def watch_once(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            clams_watch.watch(self.root, TRIM_HOURS, KEEP_HOURS, BIN_HOURS, START_DARK, settle=0, once=True)
+
+    def combined(self, directory=None):
+        path = os.path.join(directory or self.experiment, '4hour_bins_Combined_CLAMS_data', 'VO2.csv')
+        return pd.read_csv(path).sort_values(['ID', 'HOUR'], ignore_index=True)
+
+    def outputs(self, pattern):
+        return sorted(os.path.basename(path) for path in glob.glob(os.path.join(self.experiment, pattern, '*.csv')))
+
+    def trimmed_mtime(self, subject_id):
+        [path] = glob.glob(os.path.join(self.experiment, 'Trimmed_CLAMS_data', f'*_ID{subject_id}_trimmed.csv'))
+        return os.stat(path).st_mtime_ns
+
+    def test_new_export(self):
+        self.watch_once()
+        self.assertEqual(sorted(self.combined()['ID'].unique()), [1001, 1002])
+        first = self.trimmed_mtime(1001)
+
+        shutil.copy(os.path.join(self.source, 'synthetic_0003.CSV'), self.experiment)
+        self.watch_once()
+        # Only the new export is processed, the combined outputs hold every subject
+        self.assertEqual(self.trimmed_mtime(1001), first)
+        reference = copy_experiment(self.source, os.path.join(self.directory.name, 'reference'))
+        run_pipeline(reference)
+        pd.testing.assert_frame_equal(self.combined(), self.combined(reference))
+
+    def test_changed_export(self):
+        self.watch_once()
+        export_path = os.path.join(self.experiment, 'synthetic_0002.CSV')
+        with open(export_path) as f:
+            text = f.read()
+        with open(export_path, 'w') as f:
+            f.write(text.replace('Subject ID,1002', 'Subject ID,1009'))
+        self.watch_once()
+
+        # The outputs of the subject that is no longer in the export are deleted
+        for pattern in ('Cleaned_CLAMS_data', 'Trimmed_CLAMS_data', '4hour_bins_Binned_CLAMS_data'):
+            with self.subTest(pattern=pattern):
+                names = self.outputs(pattern)
+                self.assertEqual(len(names), 2)
+                self.assertFalse([name for name in names if 'ID1002' in name])
+        self.assertEqual(sorted(self.combined()['ID'].unique()), [1001, 1009])
+
+    def test_changed_config(self):
+        self.watch_once()
+        first = self.trimmed_mtime(1001)
+        config = pd.read_csv(config_file(self.experiment))
+        config.loc[config['ID'] == 1001, 'GROUP_LABEL'] = 'Relabelled'
+        config.to_csv(config_file(self.experiment), index=False)
+        self.watch_once()
+
+        # The combined outputs are rewritten with the new labels without processing the exports again
+        self.assertEqual(self.trimmed_mtime(1001), first)
+        labels = self.combined().drop_duplicates('ID').set_index('ID')['GROUP_LABEL'].to_dict()
+        self.assertEqual(labels, {1001: 'Relabelled', 1002: 'Group2'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+"""Helpers shared by the tests of the processing pipeline."""
+import contextlib
+import io
+import os
+import shutil
+
+import clams_processing
+from benchmarks.synthetic import generate_experiment
+
+# Processing parameters of the test experiments, small enough for the whole pipeline to run in about a second
+SUBJECTS = 4
+DAYS = 2
+INTERVAL_MINUTES = 15
+TRIM_HOURS = 2
+KEEP_HOURS = 24
+BIN_HOURS = [1, 4]
+START_DARK = False
+
+
+def make_experiment(directory_path, **kwargs):
+    """Write a small synthetic experiment, see benchmarks.synthetic.generate_experiment."""
+    options = {'subjects': SUBJECTS, 'days': DAYS, 'interval_minutes': INTERVAL_MINUTES}
+    options.update(kwargs)
+    generate_experiment(directory_path, **options)
+    return directory_path
+
+
+def copy_experiment(source, directory_path):
+    """Copy an experiment directory, to process it again from its raw exports."""
+    shutil.copytree(source, directory_path)
+    return directory_path
+
+
+def config_file(directory_path):
+    return os.path.join(directory_path, 'config', 'experiment_config.csv')
+
+
+def run_pipeline(directory_path, pipeline=None, **kwargs):
+    """Process an experiment with the test parameters, without the progress printed by the stages."""
+    pipeline = pipeline or clams_processing.run_pipeline
+    with contextlib.redirect_stdout(io.StringIO()):
+        pipeline(directory_path, TRIM_HOURS, KEEP_HOURS, BIN_HOURS, START_DARK, config_file(directory_path), **kwargs)
@@ -0,0 +1,91 @@
+"""Admission control of processing jobs.
+
+Every upload has at most one active job. A submission with the same parameters as the active job of its upload, e.g. a
+double click or a browser retry, is coalesced onto that job's task ID instead of enqueueing the pipeline again, and a
+submission with other parameters is refused until the job has finished. New jobs are refused while more than
+CLAMS_MAX_PENDING_JOBS jobs are waiting in the queues.
+
+The active job of every upload is kept in the Django cache, which must be shared by all web processes (Redis in the
+default settings). Task IDs are chosen before the task is sent, so duplicates arriving while it is being enqueued are
+coalesced too.
+"""
+import contextlib
+import time
+import uuid
+
+from celery import states
+from celery.result import AsyncResult
+from django.conf import settings
+from django.core.cache import cache
+
+from .metrics import queue_depths
+
+# Seconds a request waits for another request of the same upload to finish its admission
+LOCK_WAIT = 5
+
+
+def _active_job_key(upload_id):
+    return f'clams:active_job:{upload_id}'
+
+
+@contextlib.contextmanager
+def _upload_lock(upload_id):
+    """Serialize the admission of submissions of one upload across web processes."""
+    key = f'clams:admission_lock:{upload_id}'
+    deadline = time.monotonic() + LOCK_WAIT
+    while not cache.add(key, True, timeout=LOCK_WAIT * 2):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Timed out waiting for the admission of another job of upload {upload_id}")
+        time.sleep(0.05)
+    try:
+        yield
+    finally:
+        cache.delete(key)
+
+
+def active_job(upload_id):
+    """Return the active job of an upload as a dict with "task_id" and "parameters", or None."""
+    job = cache.get(_active_job_key(upload_id))
+    if job is not None and AsyncResult(job['task_id']).state in states.READY_STATES:
+        return None
+    return job
+
+
+def pending_jobs():
+    """Return the number of jobs waiting in all queues, 0 if the broker cannot be reached."""
+    return sum(queue_depths().values())
+
+
+def admit_job(upload_id, parameters):
+    """Decide whether to enqueue a new job for an upload.
+
+    Parameters:
+    upload_id (string): ID of the upload to process
+    parameters (dict): processing parameters of the submission, compared with those of the active job
+
+    Returns:
+    tuple: the outcome and a task ID. The outcome is "admitted" for a new job to enqueue with that task ID,
+        "coalesced" when the upload's active job has the same parameters, "conflict" when it has other parameters
+        (the task ID is that of the active job) and "busy" when too many jobs are pending (the task ID is None).
+    """
+    with _upload_lock(upload_id):
+        job = active_job(upload_id)
+        if job is not None:
+            outcome = 'coalesced' if job['parameters'] == parameters else 'conflict'
+            return outcome, job['task_id']
+
+        if pending_jobs() >= settings.CLAMS_MAX_PENDING_JOBS:
+            return 'busy', None
+
+        task_id = str(uuid.uuid4())
+        cache.set(_active_job_key(upload_id), {'task_id': task_id, 'parameters': parameters},
+                  timeout=settings.CLAMS_ACTIVE_JOB_TIMEOUT)
+        return 'admitted', task_id
+
+
+def release_job(upload_id, task_id):
+    """Forget the active job of an upload, e.g. when it could not be enqueued."""
+    with _upload_lock(upload_id):
+        job = cache.get(_active_job_key(upload_id))
+        if job is not None and job['task_id'] == task_id:
+            cache.delete(_active_job_key(upload_id))
@@ -0,0 +1,446 @@
+"""Prometheus-style metrics for the web and worker tiers.
+
+Counters and histograms are kept in memory by each process and written to a small JSON file per process in
+settings.CLAMS_METRICS_DIR when a request or a task has finished, not on every update. Rendering merges the files of
+every process (web and Celery workers) and adds gauges that are computed at scrape time (queue depth and MEDIA_ROOT
+usage, cached for a few minutes), so a single scrape of the /metrics/ endpoint covers the whole deployment without an
+external service. Workers on machines without a shared filesystem can expose their own metrics with
+settings.CLAMS_WORKER_METRICS_PORT.
+
+The files of processes that have exited are merged into archive.json, so the counters of recycled workers are kept
+without one file per process ever started, and a new process that is given the PID of an exited one does not overwrite
+its values.
+"""
+import atexit
+import contextlib
+import glob
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from celery.signals import before_task_publish, task_postrun, task_prerun, worker_init, worker_process_shutdown
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.dispatch import receiver
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where the files of exited processes are not merged
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Default histogram buckets in seconds, from a fast request to a very large job
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+# Buckets in bytes, from a single small export to a large cohort
+SIZE_BUCKETS = (10 ** 5, 10 ** 6, 5 * 10 ** 6, 10 ** 7, 5 * 10 ** 7, 10 ** 8, 5 * 10 ** 8, 10 ** 9, 5 * 10 ** 9)
+
+# Values of the processes that have exited
+ARCHIVE_NAME = 'archive.json'
+# Process files are named <host>-<pid>.json, the host tells the processes of this machine apart on a shared directory
+HOST = socket.gethostname()
+
+
+class Registry:
+    """In-process store of metric values that is persisted to one file per process."""
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+        # Set by every update, the values are only written when they have changed since the last flush
+        self._dirty = False
+        # PID this registry has written its file for, a file found for another process's PID is an exited one's
+        self._pid = None
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def _path(self):
+        return os.path.join(settings.CLAMS_METRICS_DIR, f'{HOST}-{os.getpid()}.json')
+
+    def _after_fork(self):
+        """Start a forked child with empty values, those of the parent stay in the parent's file."""
+        self._lock = threading.Lock()
+        self._dirty = False
+        for metric in self.metrics.values():
+            metric.samples = {}
+
+    def dumps(self):
+        """Serialize the values of every metric that has been updated in this process."""
+        with self._lock:
+            return json.dumps({name: {'type': metric.type, 'help': metric.help, 'samples': metric.samples}
+                               for name, metric in self.metrics.items() if metric.samples})
+
+    def flush(self):
+        """Write this process's values to the metrics directory so other processes can render them."""
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+        try:
+            os.makedirs(settings.CLAMS_METRICS_DIR, exist_ok=True)
+            if self._pid != os.getpid():
+                # A file at this path was left by an exited process with the same PID
+                if os.path.exists(self._path()):
+                    _archive([self._path()])
+                self._pid = os.getpid()
+            # Threads of the same process may flush at the same time
+            tmp_path = f'{self._path()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(self.dumps())
+            os.replace(tmp_path, self._path())
+        except OSError as e:
+            self._dirty = True
+            logger.warning(f"Could not write metrics: {e}")
+
+
+REGISTRY = Registry()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=REGISTRY._after_fork)
+
+
+def _label_key(labelnames, labels):
+    return json.dumps([str(labels.get(name, '')) for name in labelnames])
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.samples = {}
+        self._registry = registry
+        registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._registry._lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+            self._registry._dirty = True
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.samples = {}
+        self._registry = registry
+        registry.register(self)
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._registry._lock:
+            sample = self.samples.setdefault(key, {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0, 'count': 0})
+            # Bucket counts are stored per bucket and made cumulative when rendered
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            sample['buckets'][index] += 1
+            sample['sum'] += value
+            sample['count'] += 1
+            self._registry._dirty = True
+
+
+UPLOAD_BYTES = Counter('clams_upload_bytes_total', 'Bytes received in uploaded files.', ['kind'])
+UPLOAD_FILES = Counter('clams_upload_files_total', 'Number of uploaded files.', ['kind'])
+UPLOAD_BYTES_STORED = Counter('clams_upload_bytes_stored_total', 'Bytes of uploaded files written to the storage, '
+                              'files with content stored before are not written again.', ['kind'])
+JOBS_ENQUEUED = Counter('clams_jobs_enqueued_total', 'Processing jobs sent to the queue.', ['queue'])
+JOB_ADMISSIONS = Counter('clams_job_admissions_total', 'Job submissions by admission outcome (admitted, coalesced, '
+                         'conflict or busy).', ['outcome'])
+UPLOADS_REJECTED = Counter('clams_uploads_rejected_total', 'Uploads rejected by validation before enqueueing a job.')
+JOBS = Counter('clams_jobs_total', 'Processing jobs finished, by status.', ['status'])
+JOB_DURATION = Histogram('clams_job_duration_seconds', 'Wall time of processing jobs.')
+JOB_INPUT_BYTES = Histogram('clams_job_input_bytes', 'Size of the raw exports of processing jobs.',
+                            buckets=SIZE_BUCKETS)
+STAGE_DURATION = Histogram('clams_stage_duration_seconds', 'Wall time of pipeline stages.', ['stage'])
+QUEUE_WAIT = Histogram('clams_queue_wait_seconds', 'Time jobs spent in the queue before a worker started them.',
+                       ['queue'])
+CACHE_REQUESTS = Counter('clams_cache_requests_total', 'Cache lookups, by cache and result (hit or miss).',
+                         ['cache', 'result'])
+
+
+def record_job(result, duration, input_bytes):
+    """Record the outcome of a processing job from the result returned by process_files_task."""
+    JOBS.inc(status='failure' if 'error' in result else 'success')
+    JOB_DURATION.observe(duration)
+    JOB_INPUT_BYTES.observe(input_bytes)
+    for stage in result.get('metrics', {}).get('stages', []):
+        STAGE_DURATION.observe(stage['wall_seconds'], stage=stage['stage'])
+
+
+@receiver(request_finished)
+@task_postrun.connect
+@worker_process_shutdown.connect
+def _flush_registry(**kwargs):
+    REGISTRY.flush()
+
+
+atexit.register(REGISTRY.flush)
+
+
+@before_task_publish.connect
+def _stamp_enqueue_time(headers=None, **kwargs):
+    if headers is not None:
+        headers['clams_enqueued_at'] = time.time()
+
+
+@task_prerun.connect
+def _record_queue_wait(task=None, **kwargs):
+    enqueued_at = getattr(task.request, 'clams_enqueued_at', None)
+    if enqueued_at is not None:
+        queue = (task.request.delivery_info or {}).get('routing_key', '')
+        QUEUE_WAIT.observe(max(time.time() - enqueued_at, 0), queue=queue)
+
+
+def queue_names():
+    """Return the names of the Celery queues jobs can be routed to."""
+    from CLAMS_web.celery import app
+
+    names = [app.conf.task_default_queue]
+    names += [queue.name for queue in app.conf.task_queues or [] if queue.name not in names]
+    return names
+
+
+def queue_depths():
+    """Return the number of messages waiting in each Celery queue, or an empty dict if the broker is unreachable."""
+    from CLAMS_web.celery import app
+
+    depths = {}
+    try:
+        with app.connection_for_read() as connection:
+            channel = connection.default_channel
+            for name in queue_names():
+                depths[name] = channel.queue_declare(queue=name, passive=True).message_count
+    except Exception as e:
+        logger.warning(f"Could not read queue depth: {e}")
+    return depths
+
+
+def disk_usage(path):
+    """Return the total size in bytes and number of files below path."""
+    total_bytes = 0
+    total_files = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                total_bytes += os.path.getsize(os.path.join(root, file))
+                total_files += 1
+            except OSError:
+                continue
+    return total_bytes, total_files
+
+
+@contextlib.contextmanager
+def _directory_lock(exclusive):
+    """Hold a lock on the metrics directory, exclusive to move files into the archive and shared to read them."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(settings.CLAMS_METRICS_DIR, exist_ok=True)
+    with open(os.path.join(settings.CLAMS_METRICS_DIR, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _merge(merged, snapshot):
+    """Add the values of a snapshot to merged."""
+    for name, metric in snapshot.items():
+        target = merged.setdefault(name, {'type': metric['type'], 'help': metric['help'], 'samples': {}})
+        for key, value in metric['samples'].items():
+            if metric['type'] == 'counter':
+                target['samples'][key] = target['samples'].get(key, 0) + value
+            elif key not in target['samples']:
+                target['samples'][key] = {'buckets': list(value['buckets']), 'sum': value['sum'],
+                                          'count': value['count']}
+            else:
+                existing = target['samples'][key]
+                existing['buckets'] = [a + b for a, b in zip(existing['buckets'], value['buckets'])]
+                existing['sum'] += value['sum']
+                existing['count'] += value['count']
+    return merged
+
+
+def _archive(paths):
+    """Merge the files of exited processes into the archive and delete them.
+
+    Readers hold the shared lock, so a scrape sees the values either in the process files or in the archive.
+    """
+    archive_path = os.path.join(settings.CLAMS_METRICS_DIR, ARCHIVE_NAME)
+    with _directory_lock(exclusive=True):
+        # Another process may have archived them since they were found
+        paths = [path for path in paths if os.path.exists(path)]
+        if not paths:
+            return
+        archive = _read_snapshot(archive_path)
+        for path in paths:
+            _merge(archive, _read_snapshot(path))
+        tmp_path = f'{archive_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(archive, f)
+        os.replace(tmp_path, archive_path)
+        for path in paths:
+            os.remove(path)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to another user
+        return True
+    return True
+
+
+def _archive_exited():
+    """Move the files of the processes of this machine that have exited into the archive."""
+    # os.kill does not test for a process on Windows, it terminates it
+    if fcntl is None:
+        return
+    exited = []
+    for path in glob.glob(os.path.join(settings.CLAMS_METRICS_DIR, '*.json')):
+        name = os.path.basename(path)[:-len('.json')]
+        # Files named <pid>.json were written before the host was added to the name
+        pid = name[len(HOST) + 1:] if name.startswith(f'{HOST}-') else name
+        if pid.isdigit() and not _process_alive(int(pid)):
+            exited.append(path)
+    if exited:
+        try:
+            _archive(exited)
+        except OSError as e:
+            logger.warning(f"Could not archive metrics: {e}")
+
+
+def media_usage():
+    """Return disk_usage of MEDIA_ROOT, walked at most once every CLAMS_MEDIA_USAGE_CACHE_SECONDS by all processes."""
+    key = 'clams:media_usage'
+    try:
+        usage = cache.get(key)
+    except Exception as e:
+        logger.warning(f"Could not read the cached MEDIA_ROOT usage: {e}")
+        usage = None
+    if usage is None:
+        usage = disk_usage(settings.MEDIA_ROOT)
+        with contextlib.suppress(Exception):
+            cache.set(key, usage, timeout=settings.CLAMS_MEDIA_USAGE_CACHE_SECONDS)
+    return usage
+
+
+def _merged_snapshots():
+    """Merge the values written by every process, and those of exited processes, into one snapshot."""
+    merged = {}
+    with _directory_lock(exclusive=False):
+        for path in glob.glob(os.path.join(settings.CLAMS_METRICS_DIR, '*.json')):
+            _merge(merged, _read_snapshot(path))
+    return merged
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def render(include_gauges=True):
+    """Render all metrics in the Prometheus text exposition format.
+
+    Parameters:
+    include_gauges (bool): also compute the queue depth and MEDIA_ROOT gauges
+
+    Returns:
+    string: the exposition text
+    """
+    REGISTRY.flush()
+    _archive_exited()
+    snapshot = _merged_snapshots()
+
+    lines = []
+    for name, metric in REGISTRY.metrics.items():
+        samples = snapshot.get(name, {}).get('samples', {})
+        lines.append(f'# HELP {name} {metric.help}')
+        lines.append(f'# TYPE {name} {metric.type}')
+        for key, value in sorted(samples.items()):
+            labels = list(zip(metric.labelnames, json.loads(key)))
+            if metric.type == 'counter':
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(list(metric.buckets) + ['+Inf'], value['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels + [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {value["sum"]}')
+            lines.append(f'{name}_count{_format_labels(labels)} {value["count"]}')
+
+    if include_gauges:
+        lines.append('# HELP clams_queue_depth Messages waiting in each Celery queue.')
+        lines.append('# TYPE clams_queue_depth gauge')
+        for queue, depth in queue_depths().items():
+            lines.append(f'clams_queue_depth{_format_labels([("queue", queue)])} {depth}')
+
+        media_bytes, media_files = media_usage()
+        lines.append('# HELP clams_media_root_bytes Total size of files in MEDIA_ROOT.')
+        lines.append('# TYPE clams_media_root_bytes gauge')
+        lines.append(f'clams_media_root_bytes {media_bytes}')
+        lines.append('# HELP clams_media_root_files Number of files in MEDIA_ROOT.')
+        lines.append('# TYPE clams_media_root_files gauge')
+        lines.append(f'clams_media_root_files {media_files}')
+
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, address=''):
+    """Serve the rendered metrics over HTTP from a background thread."""
+    server = ThreadingHTTPServer((address, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name='metrics-exporter').start()
+    return server
+
+
+@worker_init.connect
+def _start_worker_exporter(**kwargs):
+    port = settings.CLAMS_WORKER_METRICS_PORT
+    if port:
+        serve(port)
+        logger.info(f"Serving worker metrics on port {port}")
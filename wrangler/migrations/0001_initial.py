@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CombinedResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('upload_id', models.CharField(max_length=36)),
+                ('bin_hours', models.FloatField()),
+                ('step_hours', models.FloatField(null=True)),
+                ('subject_id', models.IntegerField()),
+                ('group_label', models.CharField(blank=True, max_length=100)),
+                ('day', models.IntegerField()),
+                ('hour', models.FloatField()),
+                ('hour_24', models.FloatField()),
+                ('variable', models.CharField(max_length=20)),
+                ('value', models.FloatField(null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['upload_id', 'variable', 'bin_hours', 'group_label', 'day'], name='result_group_day_idx'), models.Index(fields=['upload_id', 'variable', 'bin_hours', 'subject_id', 'day'], name='result_subject_day_idx')],
+            },
+        ),
+    ]
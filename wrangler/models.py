@@ -1,3 +1,31 @@
 from django.db import models
 
-# Create your models here.
+
+class CombinedResult(models.Model):
+    """One value of the combined data of a job, a variable of one subject in one bin, see wrangler/results.py.
+
+    The indexes serve the slices the results endpoint is queried for, a variable of an upload at one bin size for some
+    groups or subjects and a range of days.
+    """
+    upload_id = models.CharField(max_length=36)
+    # Size of the bins, or length of the rolling windows, and the step of rolling windows (null for fixed bins)
+    bin_hours = models.FloatField()
+    step_hours = models.FloatField(null=True)
+    subject_id = models.IntegerField()
+    group_label = models.CharField(max_length=100, blank=True)
+    day = models.IntegerField()
+    hour = models.FloatField()
+    hour_24 = models.FloatField()
+    variable = models.CharField(max_length=20)
+    value = models.FloatField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['upload_id', 'variable', 'bin_hours', 'group_label', 'day'],
+                         name='result_group_day_idx'),
+            models.Index(fields=['upload_id', 'variable', 'bin_hours', 'subject_id', 'day'],
+                         name='result_subject_day_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.upload_id} {self.variable} ID {self.subject_id} day {self.day} hour {self.hour:g}"
@@ -0,0 +1,112 @@
+"""Downsampled previews of the subjects of an upload, to check the trimming before the results are downloaded.
+
+Previews are computed on a worker by preview_task from the cleaned data of a raw export, see clams_preview, and kept in
+the Django cache by the digest of the export, the subject and the number of points. Uploads of the same file share
+them, and every request after the first is answered from the cache without reading the export. Until a preview is in
+the cache the view answers 202 and the task is enqueued once, later requests are not queued again while it runs.
+
+The trim markers depend on the processing parameters, so they are computed for every request from the light phases of
+the cached preview, the way clams_processing.trim_clams_file finds the start of the kept data.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from clams_storage import blob_key, references
+
+from .validation import validate_export
+
+# Numbers of points a variable can be reduced to, the first request of each is computed once per subject
+PREVIEW_POINTS = (250, 500, 1000, 2000, 4000)
+DEFAULT_POINTS = 1000
+
+# Seconds a failed preview is remembered before it is computed again
+ERROR_TIMEOUT = 60
+
+
+def preview_key(digest, subject_id, points):
+    return f'clams:preview:{digest}:{subject_id}:{points}'
+
+
+def _subjects_key(digest):
+    return f'clams:preview_subjects:{digest}'
+
+
+def _pending_key(digest, points):
+    return f'clams:preview_pending:{digest}:{points}'
+
+
+def upload_subjects(storage, upload_id):
+    """Return the raw export of every subject of an upload, read from the metadata lines of the exports.
+
+    Parameters:
+    storage (LocalStorage or S3Storage): storage of the uploads
+    upload_id (string): ID of the upload
+
+    Returns:
+    dict: subject ID (int) -> name and digest of its export
+    """
+    exports = [(name, digest) for name, digest in references(storage, upload_id)
+               if '/' not in name and name.lower().endswith('.csv')]
+    # The subject IDs of an export are read from its header once per content
+    known = cache.get_many([_subjects_key(digest) for _, digest in exports])
+    subjects = {}
+    for name, digest in exports:
+        subject_ids = known.get(_subjects_key(digest))
+        if subject_ids is None:
+            subject_ids = validate_export(storage, blob_key(digest), name)['subject_ids']
+            cache.set(_subjects_key(digest), subject_ids, timeout=settings.CLAMS_PREVIEW_CACHE_SECONDS)
+        for subject_id in subject_ids:
+            subjects.setdefault(subject_id, (name, digest))
+    return subjects
+
+
+def cached_previews(digest, subject_ids, points):
+    """Return the cached previews of subjects of an export by subject ID, those not in the cache are left out."""
+    keys = {preview_key(digest, subject_id, points): subject_id for subject_id in subject_ids}
+    return {keys[key]: preview for key, preview in cache.get_many(list(keys)).items()}
+
+
+def request_preview(name, digest, subject_id, points):
+    """Enqueue preview_task for an export, unless it was enqueued already and has not finished."""
+    from .tasks import preview_task
+
+    if cache.add(_pending_key(digest, points), True, timeout=settings.CLAMS_JOB_QUEUES['small']['time_limit']):
+        preview_task.delay(name, digest, subject_id, points)
+
+
+def finish_preview(digest, subject_id, points, previews=None, error=None):
+    """Cache the previews of the subjects of an export computed by preview_task, or its error for subject_id."""
+    if error is not None:
+        cache.set(preview_key(digest, subject_id, points), {'error': error}, timeout=ERROR_TIMEOUT)
+    else:
+        cache.set_many({preview_key(digest, subject, points): preview for subject, preview in previews.items()},
+                       timeout=settings.CLAMS_PREVIEW_CACHE_SECONDS)
+    cache.delete(_pending_key(digest, points))
+
+
+def trim_window(phases, trim_hours, keep_hours, start_dark):
+    """Return the hours the trim stage keeps, from the light phases of a preview.
+
+    As in trim_clams_file the kept data starts at the first change of the LED lightness after trim_hours, or at the
+    change after it when that phase is not the start cycle, and lasts keep_hours.
+
+    Parameters:
+    phases (list of dict): light phases of the preview, see clams_preview.light_phases
+    trim_hours (float): hours trimmed from the beginning
+    keep_hours (float): hours kept
+    start_dark (bool): start the kept data at a dark phase instead of a light phase
+
+    Returns:
+    dict: "start" and "end" of the kept data in hours, None if the recording has no phase change to start at
+    """
+    # The phase of the first row at or after trim_hours
+    index = next((i for i, phase in enumerate(phases) if phase['end'] >= trim_hours), None)
+    if index is None or index + 1 >= len(phases):
+        return None
+    index += 1
+    if phases[index]['dark'] != start_dark:
+        index += 1
+        if index >= len(phases):
+            return None
+    start = phases[index]['start']
+    return {'start': start, 'end': min(start + keep_hours, phases[-1]['end'])}
@@ -0,0 +1,144 @@
+"""Indexed store of the combined results of the processing jobs, queried by the results endpoint.
+
+When a job has recombined a bin size, its CombinedArray is loaded into the CombinedResult table as a long table, one row
+per variable, subject and bin, inserted in one transaction. The table lives in the Django database (SQLite by
+default) and is indexed for slices such as "VO2 of group X on days 2 to 4 in 1 hour bins", so a slice is answered from
+a few index pages instead of unpacking the zipped results. The rows of an upload are deleted when it is processed again,
+when its job fails and when its session is cleared.
+"""
+import csv
+import io
+
+from django.core.paginator import Paginator
+from django.db import connection, transaction
+
+from instrumentation import stage
+
+from .models import CombinedResult
+
+# Rows per page of the results endpoint
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+# Columns of the rows served by the results endpoint, as named in the combined .csv files
+RESULT_COLUMNS = ['VARIABLE', 'BIN_HOURS', 'STEP_HOURS', 'ID', 'GROUP_LABEL', 'DAY', 'HOUR', '24 HOUR', 'VALUE']
+_RESULT_FIELDS = ['variable', 'bin_hours', 'step_hours', 'subject_id', 'group_label', 'day', 'hour', 'hour_24', 'value']
+_INSERT_FIELDS = ['upload_id', 'bin_hours', 'step_hours', 'subject_id', 'group_label', 'day', 'hour', 'hour_24',
+                  'variable', 'value']
+
+
+def _bin_size(bin_hours, step_hours):
+    """Return the filter of the rows of a bin size, fixed bins when step_hours is None."""
+    if step_hours is None:
+        return {'bin_hours': bin_hours, 'step_hours__isnull': True}
+    return {'bin_hours': bin_hours, 'step_hours': step_hours}
+
+
+def _insert_statement():
+    """Return the INSERT statement of a row of _INSERT_FIELDS into the CombinedResult table."""
+    quote_name = connection.ops.quote_name
+    columns = ', '.join(quote_name(CombinedResult._meta.get_field(field).column) for field in _INSERT_FIELDS)
+    placeholders = ', '.join(['%s'] * len(_INSERT_FIELDS))
+    return f'INSERT INTO {quote_name(CombinedResult._meta.db_table)} ({columns}) VALUES ({placeholders})'
+
+
+def load_results(upload_id, bin_hours, step_hours, combined_data):
+    """Store the combined data of one bin size of a job, replacing the rows stored for it before.
+
+    Called by the pipeline with the combined data of every bin size, see clams_processing.run_pipeline.
+
+    Parameters:
+    upload_id (string): ID of the processed upload
+    bin_hours (number): size of the bins, or length of the rolling windows, in hours
+    step_hours (number): step of the rolling windows in hours, None for fixed bins
+    combined_data (CombinedArray): the combined data of all subjects
+
+    Returns:
+    int: number of rows stored
+    """
+    fields = {'bin_hours': bin_hours} if step_hours is None else {'bin_hours': bin_hours, 'step_hours': step_hours}
+    with stage('index', **fields) as step:
+        subjects, bins = combined_data.present.nonzero()
+        ids = [int(subject_id) for subject_id in combined_data.ids[subjects]]
+        group_labels = [str(label) for label in combined_data.group_labels[subjects]]
+        day = combined_data.day[bins].tolist()
+        hour = combined_data.hour[bins].tolist()
+        hour_24 = combined_data.hour_24[bins].tolist()
+
+        # Rows are inserted by variable, subject and bin, the order the endpoint returns them in. They are inserted as
+        # tuples with executemany, building a model instance of every row for bulk_create takes about 7 times longer.
+        rows = []
+        for k, variable in enumerate(combined_data.variables):
+            values = combined_data.values[subjects, bins, k]
+            rows += [(upload_id, bin_hours, step_hours, ids[i], group_labels[i], day[i], hour[i], hour_24[i], variable,
+                      None if value != value else value) for i, value in enumerate(values.tolist())]
+
+        with transaction.atomic():
+            CombinedResult.objects.filter(upload_id=upload_id, **_bin_size(bin_hours, step_hours)).delete()
+            with connection.cursor() as cursor:
+                cursor.executemany(_insert_statement(), rows)
+        step.update(rows_in=len(rows), rows_out=len(rows))
+    return len(rows)
+
+
+def delete_results(upload_id):
+    """Delete the stored results of an upload."""
+    CombinedResult.objects.filter(upload_id=upload_id).delete()
+
+
+def query_results(upload_id, variables=None, bin_hours=None, step_hours=None, groups=None, subject_ids=None,
+                  day_min=None, day_max=None):
+    """Return the stored results of an upload matching the filters, ordered as they were stored.
+
+    Parameters:
+    upload_id (string): ID of the upload
+    variables (list of str): variables to return, all by default
+    bin_hours (number): bin size or rolling window length to return, all by default
+    step_hours (number): step of the rolling windows to return. With bin_hours and no step_hours only fixed bins are
+        returned.
+    groups (list of str): group labels to return, all by default
+    subject_ids (list of int): subject IDs to return, all by default
+    day_min (int): first DAY to return
+    day_max (int): last DAY to return
+
+    Returns:
+    QuerySet: the rows as tuples of the fields of RESULT_COLUMNS
+    """
+    results = CombinedResult.objects.filter(upload_id=upload_id)
+    if variables:
+        results = results.filter(variable__in=variables)
+    if bin_hours is not None:
+        results = results.filter(**_bin_size(bin_hours, step_hours))
+    if groups:
+        results = results.filter(group_label__in=groups)
+    if subject_ids:
+        results = results.filter(subject_id__in=subject_ids)
+    if day_min is not None:
+        results = results.filter(day__gte=day_min)
+    if day_max is not None:
+        results = results.filter(day__lte=day_max)
+    return results.order_by('id').values_list(*_RESULT_FIELDS)
+
+
+def paginate(results, page, page_size):
+    """Return one page of a query, see django.core.paginator.Paginator.page."""
+    return Paginator(results, page_size).page(page)
+
+
+def _number(value):
+    """Write whole numbers as integers, as the combined .csv files do."""
+    return int(value) if isinstance(value, float) and value.is_integer() else value
+
+
+def result_rows(rows):
+    """Return the rows of a page as dicts keyed by RESULT_COLUMNS."""
+    return [dict(zip(RESULT_COLUMNS, map(_number, row))) for row in rows]
+
+
+def results_csv(rows):
+    """Return the rows of a page as .csv text with a RESULT_COLUMNS header, missing values as empty fields."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(RESULT_COLUMNS)
+    writer.writerows(['' if value is None else _number(value) for value in row] for row in rows)
+    return buffer.getvalue()
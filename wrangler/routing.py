@@ -0,0 +1,52 @@
+"""Routing of processing jobs to the small and large job queues.
+
+The cost of a job is estimated from its upload before it is enqueued: cleaning and trimming read every raw export once
+and every bin size bins, recombines and reformats all of them again, so the wall time grows with the upload size times
+the number of bin sizes, plus a small overhead per file. Jobs estimated to take longer than CLAMS_LARGE_JOB_SECONDS go
+to the large queue, so they never hold up the small jobs served by the workers of the small queue.
+"""
+from django.conf import settings
+
+from .storage import upload_exports
+
+
+def estimate_job_cost(storage, upload_id, bin_hours):
+    """Estimate the wall time of a processing job in seconds.
+
+    Parameters:
+    storage (LocalStorage or S3Storage): storage of the uploads
+    upload_id (string): ID of the upload with the raw .csv exports
+    bin_hours (list): bin sizes the job processes
+
+    Returns:
+    dict: "bytes" and "files" of the raw exports, "bin_sizes" and the estimated "seconds"
+    """
+    sizes = [size for _, _, size in upload_exports(storage, upload_id)]
+    megabytes = sum(sizes) / 1e6
+    seconds = (megabytes * (settings.CLAMS_JOB_COST_PER_MB + settings.CLAMS_JOB_COST_PER_MB_PER_BIN * len(bin_hours))
+               + settings.CLAMS_JOB_COST_PER_FILE * len(sizes))
+    return {'bytes': sum(sizes), 'files': len(sizes), 'bin_sizes': len(bin_hours), 'seconds': round(seconds, 1)}
+
+
+def job_queue(cost):
+    """Return the name of the queue for a job of the estimated cost."""
+    return 'large' if cost['seconds'] > settings.CLAMS_LARGE_JOB_SECONDS else 'small'
+
+
+def enqueue_job(task, args, cost, task_id=None):
+    """Send a job to the queue for its estimated cost with the time limits of that queue.
+
+    Parameters:
+    task (Task): the Celery task to run
+    args (tuple): arguments of the task
+    cost (dict): estimated cost of the job, see estimate_job_cost
+    task_id (string): ID to give the task, a new one by default
+
+    Returns:
+    tuple: the AsyncResult of the job and the name of its queue
+    """
+    queue = job_queue(cost)
+    limits = settings.CLAMS_JOB_QUEUES[queue]
+    result = task.apply_async(args, task_id=task_id, queue=queue, soft_time_limit=limits['soft_time_limit'],
+                              time_limit=limits['time_limit'])
+    return result, queue
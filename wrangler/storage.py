@@ -0,0 +1,79 @@
+"""Storage of the uploads and results of the web app, see clams_storage."""
+import functools
+import hashlib
+
+from django.conf import settings
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+import clams_storage
+
+
+class _HashingMixin:
+    """Compute the SHA-256 digest of an uploaded file while its chunks are received, as file.sha256."""
+
+    def new_file(self, *args, **kwargs):
+        # Set first, the memory handler stops the handlers after it by raising StopFutureHandlers
+        self.hasher = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        # The memory handler passes the chunks of large files on to the next handler, which hashes them
+        if getattr(self, 'activated', True):
+            self.hasher.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.hasher.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(_HashingMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(_HashingMixin, TemporaryFileUploadHandler):
+    pass
+
+
+@functools.lru_cache(maxsize=None)
+def get_storage():
+    """Return the storage backend configured by CLAMS_STORAGE_URL."""
+    return clams_storage.open_storage(settings.CLAMS_STORAGE_URL, endpoint_url=settings.CLAMS_S3_ENDPOINT_URL)
+
+
+def store_upload(storage, upload_id, name, file):
+    """Store an uploaded file once per content, see clams_storage.store_upload_file.
+
+    Parameters:
+    storage (LocalStorage or S3Storage): storage of the uploads
+    upload_id (string): ID of the upload
+    name (string): name of the file in the upload
+    file (UploadedFile): the uploaded file, with its sha256 digest when received by the hashing upload handlers
+
+    Returns:
+    bool: True if the content was written, False if it was stored already
+    """
+    digest = getattr(file, 'sha256', None)
+    if digest is None:
+        hasher = hashlib.sha256()
+        for chunk in file.chunks():
+            hasher.update(chunk)
+        digest = hasher.hexdigest()
+    return clams_storage.store_upload_file(storage, upload_id, name, digest, file.chunks())
+
+
+def upload_files(storage, upload_id):
+    """Return the key and size of every file of an upload by its name, stored by reference or below its prefix."""
+    files = {name: (clams_storage.blob_key(digest), None)
+             for name, digest in clams_storage.references(storage, upload_id)}
+    prefix = f'{upload_id}/'
+    files.update((key[len(prefix):], (key, size)) for key, size, _ in storage.list(prefix))
+    return {name: (key, storage.size(key) if size is None else size) for name, (key, size) in files.items()}
+
+
+def upload_exports(storage, upload_id):
+    """Return the name, key and size of every raw export of an upload, the .csv files at its top, sorted by name."""
+    return [(name, key, size) for name, (key, size) in sorted(upload_files(storage, upload_id).items())
+            if '/' not in name and name.lower().endswith('.csv')]
@@ -1,40 +1,131 @@
+import contextlib
+import functools
 import os
+import tempfile
+import time
 
 from celery import shared_task
 from django.conf import settings
 
-from clams_processing import (
-    clean_all_clams_data, trim_all_clams_data, process_directory,
-    recombine_columns, reformat_csvs_in_directory
-)
+from clams_storage import blob_key, collect_garbage, references, workspace
 from helpers import zip_directory
+from instrumentation import collect, profile, stage
+from .metrics import record_job
+from .preview import finish_preview
+from .results import delete_results, load_results
+from .storage import get_storage, upload_exports
+
+
+def _profile_path(upload_id):
+    """Return where to dump a cProfile of this job, or None if the job is not selected for profiling."""
+    profile_jobs = settings.CLAMS_PROFILE_JOBS
+    if upload_id in profile_jobs or '*' in profile_jobs:
+        return os.path.join(settings.CLAMS_PROFILE_DIR, f'{upload_id}.prof')
+    return None
+
+
+def _input_bytes(storage, upload_id):
+    """Return the total size of the raw exports of the upload."""
+    try:
+        return sum(size for _, _, size in upload_exports(storage, upload_id))
+    except Exception:
+        # An unreachable storage fails the job itself with its error
+        return 0
 
 
 @shared_task
 def process_files_task(upload_id, trim_hours, keep_hours, bin_hours, start_cycle):
+    started = time.perf_counter()
+    input_bytes = _input_bytes(get_storage(), upload_id)
+    result = _process_files(upload_id, trim_hours, keep_hours, bin_hours, start_cycle)
+    record_job(result, time.perf_counter() - started, input_bytes)
+    return result
+
+
+def _process_files(upload_id, trim_hours, keep_hours, bin_hours, start_cycle):
+    with collect(job_id=upload_id) as metrics, contextlib.ExitStack() as stack:
+        try:
+            # A local storage is processed in place, uploads in a remote storage are fetched to a local workspace
+            storage = get_storage()
+            with stage('fetch'):
+                blobs = [] if storage.local else references(storage, upload_id)
+                upload_dir = stack.enter_context(workspace(
+                    storage, f'{upload_id}/', settings.CLAMS_WORKSPACE_DIR, settings.CLAMS_WORKER_CACHE_DIR,
+                    settings.CLAMS_WORKER_CACHE_BYTES, blobs))
+            experiment_config_path = os.path.join(upload_dir, 'config')
+            # the views.upload_csv_files function renames it to experiment_config.csv
+            experiment_config_file = os.path.join(experiment_config_path, 'experiment_config.csv')
+            start_dark = start_cycle == 'Start Dark'
+
+            # Imported here so web processes, which import this module to send the tasks, do not load pandas. Workers
+            # import it before starting their pool, see CLAMS_web.celery.preload_processing.
+            from clams_processing import run_pipeline, stream_pipeline
+
+            # The combined data of every bin size is loaded into the results table, replacing that of earlier jobs
+            delete_results(upload_id)
+            store_results = functools.partial(load_results, upload_id)
+
+            with profile(_profile_path(upload_id)):
+                if settings.CLAMS_MAX_SUBJECTS_IN_FLIGHT:
+                    stream_pipeline(upload_dir, trim_hours, keep_hours, bin_hours, start_dark, experiment_config_file,
+                                    max_subjects=settings.CLAMS_MAX_SUBJECTS_IN_FLIGHT, combined_callback=store_results)
+                else:
+                    run_pipeline(upload_dir, trim_hours, keep_hours, bin_hours, start_dark, experiment_config_file,
+                                 combined_callback=store_results)
+
+                # Zip the processed files to deliver to user and store the zip next to the upload
+                zip_key = f'{upload_id}.zip'
+                if storage.local:
+                    zip_file_path = storage.path(zip_key)
+                else:
+                    zip_file_path = os.path.join(os.path.dirname(upload_dir), zip_key)
+                with stage('zip') as step:
+                    zip_directory(upload_dir, zip_file_path)
+                    step['bytes_written'] = os.path.getsize(zip_file_path)
+                    storage.upload_file(zip_file_path, zip_key)
+
+            return {'upload_id': upload_id, 'metrics': metrics.as_dict()}
+        except Exception as e:
+            # Log any exceptions
+            print(f"Error processing files: {e}")
+            # Results of the bin sizes processed before the error are not served
+            with contextlib.suppress(Exception):
+                delete_results(upload_id)
+            return {'error': str(e), 'metrics': metrics.as_dict()}
+
+
+@shared_task
+def preview_task(name, digest, subject_id, points):
+    """Compute the previews of every subject of a raw export at one resolution and cache them, see wrangler.preview.
+
+    An error is cached for the requested subject instead, e.g. when the export cannot be cleaned.
+    """
+    from clams_preview import preview_export
+
+    storage = get_storage()
+    os.makedirs(settings.CLAMS_WORKSPACE_DIR, exist_ok=True)
     try:
-        upload_dir = os.path.join(settings.MEDIA_ROOT, upload_id)
-        experiment_config_path = os.path.join(upload_dir, 'config')
-        # the views.upload_csv_files function renames it to experiment_config.csv
-        experiment_config_file = os.path.join(experiment_config_path, 'experiment_config.csv')
-
-        # pre-processing of CLAMS data
-        clean_all_clams_data(upload_dir)
-        # quality_control(upload_dir)
-        trim_all_clams_data(upload_dir, trim_hours, keep_hours, start_cycle)
-
-        # Loop through the bin hours and process the data
-        for bin_hour in bin_hours:
-            process_directory(upload_dir, bin_hour)
-            recombine_columns(upload_dir, experiment_config_file, bin_hour)
-            reformat_csvs_in_directory(os.path.join(upload_dir, f'{bin_hour}hour_bins_Combined_CLAMS_data'))
-
-        # Zip the processed files to deliver to user
-        zip_file_path = os.path.join(settings.MEDIA_ROOT, f'{upload_id}.zip')
-        zip_directory(upload_dir, zip_file_path)
-
-        return {'upload_id': upload_id}
+        with tempfile.TemporaryDirectory(dir=settings.CLAMS_WORKSPACE_DIR) as directory:
+            # The export is read in place from a local storage, cleaned files are never written next to the upload
+            if storage.local:
+                export_path = storage.path(blob_key(digest))
+            else:
+                export_path = os.path.join(directory, name)
+                storage.download_file(blob_key(digest), export_path)
+            previews = preview_export(export_path, os.path.join(directory, 'Cleaned_CLAMS_data'), points)
     except Exception as e:
-        # Log any exceptions
-        print(f"Error processing files: {e}")
+        print(f"Error previewing {name}: {e}")
+        finish_preview(digest, subject_id, points, error=str(e))
         return {'error': str(e)}
+    # The metadata lines listed a subject the export has no rows of
+    previews.setdefault(subject_id, {'error': f"Subject ID {subject_id} has no data in {name}"})
+    finish_preview(digest, subject_id, points, previews)
+    return {'subjects': sorted(previews)}
+
+
+@shared_task
+def collect_blobs_task():
+    """Delete the stored contents of uploaded files that no upload references anymore."""
+    deleted = collect_garbage(get_storage(), settings.CLAMS_BLOB_MIN_AGE)
+    print(f"Deleted {deleted} unreferenced blobs")
+    return {'deleted': deleted}
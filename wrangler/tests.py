@@ -1,3 +1,380 @@
-from django.test import TestCase
+import contextlib
+import io
+import os
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from benchmarks.synthetic import generate_experiment
+from clams_array import CombinedArray
+from clams_io import read_csv
+from clams_preview import preview_subject
+from clams_processing import clean_clams_file, trim_clams_file
+from clams_profiles import parse_datetimes
+from clams_storage import LocalStorage
+
+from .admission import active_job, admit_job, release_job
+from .models import CombinedResult
+from .preview import trim_window
+from .results import RESULT_COLUMNS, delete_results, load_results, paginate, query_results, results_csv
+from .routing import enqueue_job, estimate_job_cost, job_queue
+from .validation import validate_upload
+
+UPLOAD_ID = 'a1b2c3d4-0000-4000-8000-000000000001'
+
+
+def combined_data():
+    """Two subjects of different groups over two days of 12 hour bins, the second subject without a value in one bin."""
+    frames = []
+    for subject_id, group_label, offset in [('1001', 'Control', 0), ('1002', 'Treated', 100)]:
+        hours = np.array([12, 24, 36, 48])
+        frames.append(pd.DataFrame({
+            'ID': subject_id, 'GROUP_LABEL': group_label, 'DAY': (hours - 1) // 24 + 1, 'HOUR': hours,
+            '24 HOUR': (hours - 1) % 24 + 1, 'VO2': hours * 10.5 + offset, 'WHEEL': hours + offset}))
+    frames[1].loc[2, 'VO2'] = np.nan
+    return CombinedArray.from_subjects(frames, ['VO2', 'WHEEL'])
+
+
+class ResultsQueryTests(TestCase):
+
+    def setUp(self):
+        load_results(UPLOAD_ID, 12, None, combined_data())
+        load_results(UPLOAD_ID, 6, 3, combined_data())
+
+    def test_load_results(self):
+        # A row per variable, subject and bin of both bin sizes
+        self.assertEqual(CombinedResult.objects.filter(upload_id=UPLOAD_ID).count(), 2 * 2 * 2 * 4)
+        self.assertIsNone(CombinedResult.objects.get(upload_id=UPLOAD_ID, step_hours=None, variable='VO2',
+                                                     subject_id=1002, hour=36).value)
+
+    def test_load_replaces_bin_size(self):
+        self.assertEqual(load_results(UPLOAD_ID, 12, None, combined_data()), 16)
+        self.assertEqual(CombinedResult.objects.filter(upload_id=UPLOAD_ID).count(), 32)
+
+    def test_filters(self):
+        rows = list(query_results(UPLOAD_ID, variables=['WHEEL'], bin_hours=12, groups=['Treated'], day_min=2))
+        self.assertEqual(rows, [('WHEEL', 12, None, 1002, 'Treated', 2, 36, 12, 136),
+                                ('WHEEL', 12, None, 1002, 'Treated', 2, 48, 24, 148)])
+        self.assertEqual(len(query_results(UPLOAD_ID, bin_hours=6, step_hours=3, subject_ids=[1001], day_max=1)), 4)
+        # Without step_hours only the fixed bins of a size are returned
+        self.assertEqual(len(query_results(UPLOAD_ID, bin_hours=6)), 0)
+        self.assertEqual(len(query_results('other-upload')), 0)
+
+    def test_stored_order(self):
+        rows = list(query_results(UPLOAD_ID, bin_hours=12))
+        self.assertEqual([row[0] for row in rows], ['VO2'] * 8 + ['WHEEL'] * 8)
+        self.assertEqual([row[3] for row in rows[:8]], [1001] * 4 + [1002] * 4)
+
+    def test_paginate(self):
+        page = paginate(query_results(UPLOAD_ID, bin_hours=12), 2, 5)
+        self.assertEqual((page.paginator.count, page.paginator.num_pages), (16, 4))
+        self.assertEqual(len(page), 5)
+        self.assertTrue(page.has_next())
+
+    def test_results_csv(self):
+        text = results_csv(query_results(UPLOAD_ID, variables=['VO2'], bin_hours=12, subject_ids=[1002]))
+        lines = text.splitlines()
+        self.assertEqual(lines[0], ','.join(RESULT_COLUMNS))
+        # Whole numbers are written as integers and missing values as empty fields
+        self.assertEqual(lines[1], 'VO2,12,,1002,Treated,1,12,12,226')
+        self.assertEqual(lines[3], 'VO2,12,,1002,Treated,2,36,12,')
+
+    def test_delete_results(self):
+        delete_results(UPLOAD_ID)
+        self.assertFalse(CombinedResult.objects.filter(upload_id=UPLOAD_ID).exists())
+
+
+class ResultsViewTests(TestCase):
+
+    def setUp(self):
+        load_results(UPLOAD_ID, 12, None, combined_data())
+        session = self.client.session
+        session['upload_id'] = UPLOAD_ID
+        session.save()
+        self.url = reverse('results', args=[UPLOAD_ID])
+
+    def test_json(self):
+        response = self.client.get(self.url, {'variables': 'VO2', 'subjects': '1001', 'page_size': 3})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['count'], data['page'], data['num_pages']), (4, 1, 2))
+        self.assertEqual(data['results'][0], {'VARIABLE': 'VO2', 'BIN_HOURS': 12, 'STEP_HOURS': None, 'ID': 1001,
+                                              'GROUP_LABEL': 'Control', 'DAY': 1, 'HOUR': 12, '24 HOUR': 12,
+                                              'VALUE': 126})
+
+        response = self.client.get(data['next'])
+        self.assertEqual(response.json()['page'], 2)
+        self.assertIsNone(response.json()['next'])
+
+    def test_csv(self):
+        response = self.client.get(self.url, {'format': 'csv', 'groups': 'Control', 'page_size': 5})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['X-Total-Count'], '8')
+        self.assertIn('rel="next"', response['Link'])
+        self.assertEqual(len(response.content.decode().splitlines()), 6)
+
+    def test_other_upload(self):
+        self.assertEqual(self.client.get(reverse('results', args=['another-upload'])).status_code, 403)
+
+    def test_invalid_parameters(self):
+        for params in ({'bin_hours': 'one'}, {'subjects': '1001,x'}, {'page_size': 0},
+                       {'page_size': 100000}, {'step_hours': 3}, {'format': 'xml'}):
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get(self.url, params).status_code, 400)
+
+    def test_missing_page(self):
+        self.assertEqual(self.client.get(self.url, {'page': 99}).status_code, 404)
+
+    def test_clear_session_deletes_results(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(CLAMS_STORAGE_URL=directory), \
+                mock.patch('wrangler.views.collect_blobs_task') as collect_blobs_task:
+            response = self.client.get(reverse('clear_session'))
+        self.assertEqual(response.status_code, 200)
+        collect_blobs_task.delay.assert_called_once_with()
+        self.assertFalse(CombinedResult.objects.filter(upload_id=UPLOAD_ID).exists())
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+
+class UploadCase(TestCase):
+    """An upload of two synthetic exports and their experiment configuration in a local storage."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.storage = LocalStorage(os.path.join(directory.name, 'storage'))
+        source = os.path.join(directory.name, 'source')
+        generate_experiment(source, subjects=2, days=1)
+        self.files = {}
+        for name in ('synthetic_0001.CSV', 'synthetic_0002.CSV', 'config/experiment_config.csv'):
+            with open(os.path.join(source, name), 'rb') as f:
+                self.files[name] = f.read()
+
+    def upload(self, files, upload_id=UPLOAD_ID):
+        self.storage.delete(f'{upload_id}/')
+        for name, data in files.items():
+            with self.storage.open(f'{upload_id}/{name}', 'wb') as f:
+                f.write(data)
+        return upload_id
+
+
+class ValidationTests(UploadCase):
+
+    def errors(self, report):
+        return [error for file in report['files'] for error in file['errors']] + report['errors']
+
+    def test_valid_upload(self):
+        report = validate_upload(self.storage, self.upload(self.files))
+        self.assertTrue(report['valid'], report)
+        self.assertEqual([file['subject_ids'] for file in report['files'][1:]], [[1001], [1002]])
+        self.assertEqual(report['files'][0]['ids'], [1001, 1002])
+
+    def test_rejected_exports(self):
+        export = self.files['synthetic_0002.CSV']
+        header_end = export.index(b'\n', export.index(b'INTERVAL,')) + 1
+        cases = {
+            'Missing columns: WHEEL ACC': export.replace(b',WHEEL ACC,', b',WHEEL TOTAL,'),
+            'No "Subject ID" in the metadata lines': export.replace(b'Subject ID,1002', b'Subject,1002'),
+            "Subject ID 'A2' is not a whole number": export.replace(b'Subject ID,1002', b'Subject ID,A2'),
+            'No column header row with a DATE/TIME column': b'Not an export\n',
+            'not a UTF-8 text file': b'\xff\xfe' + export,
+            'No data rows with a DATE/TIME value': export[:header_end],
+        }
+        for error, data in cases.items():
+            with self.subTest(error=error):
+                report = validate_upload(self.storage, self.upload({**self.files, 'synthetic_0002.CSV': data}))
+                self.assertFalse(report['valid'])
+                self.assertEqual(len(self.errors(report)), 1, self.errors(report))
+                self.assertIn(error, self.errors(report)[0])
+
+    def test_rejected_config(self):
+        config = self.files['config/experiment_config.csv']
+        cases = {
+            'Column "GROUP LABEL" must be named "GROUP_LABEL"': config.replace(b'GROUP_LABEL', b'GROUP LABEL'),
+            'Missing column "ID"': config.replace(b'ID,', b'SUBJECT,'),
+            'Subject ID 1002 is not listed in the experiment configuration': config.replace(b'1002,', b'1009,'),
+            'No subjects are listed': b'ID,GROUP_LABEL\n',
+        }
+        for error, data in cases.items():
+            with self.subTest(error=error):
+                files = {**self.files, 'config/experiment_config.csv': data}
+                report = validate_upload(self.storage, self.upload(files))
+                self.assertFalse(report['valid'])
+                self.assertIn(error, self.errors(report))
+
+    def test_missing_files(self):
+        report = validate_upload(self.storage, self.upload({'config/experiment_config.csv': b'ID,GROUP_LABEL\n1,A\n'}))
+        self.assertEqual(report['errors'], ['No raw .csv exports were uploaded'])
+        exports = {name: data for name, data in self.files.items() if not name.startswith('config/')}
+        report = validate_upload(self.storage, self.upload(exports))
+        self.assertEqual(self.errors(report), ['No experiment configuration file was uploaded'])
+
+    def test_warnings(self):
+        # Configured subjects without an export and subjects in several exports do not reject the upload
+        files = {**self.files, 'synthetic_0003.CSV': self.files['synthetic_0002.CSV'],
+                 'config/experiment_config.csv': self.files['config/experiment_config.csv'] + b'1009,Group1\n'}
+        report = validate_upload(self.storage, self.upload(files))
+        self.assertTrue(report['valid'], report)
+        self.assertEqual(report['files'][0]['warnings'], ['No export for IDs: 1009'])
+        self.assertEqual(report['files'][3]['warnings'], ['Subject ID 1002 is also in synthetic_0002.CSV'])
+
+    def test_process_view_rejects_upload(self):
+        upload_id = self.upload({**self.files, 'synthetic_0001.CSV': b'Not an export\n'})
+        session = self.client.session
+        session['upload_id'] = upload_id
+        session.save()
+        with mock.patch('wrangler.views.get_storage', return_value=self.storage), \
+                mock.patch('wrangler.views.admit_job') as admit_job:
+            response = self.client.post(reverse('process'), {'trim_hours': 2, 'keep_hours': 24, 'bin_hours': ['1'],
+                                                             'start_cycle': 'Start Light'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.json()['validation']['valid'])
+        admit_job.assert_not_called()
+
+
+@override_settings(CLAMS_JOB_COST_PER_MB=0.25, CLAMS_JOB_COST_PER_MB_PER_BIN=0.15, CLAMS_JOB_COST_PER_FILE=0.05,
+                   CLAMS_LARGE_JOB_SECONDS=60, CLAMS_JOB_QUEUES={
+                       'small': {'soft_time_limit': 600, 'time_limit': 660},
+                       'large': {'soft_time_limit': 14400, 'time_limit': 14700}})
+class RoutingTests(UploadCase):
+
+    def test_estimate_job_cost(self):
+        # Only the raw exports at the top of the upload are counted
+        upload_id = self.upload({'a.csv': b'x' * 1000000, 'b.CSV': b'x' * 3000000,
+                                 'config/experiment_config.csv': b'x' * 1000000})
+        cost = estimate_job_cost(self.storage, upload_id, ['1', '4'])
+        # 4 MB read once and binned twice, plus the overhead of two files
+        self.assertEqual(cost, {'bytes': 4000000, 'files': 2, 'bin_sizes': 2, 'seconds': 2.3})
+
+    def test_job_queue(self):
+        self.assertEqual(job_queue({'seconds': 60}), 'small')
+        self.assertEqual(job_queue({'seconds': 60.1}), 'large')
+
+    def test_enqueue_job(self):
+        task = mock.Mock()
+        for seconds, queue, soft_time_limit, time_limit in [(1, 'small', 600, 660), (100, 'large', 14400, 14700)]:
+            with self.subTest(queue=queue):
+                result, routed = enqueue_job(task, ('upload',), {'seconds': seconds}, task_id='task')
+                self.assertEqual(routed, queue)
+                self.assertIs(result, task.apply_async.return_value)
+                task.apply_async.assert_called_with(('upload',), task_id='task', queue=queue,
+                                                    soft_time_limit=soft_time_limit, time_limit=time_limit)
+
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+PARAMETERS = {'trim_hours': 2, 'keep_hours': 24, 'bin_hours': ['1'], 'start_cycle': 'Start Light'}
+
+
+@override_settings(CACHES=LOCMEM_CACHES, CLAMS_MAX_PENDING_JOBS=2)
+class AdmissionTests(UploadCase):
+    """One active job per upload, kept in the cache."""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        # Jobs are running and no job is waiting in the queues, without a broker
+        self.pending_jobs = self.patch('wrangler.admission.pending_jobs', return_value=0)
+        self.async_result = self.patch('wrangler.admission.AsyncResult')
+        self.async_result.return_value.state = 'STARTED'
+        self.patch('wrangler.views.get_storage', return_value=self.storage)
+        self.apply_async = self.patch('wrangler.views.process_files_task.apply_async',
+                                      side_effect=lambda args, task_id, **options: mock.Mock(id=task_id))
+
+        session = self.client.session
+        session['upload_id'] = self.upload(self.files)
+        session.save()
+
+    def patch(self, target, **kwargs):
+        patcher = mock.patch(target, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def submit(self, **parameters):
+        return self.client.post(reverse('process'), {**PARAMETERS, **parameters})
+
+    def test_admit_job(self):
+        outcome, task_id = admit_job(UPLOAD_ID, PARAMETERS)
+        self.assertEqual(outcome, 'admitted')
+        self.assertEqual(admit_job(UPLOAD_ID, PARAMETERS), ('coalesced', task_id))
+        self.assertEqual(admit_job(UPLOAD_ID, {**PARAMETERS, 'trim_hours': 4}), ('conflict', task_id))
+        self.assertEqual(admit_job('other-upload', PARAMETERS)[0], 'admitted')
+
+        # A finished job no longer holds its upload
+        self.async_result.return_value.state = 'SUCCESS'
+        outcome, next_task_id = admit_job(UPLOAD_ID, PARAMETERS)
+        self.assertEqual(outcome, 'admitted')
+        self.assertNotEqual(next_task_id, task_id)
+
+    def test_busy(self):
+        self.pending_jobs.return_value = 2
+        self.assertEqual(admit_job(UPLOAD_ID, PARAMETERS), ('busy', None))
+        self.assertIsNone(active_job(UPLOAD_ID))
+
+    def test_release_job(self):
+        _, task_id = admit_job(UPLOAD_ID, PARAMETERS)
+        # Only the job that is active is released
+        release_job(UPLOAD_ID, 'another-task')
+        self.assertEqual(active_job(UPLOAD_ID)['task_id'], task_id)
+        release_job(UPLOAD_ID, task_id)
+        self.assertIsNone(active_job(UPLOAD_ID))
+
+    def test_coalesced_submissions(self):
+        response = self.submit()
+        task_id = active_job(UPLOAD_ID)['task_id']
+        self.assertRedirects(response, reverse('processing', args=[task_id]), fetch_redirect_response=False)
+        # A resubmission is sent to the same job, which is only enqueued once
+        self.assertRedirects(self.submit(), reverse('processing', args=[task_id]), fetch_redirect_response=False)
+        self.apply_async.assert_called_once()
+        self.assertEqual(self.apply_async.call_args.kwargs['task_id'], task_id)
+
+    def test_conflicting_submission(self):
+        self.submit()
+        response = self.submit(trim_hours=4)
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('error', response.json())
+        self.apply_async.assert_called_once()
+
+    def test_busy_submission(self):
+        self.pending_jobs.return_value = 2
+        response = self.submit()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '120')
+        self.apply_async.assert_not_called()
+
+    def test_failed_submission_releases_job(self):
+        # The upload is free for another submission when the cost estimate or the broker fails
+        for target in ('wrangler.views.estimate_job_cost', 'wrangler.views.process_files_task.apply_async'):
+            with self.subTest(target=target), mock.patch(target, side_effect=RuntimeError):
+                with self.assertRaises(RuntimeError):
+                    self.submit()
+                self.assertIsNone(active_job(UPLOAD_ID))
+        self.assertEqual(self.submit().status_code, 302)
+
+
+class TrimWindowTests(TestCase):
+    """The trim markers of a preview are where trim_clams_file starts and ends the kept data."""
+
+    def test_trim_window(self):
+        with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+            generate_experiment(directory, subjects=1, days=3)
+            cleaned_path = clean_clams_file(os.path.join(directory, 'synthetic_0001.CSV'), directory)
+            phases = preview_subject(cleaned_path, 1000)['phases']
+            start_time = parse_datetimes(read_csv(cleaned_path)['DATE/TIME']).iloc[0]
+            for start_dark in (False, True):
+                with self.subTest(start_dark=start_dark):
+                    trimmed_directory = os.path.join(directory, f'dark_{start_dark}')
+                    os.makedirs(trimmed_directory)
+                    trimmed = read_csv(trim_clams_file(cleaned_path, trimmed_directory, 5, 24, start_dark))
+                    hours = (parse_datetimes(trimmed['DATE/TIME']) - start_time) / pd.Timedelta(hours=1)
+
+                    window = trim_window(phases, 5, 24, start_dark)
+                    self.assertEqual(window['start'], round(hours.iloc[0], 4))
+                    self.assertEqual(trimmed['LED LIGHTNESS'].iloc[0] == 0, start_dark)
+                    # The last kept row is the last one within the window
+                    self.assertLessEqual(hours.iloc[-1], window['end'])
+                    self.assertGreater(hours.iloc[-1], window['end'] - 0.25)
@@ -0,0 +1,185 @@
+"""Header-only validation of an upload before its processing job is enqueued.
+
+Only the first HEADER_BYTES of every raw export are read, with the csv module, to check what the pipeline would
+otherwise fail on minutes later in the worker: a metadata "Subject ID" line, the column header row and the columns the
+binned files are computed from. The experiment configuration must have the ID and GROUP_LABEL columns and list every
+subject ID of the exports. The report lists the errors and warnings of every file, the job is only enqueued when there
+are no errors.
+
+Files are read through the storage of the uploads, so only the headers are transferred from a remote storage.
+"""
+import codecs
+import csv
+import io
+import re
+
+from clams_profiles import EXPORT_COLUMNS, MAX_HEADER_LINES, channel_subject_ids
+
+from .storage import upload_files
+
+# Bytes read from the start of every raw export
+HEADER_BYTES = 64 * 1024
+
+# Columns of the experiment configuration, see recombine_columns
+CONFIG_COLUMNS = ['ID', 'GROUP_LABEL']
+
+
+def _read_head(storage, key):
+    """Return the complete lines in the first HEADER_BYTES of a file and whether they are the whole file."""
+    head = storage.read_head(key, HEADER_BYTES + 1)
+    complete = len(head) <= HEADER_BYTES
+    # A character cut in two at the end of the sample is not a decoding error
+    text = codecs.getincrementaldecoder('utf-8')().decode(head[:HEADER_BYTES], final=complete)
+    lines = text.splitlines()
+    if not complete and lines:
+        lines.pop()
+    return lines, complete
+
+
+def validate_export(storage, key, name):
+    """Check the metadata and column header of one raw export.
+
+    Parameters:
+    storage (LocalStorage or S3Storage): storage of the uploads
+    key (string): key of the raw .csv file exported by Oxymax-CLAMS
+    name (string): name of the file in the upload
+
+    Returns:
+    dict: "file", "subject_ids" found in the metadata, "errors" and "warnings"
+    """
+    report = {'file': name, 'subject_ids': [], 'errors': [], 'warnings': []}
+    try:
+        lines, complete = _read_head(storage, key)
+    except UnicodeDecodeError:
+        report['errors'].append("The file is not a UTF-8 text file, it may not be an Oxymax-CLAMS .csv export")
+        return report
+
+    rows = list(csv.reader(lines[:MAX_HEADER_LINES]))
+    header_index = next((i for i, row in enumerate(rows) if 'DATE/TIME' in row), None)
+    if header_index is None:
+        report['errors'].append(f"No column header row with a DATE/TIME column in the first {MAX_HEADER_LINES} "
+                                f"lines, it may not be an Oxymax-CLAMS export")
+        return report
+
+    # Metadata lines as read by clams_profiles.read_export_metadata
+    metadata = {}
+    for row in rows[:header_index]:
+        if row:
+            metadata[row[0].strip()] = [value.strip() for value in row[1:] if value.strip()]
+    subject_ids = metadata.get('Subject ID', [])
+    if not subject_ids:
+        report['errors'].append('No "Subject ID" in the metadata lines')
+    try:
+        channel_subject_ids(metadata)
+    except ValueError as e:
+        report['errors'].append(str(e))
+    for subject_id in subject_ids:
+        # Subjects are matched to the configuration by the number in the ID of their file name
+        if not re.fullmatch(r'\d+', subject_id):
+            report['errors'].append(f'Subject ID {subject_id!r} is not a whole number')
+        else:
+            report['subject_ids'].append(int(subject_id))
+
+    columns = [column.strip() for column in rows[header_index]]
+    missing = [column for column in EXPORT_COLUMNS if column not in columns]
+    if missing:
+        report['errors'].append(f"Missing columns: {', '.join(missing)}")
+
+    date_index = rows[header_index].index('DATE/TIME')
+    data_rows = csv.reader(lines[header_index + 1:])
+    if complete and not any(date_index < len(row) and any(c.isdigit() for c in row[date_index]) for row in data_rows):
+        report['errors'].append("No data rows with a DATE/TIME value")
+    return report
+
+
+def validate_config(storage, key):
+    """Check the columns and IDs of an experiment configuration file.
+
+    Parameters:
+    storage (LocalStorage or S3Storage): storage of the uploads
+    key (string): key of the experiment configuration file, None if it was not uploaded
+
+    Returns:
+    dict: "file", "ids" listed in the configuration, "errors" and "warnings"
+    """
+    report = {'file': 'experiment_config.csv', 'ids': [], 'errors': [], 'warnings': []}
+    if key is None:
+        report['errors'].append("No experiment configuration file was uploaded")
+        return report
+
+    try:
+        with storage.open(key, 'rb') as f:
+            text = f.read().decode('utf-8-sig')
+        rows = [row for row in csv.reader(io.StringIO(text, newline='')) if any(value.strip() for value in row)]
+    except UnicodeDecodeError:
+        report['errors'].append("The file is not a UTF-8 text file")
+        return report
+    header = rows[0] if rows else []
+
+    for column in CONFIG_COLUMNS:
+        if column in header:
+            continue
+        # e.g. "GROUP LABEL" or "group_label" instead of GROUP_LABEL
+        similar = [name for name in header if re.sub(r'[\s_]+', '_', name.strip()).upper() == column]
+        if similar:
+            report['errors'].append(f'Column "{similar[0]}" must be named "{column}"')
+        else:
+            report['errors'].append(f'Missing column "{column}"')
+    if 'ID' not in header:
+        return report
+
+    id_index = header.index('ID')
+    for row in rows[1:]:
+        value = row[id_index].strip() if id_index < len(row) else ''
+        if re.fullmatch(r'\d+(\.0*)?', value):
+            report['ids'].append(int(float(value)))
+        else:
+            report['errors'].append(f'ID {value!r} is not a whole number')
+    if not rows[1:]:
+        report['errors'].append("No subjects are listed")
+    duplicates = sorted({i for i in report['ids'] if report['ids'].count(i) > 1})
+    if duplicates:
+        report['warnings'].append(f"IDs listed more than once, the first group label is used: "
+                                  f"{', '.join(map(str, duplicates))}")
+    return report
+
+
+def validate_upload(storage, upload_id):
+    """Check every raw export of an upload and their coverage by the experiment configuration.
+
+    Parameters:
+    storage (LocalStorage or S3Storage): storage of the uploads
+    upload_id (string): ID of the upload, with the raw exports and config/experiment_config.csv below its prefix
+
+    Returns:
+    dict: "valid" (bool), "errors" of the upload as a whole and "files", the report of every file
+    """
+    uploaded = upload_files(storage, upload_id)
+    config = validate_config(storage, uploaded.get('config/experiment_config.csv', (None, None))[0])
+    exports = [validate_export(storage, key, name) for name, (key, _) in sorted(uploaded.items())
+               if '/' not in name and name.lower().endswith('.csv')]
+
+    errors = []
+    if not exports:
+        errors.append("No raw .csv exports were uploaded")
+
+    # Every subject needs a group label, configured subjects without an export are only reported
+    configured = set(config['ids'])
+    seen = {}
+    for export in exports:
+        for subject_id in export['subject_ids']:
+            if config['ids'] and subject_id not in configured:
+                export['errors'].append(f"Subject ID {subject_id} is not listed in the experiment configuration")
+            if subject_id in seen:
+                export['warnings'].append(f"Subject ID {subject_id} is also in {seen[subject_id]}")
+            seen.setdefault(subject_id, export['file'])
+    missing = sorted(configured - set(seen))
+    if missing:
+        config['warnings'].append(f"No export for IDs: {', '.join(map(str, missing))}")
+
+    files = [config] + exports
+    return {
+        'valid': not errors and not any(report['errors'] for report in files),
+        'errors': errors,
+        'files': files,
+    }
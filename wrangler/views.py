@@ -1,15 +1,27 @@
-import os
-import shutil
+import posixpath
 import uuid
 from wsgiref.util import FileWrapper
 
 from celery.result import AsyncResult
 from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.core.paginator import InvalidPage
 from django.http import JsonResponse, HttpResponse, HttpResponseNotFound, HttpResponseForbidden, FileResponse, Http404
 from django.shortcuts import render, redirect
 
+from clams_storage import delete_upload
+
+from . import metrics
+from .admission import admit_job, release_job
 from .forms import UserInputForm
-from .tasks import process_files_task
+from .preview import DEFAULT_POINTS, PREVIEW_POINTS, cached_previews, request_preview, trim_window, upload_subjects
+from .results import (
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, delete_results, paginate, query_results, result_rows, results_csv
+)
+from .routing import enqueue_job, estimate_job_cost
+from .storage import get_storage, store_upload
+from .tasks import collect_blobs_task, process_files_task
+from .validation import validate_upload
 
 
 def homepage_view(request):
@@ -32,8 +44,42 @@ def process_view(request):
             if not upload_id:
                 return JsonResponse({'error': 'No upload session found'}, status=400)
 
-            # Enqueue the processing task
-            task = process_files_task.delay(upload_id, trim_hours, keep_hours, bin_hours, start_cycle)
+            # Reject uploads the pipeline would fail on before they reach a worker
+            storage = get_storage()
+            report = validate_upload(storage, upload_id)
+            if not report['valid']:
+                metrics.UPLOADS_REJECTED.inc()
+                return JsonResponse({'error': 'The uploaded files cannot be processed', 'validation': report},
+                                    status=400)
+
+            # Coalesce resubmissions onto the upload's active job and refuse new jobs when the queues are full
+            parameters = {'trim_hours': trim_hours, 'keep_hours': keep_hours, 'bin_hours': sorted(bin_hours, key=int),
+                          'start_cycle': start_cycle}
+            try:
+                outcome, task_id = admit_job(upload_id, parameters)
+            except TimeoutError:
+                outcome, task_id = 'busy', None
+            metrics.JOB_ADMISSIONS.inc(outcome=outcome)
+            if outcome == 'coalesced':
+                return redirect('processing', task_id=task_id)
+            if outcome == 'conflict':
+                return JsonResponse({'error': 'A job with other parameters is already running for these files',
+                                     'task_id': task_id}, status=409)
+            if outcome == 'busy':
+                response = JsonResponse({'error': 'The server is busy, please try again in a few minutes'}, status=503)
+                response['Retry-After'] = '120'
+                return response
+
+            # Enqueue the processing task on the queue for its estimated cost, the upload is free for another job if
+            # either fails
+            try:
+                cost = estimate_job_cost(storage, upload_id, bin_hours)
+                task, queue = enqueue_job(process_files_task,
+                                          (upload_id, trim_hours, keep_hours, bin_hours, start_cycle), cost, task_id)
+            except Exception:
+                release_job(upload_id, task_id)
+                raise
+            metrics.JOBS_ENQUEUED.inc(queue=queue)
 
             # Redirect to the processing page with the task ID
             return redirect('processing', task_id=task.id)
@@ -54,8 +100,7 @@ def download_view(request, upload_id):
     if upload_id != session_upload_id:
         return HttpResponseForbidden('You are not authorized to access this file.')
 
-    file_path = os.path.join(settings.MEDIA_ROOT, f'{upload_id}.zip')
-    if os.path.exists(file_path):
+    if get_storage().exists(f'{upload_id}.zip'):
         return render(request, 'download.html', {'upload_id': upload_id})
     else:
         return HttpResponseNotFound('File not found.')
@@ -79,33 +124,24 @@ def upload_csv_files(request):
             upload_id = str(uuid.uuid4())
             request.session['upload_id'] = upload_id  # Store it in the session
 
-        upload_dir = os.path.join(settings.MEDIA_ROOT, upload_id)
-        os.makedirs(upload_dir, exist_ok=True)
-        request.session['upload_dir'] = upload_dir  # Store directory path in session
+        storage = get_storage()
 
         # Check if the request contains the config file
         config_file = request.FILES.get('config_file')
         if config_file:
-            # Create the 'config' subfolder if it doesn't exist
-            config_dir = os.path.join(upload_dir, 'config')
-            os.makedirs(config_dir, exist_ok=True)
-
-            # Save the config file to the 'config' subfolder
-            config_file_path = os.path.join(config_dir, 'experiment_config.csv')
-            with open(config_file_path, 'wb+') as destination:
-                for chunk in config_file.chunks():
-                    destination.write(chunk)
+            # Save the config file to the 'config' subfolder, its content is only written if it is new
+            if store_upload(storage, upload_id, 'config/experiment_config.csv', config_file):
+                metrics.UPLOAD_BYTES_STORED.inc(config_file.size, kind='config')
+            metrics.UPLOAD_FILES.inc(kind='config')
+            metrics.UPLOAD_BYTES.inc(config_file.size, kind='config')
 
         # Save files uploaded in this request
         files = request.FILES.getlist('file')
         for file in files:
-            file_path = os.path.join(upload_dir, file.name)
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            with open(file_path, 'wb+') as destination:
-                for chunk in file.chunks():
-                    destination.write(chunk)
-
-        request.session['upload_dir'] = upload_dir  # Store directory path in session
+            if store_upload(storage, upload_id, posixpath.basename(file.name), file):
+                metrics.UPLOAD_BYTES_STORED.inc(file.size, kind='data')
+            metrics.UPLOAD_FILES.inc(kind='data')
+            metrics.UPLOAD_BYTES.inc(file.size, kind='data')
 
         return JsonResponse({'message': 'File uploaded successfully', 'upload_id': upload_id})
 
@@ -126,15 +162,171 @@ def task_status(request, task_id):
     return JsonResponse(response_data)
 
 
+def preview_subjects(request, upload_id):
+    """List the subjects of an upload that can be previewed, and start computing their previews at the default
+    resolution so they are cached by the time they are plotted.
+    """
+    if upload_id != request.session.get('upload_id'):
+        return HttpResponseForbidden('You are not authorized to access this upload.')
+
+    subjects = upload_subjects(get_storage(), upload_id)
+    exports = {}
+    for subject_id, (name, digest) in subjects.items():
+        exports.setdefault((name, digest), []).append(subject_id)
+    for (name, digest), subject_ids in exports.items():
+        if len(cached_previews(digest, subject_ids, DEFAULT_POINTS)) < len(subject_ids):
+            request_preview(name, digest, subject_ids[0], DEFAULT_POINTS)
+
+    return JsonResponse({
+        'subjects': [{'subject_id': subject_id, 'file': name} for subject_id, (name, _) in sorted(subjects.items())],
+        'points': PREVIEW_POINTS,
+        'default_points': DEFAULT_POINTS,
+    })
+
+
+def preview_subject(request, upload_id, subject_id):
+    """Return the downsampled series of variables of one subject, its light phases and the trim markers.
+
+    Query parameters:
+    variables: comma-separated columns to return, VO2 and RER by default
+    points: number of points of every series, one of PREVIEW_POINTS
+    trim_hours, keep_hours, start_cycle: processing parameters to place the trim markers at, no markers without them
+
+    Answers 202 with a Retry-After header while the preview is computed.
+    """
+    if upload_id != request.session.get('upload_id'):
+        return HttpResponseForbidden('You are not authorized to access this upload.')
+
+    try:
+        points = int(request.GET.get('points', DEFAULT_POINTS))
+        trim_hours = request.GET.get('trim_hours')
+        keep_hours = request.GET.get('keep_hours')
+        trim = None if trim_hours is None or keep_hours is None else (float(trim_hours), float(keep_hours))
+    except ValueError:
+        return JsonResponse({'error': 'points, trim_hours and keep_hours must be numbers'}, status=400)
+    if points not in PREVIEW_POINTS:
+        return JsonResponse({'error': f"points must be one of {', '.join(map(str, PREVIEW_POINTS))}"}, status=400)
+    start_cycle = request.GET.get('start_cycle', 'Start Light')
+    if start_cycle not in ('Start Light', 'Start Dark'):
+        return JsonResponse({'error': 'start_cycle must be "Start Light" or "Start Dark"'}, status=400)
+
+    subjects = upload_subjects(get_storage(), upload_id)
+    if subject_id not in subjects:
+        return JsonResponse({'error': f'Subject ID {subject_id} is not in the uploaded files'}, status=404)
+    name, digest = subjects[subject_id]
+
+    preview = cached_previews(digest, [subject_id], points).get(subject_id)
+    metrics.CACHE_REQUESTS.inc(cache='preview', result='miss' if preview is None else 'hit')
+    if preview is None:
+        request_preview(name, digest, subject_id, points)
+        response = JsonResponse({'status': 'PENDING'}, status=202)
+        response['Retry-After'] = '1'
+        return response
+    if 'error' in preview:
+        return JsonResponse({'error': preview['error']}, status=422)
+
+    variables = [variable.strip() for variable in request.GET.get('variables', 'VO2,RER').split(',')]
+    missing = [variable for variable in variables if variable not in preview['series']]
+    if missing:
+        return JsonResponse({'error': f"Unknown variables: {', '.join(missing)}",
+                             'variables': list(preview['series'])}, status=400)
+
+    return JsonResponse({
+        'subject_id': subject_id,
+        'file': name,
+        'start': preview['start'],
+        'hours': preview['hours'],
+        'rows': preview['rows'],
+        'points': points,
+        'phases': preview['phases'],
+        'trim': trim and trim_window(preview['phases'], *trim, start_cycle == 'Start Dark'),
+        'series': {variable: preview['series'][variable] for variable in variables},
+    })
+
+
+def _split(value, convert=str):
+    """Return the comma-separated values of a query parameter, None if it is not given."""
+    return None if not value else [convert(item.strip()) for item in value.split(',') if item.strip()]
+
+
+def results_view(request, upload_id):
+    """Return a slice of the combined results of the last job of an upload, a page at a time.
+
+    Query parameters:
+    variables: comma-separated variables to return, all by default
+    bin_hours, step_hours: bin size, or rolling window length and step, to return, all by default
+    groups, subjects: comma-separated group labels and subject IDs to return, all by default
+    day_min, day_max: range of DAY to return
+    format: "json" (default) or "csv"
+    page, page_size: page to return, pages of DEFAULT_PAGE_SIZE rows by default and at most MAX_PAGE_SIZE
+    """
+    if upload_id != request.session.get('upload_id'):
+        return HttpResponseForbidden('You are not authorized to access this upload.')
+
+    params = request.GET
+    try:
+        bin_hours = params.get('bin_hours')
+        step_hours = params.get('step_hours')
+        day_min = params.get('day_min')
+        day_max = params.get('day_max')
+        filters = {
+            'variables': _split(params.get('variables')),
+            'bin_hours': None if bin_hours is None else float(bin_hours),
+            'step_hours': None if step_hours is None else float(step_hours),
+            'groups': _split(params.get('groups')),
+            'subject_ids': _split(params.get('subjects'), int),
+            'day_min': None if day_min is None else int(day_min),
+            'day_max': None if day_max is None else int(day_max),
+        }
+        page_size = int(params.get('page_size', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return JsonResponse({'error': 'bin_hours and step_hours must be numbers, subjects, day_min, day_max and '
+                                      'page_size integers'}, status=400)
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        return JsonResponse({'error': f'page_size must be between 1 and {MAX_PAGE_SIZE}'}, status=400)
+    if filters['step_hours'] is not None and filters['bin_hours'] is None:
+        return JsonResponse({'error': 'step_hours needs bin_hours'}, status=400)
+    output_format = params.get('format', 'json')
+    if output_format not in ('json', 'csv'):
+        return JsonResponse({'error': 'format must be "json" or "csv"'}, status=400)
+
+    try:
+        page = paginate(query_results(upload_id, **filters), params.get('page', 1), page_size)
+    except InvalidPage as e:
+        return JsonResponse({'error': str(e)}, status=404)
+    next_page = None
+    if page.has_next():
+        query = params.copy()
+        query['page'] = page.next_page_number()
+        next_page = request.build_absolute_uri(f'{request.path}?{query.urlencode()}')
+
+    if output_format == 'csv':
+        response = HttpResponse(results_csv(page), content_type='text/csv')
+        response['X-Total-Count'] = page.paginator.count
+        if next_page:
+            response['Link'] = f'<{next_page}>; rel="next"'
+        return response
+    return JsonResponse({
+        'count': page.paginator.count,
+        'page': page.number,
+        'num_pages': page.paginator.num_pages,
+        'next': next_page,
+        'results': result_rows(page),
+    })
+
+
 def download_zip_file(request, upload_id):
     # Check if the upload_id matches the session's upload_id
     session_upload_id = request.session.get('upload_id')
     if upload_id != session_upload_id:
         return HttpResponseForbidden('You are not authorized to access this file.')
 
-    file_path = os.path.join(settings.MEDIA_ROOT, f'{upload_id}.zip')
-    if os.path.exists(file_path):
-        response = FileResponse(open(file_path, 'rb'), content_type='application/zip')
+    storage = get_storage()
+    zip_key = f'{upload_id}.zip'
+    if storage.exists(zip_key):
+        # Streamed from the storage in chunks
+        response = FileResponse(storage.open(zip_key, 'rb'), content_type='application/zip')
+        response['Content-Length'] = storage.size(zip_key)
         response['Content-Disposition'] = f'attachment; filename={upload_id}.zip'
         return response
     else:
@@ -142,8 +334,7 @@ def download_zip_file(request, upload_id):
 
 
 def check_zip_exists(request, upload_id):
-    file_path = os.path.join(settings.MEDIA_ROOT, f'{upload_id}.zip')
-    return JsonResponse({'exists': os.path.exists(file_path)})
+    return JsonResponse({'exists': get_storage().exists(f'{upload_id}.zip')})
 
 
 def download_config_template(request):
@@ -153,10 +344,10 @@ def download_config_template(request):
     Returns: HttpResponse object with the experiment configuration template file.
     """
 
-    # Path to the experiment configuration file
-    config_file = os.path.join(settings.STATIC_ROOT, 'templates', 'experiment_config.csv')
+    # Path to the experiment configuration file in the static files, whether or not collectstatic has run
+    config_file = finders.find('templates/experiment_config.csv')
 
-    if os.path.exists(config_file):
+    if config_file:
         with open(config_file, 'rb') as fh:
             response = HttpResponse(FileWrapper(fh), content_type='text/csv')
             response['Content-Disposition'] = 'attachment; filename=experiment_config.csv'
@@ -165,9 +356,12 @@ def download_config_template(request):
 
 
 def clear_session(request):
-    upload_dir = request.session.get('upload_dir', None)
-    if upload_dir and os.path.exists(upload_dir):
-        shutil.rmtree(upload_dir)  # Delete the session folder and its contents
+    upload_id = request.session.get('upload_id', None)
+    if upload_id:
+        # Delete the uploaded files of the session, their contents once no other upload uses them
+        delete_upload(get_storage(), upload_id)
+        delete_results(upload_id)
+        collect_blobs_task.delay()
 
     request.session.flush()  # Clear all session data
 
@@ -175,4 +369,11 @@ def clear_session(request):
 
 
 def privacy_policy_view(request):
-    return render(request, 'privacy-policy.html')
\ No newline at end of file
+    return render(request, 'privacy-policy.html')
+
+
+def metrics_view(request):
+    """Expose web and worker metrics in the Prometheus text format to the clients in CLAMS_METRICS_ALLOWED_IPS."""
+    if request.META.get('REMOTE_ADDR') not in settings.CLAMS_METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden('You are not authorized to access metrics.')
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
\ No newline at end of file